@@ -0,0 +1,437 @@
+"""
+In-process stand-in for flywheel.Client, serving a synthetic hierarchy.
+
+The hierarchy is never stored: containers and files are generated from their ids,
+so hierarchies of millions of files cost nothing until they are listed. Every
+request sleeps `latency` seconds and file transfers are limited to `bandwidth`
+bytes per second per connection, so benchmarks see network-like timings without
+a Flywheel instance.
+"""
+import hashlib
+import re
+import threading
+import time
+from collections import Counter
+from pathlib import Path
+
+# Ids are 24 hex digits: a level digit, then the index of the container at each
+# level, so sorting ids sorts containers by index like Flywheel's "_id:asc".
+LEVELS = ("group", "project", "subject", "session", "acquisition", "file")
+_INDEX_DIGITS = (0, 5, 6, 4, 4, 4)
+_KINDS = {
+    "projects": "project",
+    "subjects": "subject",
+    "sessions": "session",
+    "acquisitions": "acquisition",
+}
+_FILE_TYPES = (("nifti", ".nii.gz", "MR"), ("dicom", ".dicom.zip", "MR"))
+
+MODIFIED = "2021-01-01T00:00:00+00:00"
+
+
+class FakeApiException(Exception):
+    """
+    Error of a fake request, with the status of an HTTP response.
+    """
+
+    def __init__(self, status, reason=""):
+        super().__init__(f"({status}) {reason}")
+        self.status = status
+        self.headers = {}
+
+
+class Hierarchy:
+    """
+    Shape of a synthetic Flywheel group.
+    """
+
+    def __init__(
+        self,
+        projects=50,
+        subjects=20000,
+        sessions=5,
+        acquisitions=1,
+        files=10,
+        file_size=64 * 1024,
+        group="benchmark",
+    ):
+        """
+        Args:
+            projects (int): Projects of the group.
+            subjects (int): Subjects per project.
+            sessions (int): Sessions per subject.
+            acquisitions (int): Acquisitions per session.
+            files (int): Files per acquisition.
+            file_size (int): Bytes per file.
+            group (str): Id of the group.
+        """
+        self.counts = (1, projects, subjects, sessions, acquisitions, files)
+        self.file_size = file_size
+        self.group = group
+
+    @property
+    def total_files(self):
+        """
+        int: Files in the hierarchy.
+        """
+        total = 1
+        for count in self.counts:
+            total *= count
+        return total
+
+    def make_id(self, indices):
+        """
+        Args:
+            indices (tuple): Index of the container at each level below the
+                group, e.g. (project, subject) for a subject.
+
+        Returns:
+            str: Id of the container or file.
+        """
+        if not indices:
+            return self.group
+        digits = [str(len(indices))]
+        for level, width in enumerate(_INDEX_DIGITS[1:]):
+            index = indices[level] if level < len(indices) else 0
+            digits.append(f"{index:0{width}x}")
+        return "".join(digits)
+
+    def parse_id(self, container_id):
+        """
+        Args:
+            container_id (str): Id made by make_id.
+
+        Returns:
+            tuple: Indices of the container.
+
+        Raises:
+            FakeApiException: The id is not in the hierarchy.
+        """
+        if container_id == self.group:
+            return ()
+        if len(container_id) != 24 or not container_id[0].isdigit():
+            raise FakeApiException(404, f"{container_id} not found")
+        depth = int(container_id[0])
+        indices, position = [], 1
+        for width in _INDEX_DIGITS[1 : depth + 1]:
+            indices.append(int(container_id[position : position + width], 16))
+            position += width
+        if depth >= len(LEVELS) or any(
+            index >= count for index, count in zip(indices, self.counts[1:])
+        ):
+            raise FakeApiException(404, f"{container_id} not found")
+        return tuple(indices)
+
+
+def content(index, size):
+    """
+    Files at the same index of different acquisitions have the same content, so
+    listing a million files only hashes a few.
+
+    Args:
+        index (int): Index of a fake file in its acquisition.
+        size (int): Bytes of the file.
+
+    Returns:
+        bytes: Deterministic content of the file.
+    """
+    block = hashlib.sha256(str(index).encode()).digest()
+    return (block * (size // len(block) + 1))[:size]
+
+
+class Namespace:
+    """
+    Attribute bag standing in for SDK models.
+    """
+
+    def __init__(self, **attributes):
+        self.__dict__.update(attributes)
+
+    def __getitem__(self, key):
+        return getattr(self, key)
+
+
+class FakeFile(Namespace):
+    """
+    File entry of a fake container.
+    """
+
+
+class FakeContainer(Namespace):
+    """
+    Container of the fake hierarchy, with the SDK methods used by the module.
+    """
+
+    def reload(self):
+        self.client._request("reload")
+        return self
+
+    def upload_file(self, path):
+        self.client.upload(self, Path(path))
+
+    def delete_file(self, name):
+        self.client._request("delete_file")
+        self.files = [f for f in self.files if f.name != name]
+
+
+class FakeFinder:
+    """
+    Finder of a fake client, e.g. `client.subjects`.
+    """
+
+    _FILTER = re.compile(r"parents\.(\w+)=(\w+)")
+
+    def __init__(self, client, kind):
+        self.client = client
+        self.kind = kind
+
+    def __call__(self):
+        return self.find()
+
+    def find(self, filter=None, limit=None, sort=None, after_id=None):
+        """
+        Args:
+            filter (str, optional): "parents.<type>=<id>".
+            limit (int, optional): Page size.
+            sort (str, optional): Ignored, results are always sorted by id.
+            after_id (str, optional): Id of the last result of the previous page.
+
+        Returns:
+            list: FakeContainers.
+        """
+        self.client._request(self.kind)
+        level = LEVELS.index(_KINDS.get(self.kind, "group"))
+        parent_level, parent_id = 0, self.client.hierarchy.group
+        if filter:
+            parent_type, parent_id = self._FILTER.match(filter).groups()
+            parent_level = LEVELS.index(parent_type)
+        parent = self.client.hierarchy.parse_id(parent_id)
+        start = 0
+        if after_id is not None and level - parent_level == 1:
+            start = self.client.hierarchy.parse_id(after_id)[-1] + 1
+        containers = []
+        for indices in self.client._descendants(parent, level - parent_level, start):
+            container_id = self.client.hierarchy.make_id(indices)
+            if after_id is not None and container_id <= after_id:
+                continue
+            containers.append(self.client._container(indices))
+            if limit and len(containers) == limit:
+                break
+        return containers
+
+
+class FakeFlywheel:
+    """
+    Stand-in for flywheel.Client serving a Hierarchy.
+
+    Only the SDK calls made by the module are provided. Download URLs are not,
+    so files are downloaded with download_file_from_container. Uploaded files are
+    kept in memory by container.
+    """
+
+    def __init__(self, hierarchy, latency=0.0, bandwidth=None):
+        """
+        Args:
+            hierarchy (Hierarchy): Served hierarchy.
+            latency (float): Seconds added to every request.
+            bandwidth (float, optional): Bytes per second of each transfer, None
+                for no limit.
+        """
+        self.hierarchy = hierarchy
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.calls = Counter()
+        self.uploaded = {}
+        self._hashes = {}
+        self._lock = threading.Lock()
+        for kind in _KINDS:
+            setattr(self, kind, FakeFinder(self, kind))
+
+    def _request(self, name):
+        with self._lock:
+            self.calls[name] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _transfer(self, size):
+        if self.bandwidth:
+            time.sleep(size / self.bandwidth)
+
+    def _descendants(self, parent, depth, start=0):
+        """
+        Args:
+            parent (tuple): Indices of a container.
+            depth (int): Levels below the container.
+            start (int): First index of the level below the container.
+
+        Yields:
+            tuple: Indices of the descendants at that depth, sorted by id.
+        """
+        if depth == 0:
+            yield parent
+            return
+        for index in range(start, self.hierarchy.counts[len(parent) + 1]):
+            yield from self._descendants(parent + (index,), depth - 1)
+
+    def _file_hash(self, index):
+        digest = self._hashes.get(index)
+        if digest is None:
+            digest = hashlib.sha384(content(index, self.hierarchy.file_size))
+            digest = self._hashes[index] = f"v0-sha384-{digest.hexdigest()}"
+        return digest
+
+    def _file(self, indices):
+        file_type, extension, modality = _FILE_TYPES[indices[-1] % len(_FILE_TYPES)]
+        file_id = self.hierarchy.make_id(indices)
+        return FakeFile(
+            id=file_id,
+            file_id=file_id,
+            name=f"file_{indices[-1]}{extension}",
+            type=file_type,
+            size=self.hierarchy.file_size,
+            modified=MODIFIED,
+            hash=self._file_hash(indices[-1]),
+            version=1,
+            modality=modality,
+        )
+
+    def _container(self, indices):
+        """
+        Args:
+            indices (tuple): Indices of the container.
+
+        Returns:
+            FakeContainer: Container with its files.
+        """
+        container_type = LEVELS[len(indices)]
+        container_id = self.hierarchy.make_id(indices)
+        parents = Namespace(
+            **{
+                LEVELS[level]: self.hierarchy.make_id(indices[:level])
+                for level in range(len(indices))
+            }
+        )
+        files = list(self.uploaded.get(container_id, []))
+        if container_type == "acquisition":
+            files = [
+                self._file(indices + (index,))
+                for index in range(self.hierarchy.counts[-1])
+            ] + files
+        return FakeContainer(
+            client=self,
+            id=container_id,
+            label=(
+                f"{container_type} {'-'.join(str(i) for i in indices)}"
+                if indices
+                else self.hierarchy.group
+            ),
+            container_type=container_type,
+            modified=MODIFIED,
+            parents=parents,
+            files=files,
+            analyses=[],
+        )
+
+    def get_current_user(self):
+        self._request("get_current_user")
+        return {"email": "benchmark@example.com"}
+
+    def get_config(self):
+        self._request("get_config")
+        return {"site": {"api_url": "https://fake.flywheel.example/api"}}
+
+    def groups(self):
+        self._request("groups")
+        return [self._container(())]
+
+    def get_group(self, group_id):
+        self._request("get_group")
+        self.hierarchy.parse_id(group_id)
+        return self._container(())
+
+    def get(self, container_id):
+        self._request("get")
+        return self._container(self.hierarchy.parse_id(container_id))
+
+    def lookup(self, path):
+        """
+        Args:
+            path (str): "group/project 0/subject 0-1/..." path of labels.
+
+        Returns:
+            FakeContainer: Container at the path.
+        """
+        self._request("lookup")
+        labels = path.strip("/").split("/")
+        if labels[0] != self.hierarchy.group:
+            raise FakeApiException(404, f"{path} not found")
+        indices = ()
+        for label in labels[1:]:
+            try:
+                indices = tuple(int(i) for i in label.split(" ")[-1].split("-"))
+                self.hierarchy.parse_id(self.hierarchy.make_id(indices))
+            except (ValueError, FakeApiException):
+                raise FakeApiException(404, f"{path} not found")
+        return self._container(indices)
+
+    def get_container_download_url(self, container_id, file_name):
+        raise FakeApiException(501, "No download URLs")
+
+    def download_file_from_container(self, container_id, file_name, dest_file):
+        """
+        Write a file of a container, limited to `bandwidth`.
+
+        Args:
+            container_id (str): Id of the container.
+            file_name (str): Name of the file.
+            dest_file (str): Destination path.
+        """
+        self._request("download_file_from_container")
+        container = self._container(self.hierarchy.parse_id(container_id))
+        for file_entry in container.files:
+            if file_entry.name == file_name:
+                break
+        else:
+            raise FakeApiException(404, f"{file_name} not found")
+        data = self._uploaded_data(container_id, file_name)
+        if data is None:
+            index = self.hierarchy.parse_id(file_entry.id)[-1]
+            data = content(index, file_entry.size)
+        self._transfer(len(data))
+        Path(dest_file).write_bytes(data)
+
+    def _uploaded_data(self, container_id, file_name):
+        for file_entry in self.uploaded.get(container_id, []):
+            if file_entry.name == file_name:
+                return file_entry.data
+        return None
+
+    def upload(self, container, path):
+        """
+        Receive an uploaded file, limited to `bandwidth`.
+
+        Args:
+            container (FakeContainer): Container receiving the file.
+            path (pathlib.Path): Uploaded file.
+        """
+        self._request("upload_file")
+        data = path.read_bytes()
+        self._transfer(len(data))
+        uploaded = self.uploaded.setdefault(container.id, [])
+        versions = [f.version for f in uploaded if f.name == path.name]
+        uploaded[:] = [f for f in uploaded if f.name != path.name]
+        file_id = f"9{hashlib.sha1(container.id.encode() + data).hexdigest()[:23]}"
+        uploaded.append(
+            FakeFile(
+                id=file_id,
+                file_id=file_id,
+                name=path.name,
+                type=None,
+                size=len(data),
+                modified=MODIFIED,
+                hash=f"v0-sha384-{hashlib.sha384(data).hexdigest()}",
+                version=max(versions, default=0) + 1,
+                modality=None,
+                data=data,
+            )
+        )
@@ -0,0 +1,135 @@
+"""
+Micro-benchmark of tree node creation.
+
+Compares the former per-node construction (a QStandardItem per row, resolving the
+module path and decoding its icon from disk for every node) with appending whole
+pages of records to the FlywheelTreeModel.
+
+Run with the Slicer Python interpreter, e.g.:
+
+    Slicer --no-main-window --python-script node_creation_benchmark.py -- \
+        --nodes 20000 --page-size 500
+"""
+import argparse
+import os
+import sys
+import time
+from pathlib import Path
+
+import qt
+
+MODULE_DIR = Path(__file__).resolve().parents[2]
+sys.path.insert(0, str(MODULE_DIR))
+
+from management.node_table import ROOT_REF  # noqa: E402
+from management.records import ContainerRecord, FileRecord  # noqa: E402
+from management.tree_model import FlywheelTreeModel  # noqa: E402
+
+
+def make_records(count):
+    """
+    Args:
+        count (int): Number of acquisitions.
+
+    Returns:
+        list: Acquisition records with one file each.
+    """
+    return [
+        ContainerRecord(
+            f"{index:024x}",
+            f"acquisition {index}",
+            "acquisition",
+            parents={"group": "benchmark", "project": "project"},
+            files=[FileRecord(f"file{index:020x}", "image.nii.gz", "nifti")],
+        )
+        for index in range(count)
+    ]
+
+
+def legacy_rows(records, page_size):
+    """
+    Create rows the way the QStandardItemModel tree did.
+
+    Every row and each of its folders resolved the module directory and decoded its
+    icon from disk, and rows were appended one at a time.
+
+    Args:
+        records (list): Records of the rows.
+        page_size (int): Unused, rows were appended one by one.
+
+    Returns:
+        qt.QStandardItemModel: Populated model.
+    """
+    model = qt.QStandardItemModel()
+    for record in records:
+        source_dir = Path(os.path.realpath(__file__)).parents[2]
+        item = qt.QStandardItem()
+        item.setData(record.id)
+        item.setText(record.label)
+        item.setIcon(qt.QIcon(str(source_dir / "Resources/Icons/acquisition.png")))
+        model.appendRow(item)
+        for folder_name, icon_path in (
+            ("FILES", "Resources/Icons/folder.png"),
+            ("ANALYSES", "Resources/Icons/dwnld-folder.png"),
+        ):
+            source_dir = Path(os.path.realpath(__file__)).parents[2]
+            folder = qt.QStandardItem()
+            folder.setText(folder_name)
+            folder.setIcon(qt.QIcon(str(source_dir / icon_path)))
+            item.appendRow(folder)
+    return model
+
+
+def table_rows(records, page_size):
+    """
+    Append rows to the FlywheelTreeModel one page at a time.
+
+    Args:
+        records (list): Records of the rows.
+        page_size (int): Number of rows per insertion.
+
+    Returns:
+        FlywheelTreeModel: Populated model.
+    """
+    model = FlywheelTreeModel()
+    for start in range(0, len(records), page_size):
+        model.append_children(ROOT_REF, records[start : start + page_size])
+    return model
+
+
+def measure(build, records, page_size, repeat):
+    """
+    Args:
+        build (callable): Function populating a model.
+        records (list): Records of the rows.
+        page_size (int): Number of rows per insertion.
+        repeat (int): Number of runs, the best is kept.
+
+    Returns:
+        float: Nodes created per second.
+    """
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        build(records, page_size)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return len(records) / best
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--nodes", type=int, default=20000)
+    parser.add_argument("--page-size", type=int, default=500)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args(argv)
+
+    records = make_records(args.nodes)
+    for name, build in (("legacy", legacy_rows), ("node table", table_rows)):
+        rate = measure(build, records, args.page_size, args.repeat)
+        print(f"{name:>12}: {rate:12.0f} nodes/s")
+
+
+if __name__ == "__main__":
+    main([arg for arg in sys.argv[1:] if arg != "--"])
+    sys.exit(0)
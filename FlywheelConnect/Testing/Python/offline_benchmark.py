@@ -0,0 +1,500 @@
+"""
+Offline benchmarks of Flywheel Connect against a synthetic Flywheel.
+
+The module runs against the in-process FakeFlywheel of fake_flywheel.py, with
+injected latency and bandwidth, through the same transport, listing cache, tree,
+download, DICOM and upload code as in Slicer. Nothing is sent over the network and
+the cache is a temporary directory.
+
+Run headless with the Slicer Python interpreter, e.g.:
+
+    Slicer --no-main-window --python-script offline_benchmark.py -- \
+        --subjects 20000 --latency 0.05 --bandwidth 50e6 --output results.json
+
+Results are printed and, with --output, written as JSON to compare runs.
+"""
+import argparse
+import io
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from zipfile import ZIP_STORED, ZipFile
+
+import qt
+
+MODULE_DIR = Path(__file__).resolve().parents[2]
+sys.path.insert(0, str(MODULE_DIR))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+from fake_flywheel import FakeFlywheel, Hierarchy  # noqa: E402
+from management.background import MainThreadQueue  # noqa: E402
+from management.cache_manifest import CacheManifest  # noqa: E402
+from management.dicom_cache import DicomExtractCache  # noqa: E402
+from management.download_manager import DownloadManager  # noqa: E402
+from management.instrumentation import PERCENTILES, recorder  # noqa: E402
+from management.listing_cache import ListingCache  # noqa: E402
+from management.node_table import CHILDREN, FILE, FILES, ROOT_REF, SLOTS  # noqa: E402
+from management.search_index import SearchIndex  # noqa: E402
+from management.transport import FlywheelTransport  # noqa: E402
+from management.tree_management import TreeManagement  # noqa: E402
+from management.upload_manager import UploadManager  # noqa: E402
+
+# Version of the JSON results, bumped when their layout changes
+RESULTS_VERSION = 1
+
+# Benchmarks in the order they run; later ones use the rows listed by "tree"
+BENCHMARKS = ("tree", "downloads", "cache_state", "search_index", "dicom", "uploads")
+
+
+def wait_for(predicate, timeout=600):
+    """
+    Process Qt events, delivering MainThreadQueue callbacks, until a condition holds.
+
+    Args:
+        predicate (callable): Returns True once done.
+        timeout (float): Seconds before giving up.
+
+    Raises:
+        TimeoutError: The condition did not hold in time.
+    """
+    deadline = time.perf_counter() + timeout
+    while not predicate():
+        if time.perf_counter() > deadline:
+            raise TimeoutError("Benchmark step did not finish in time")
+        qt.QApplication.processEvents()
+        time.sleep(0.001)
+
+
+def dicom_archive(path, series_count, slices, size):
+    """
+    Write a zip of uncompressed CT series.
+
+    Args:
+        path (pathlib.Path): Archive to write.
+        series_count (int): Number of series.
+        slices (int): Slices per series.
+        size (int): Rows and columns of each slice.
+    """
+    import pydicom
+    from pydicom.dataset import FileDataset, FileMetaDataset
+    from pydicom.uid import ExplicitVRLittleEndian, generate_uid
+
+    with ZipFile(path, "w", ZIP_STORED) as archive:
+        for series_number in range(1, series_count + 1):
+            series_uid = generate_uid()
+            for index in range(slices):
+                file_meta = FileMetaDataset()
+                file_meta.MediaStorageSOPClassUID = "1.2.840.10008.5.1.4.1.1.2"
+                file_meta.MediaStorageSOPInstanceUID = generate_uid()
+                file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+                ds = FileDataset(None, {}, file_meta=file_meta, preamble=b"\0" * 128)
+                ds.is_little_endian = True
+                ds.is_implicit_VR = False
+                ds.SOPClassUID = file_meta.MediaStorageSOPClassUID
+                ds.SOPInstanceUID = file_meta.MediaStorageSOPInstanceUID
+                ds.Modality = "CT"
+                ds.SeriesInstanceUID = series_uid
+                ds.SeriesNumber = series_number
+                ds.InstanceNumber = index + 1
+                ds.ImagePositionPatient = [0, 0, index]
+                ds.ImageOrientationPatient = [1, 0, 0, 0, 1, 0]
+                ds.PixelSpacing = [1, 1]
+                ds.Rows = ds.Columns = size
+                ds.SamplesPerPixel = 1
+                ds.PhotometricInterpretation = "MONOCHROME2"
+                ds.BitsAllocated = ds.BitsStored = 16
+                ds.HighBit = 15
+                ds.PixelRepresentation = 0
+                ds.PixelData = bytes(size * size * 2)
+                buffer = io.BytesIO()
+                pydicom.dcmwrite(buffer, ds, write_like_original=False)
+                archive.writestr(f"{series_number}/{index}.dcm", buffer.getvalue())
+
+
+class OfflineBenchmark:
+    """
+    Module objects wired to a FakeFlywheel, standing in for the module widget.
+
+    TreeManagement reads the tree view, queue, executor, managers and listing
+    cache from its main window; this object provides them.
+    """
+
+    def __init__(self, args, work_dir):
+        """
+        Args:
+            args (argparse.Namespace): Command line arguments.
+            work_dir (pathlib.Path): Temporary directory holding the cache.
+        """
+        self.args = args
+        self.work_dir = work_dir
+        self.hierarchy = Hierarchy(
+            projects=args.projects,
+            subjects=args.subjects,
+            sessions=args.sessions,
+            acquisitions=args.acquisitions,
+            files=args.files,
+            file_size=args.file_size,
+        )
+        self.fake = FakeFlywheel(
+            self.hierarchy, latency=args.latency, bandwidth=args.bandwidth
+        )
+        self.fw_client = FlywheelTransport(self.fake, pool_size=16)
+        cache_dir = work_dir / "flywheelIO"
+        cache_dir.mkdir()
+        self.cache_manifest = CacheManifest(str(cache_dir))
+        self.main_queue = MainThreadQueue()
+        self.listing_executor = ThreadPoolExecutor(
+            max_workers=4, thread_name_prefix="fw-listing"
+        )
+        self.download_manager = DownloadManager(
+            self.main_queue, max_workers=args.download_workers
+        )
+        self.download_manager.fw_client = self.fw_client
+        self.download_manager.transport = self.fw_client
+        self.download_manager.cache_manifest = self.cache_manifest
+        self.upload_manager = UploadManager(self.main_queue)
+        self.upload_manager.fw_client = self.fw_client
+        self.listing_cache = ListingCache(self.fw_client, str(cache_dir))
+        self.treeView = qt.QTreeView()
+        self.tree_management = TreeManagement(self)
+        self.tree_management.expander.listing_cache = self.listing_cache
+        self.model = self.tree_management.source_model
+        self.model.cache_manifest = self.cache_manifest
+        self.results = []
+
+    # Callbacks TreeManagement expects from the module widget
+    def onDownloadProgress(self, files_done, files_total, bytes_done, bytes_total):
+        pass
+
+    def onDownloadsFinished(self, batch):
+        pass
+
+    def onContainerCached(self, record, batch):
+        pass
+
+    def add_result(self, name, seconds, items=0, size=0, **extra):
+        """
+        Record the outcome of a benchmark.
+
+        Args:
+            name (str): Name of the benchmark.
+            seconds (float): Wall time.
+            items (int): Rows, files or checks processed.
+            size (int): Bytes transferred.
+            **extra: Other measures.
+        """
+        result = {"name": name, "seconds": seconds, "items": items, "bytes": size}
+        if seconds > 0:
+            result["items_per_second"] = items / seconds
+            result["megabytes_per_second"] = size / 2 ** 20 / seconds
+        result.update(extra)
+        self.results.append(result)
+        print(f"{name:>28}: {seconds:9.3f} s {items:9d} items {size / 2 ** 20:9.1f} MB")
+
+    def close(self):
+        self.tree_management.cancel_pending()
+        self.tree_management.bulk_downloader.shutdown()
+        self.download_manager.shutdown()
+        self.upload_manager.shutdown()
+        self.listing_executor.shutdown(wait=True)
+        self.listing_cache.close()
+        self.cache_manifest.close()
+
+    def _expand(self, refs):
+        """
+        Expand container rows and wait until they are listed.
+
+        Args:
+            refs (list): References of container rows.
+
+        Returns:
+            float: Seconds taken.
+        """
+        items = [self.model.item_for_ref(ref) for ref in refs]
+        start = time.perf_counter()
+        for item in items:
+            self.tree_management.expander.expand(item)
+        wait_for(lambda: all(item._listed for item in items))
+        return time.perf_counter() - start
+
+    def _children(self, refs, slot=CHILDREN):
+        """
+        Args:
+            refs (list): References of container rows.
+            slot (int): Folder listing the children.
+
+        Returns:
+            list: References of the rows listed in the folder of each container.
+        """
+        table = self.model.table
+        return [
+            child * SLOTS
+            for ref in refs
+            for child in table.child_nodes(ref + slot)
+        ]
+
+    def bench_tree(self):
+        """
+        List a project, page through its subjects and expand down to files.
+        """
+        args = self.args
+        start = time.perf_counter()
+        self.tree_management.populateTree()
+        group = self.model.table.records[self.model.table.child_nodes(ROOT_REF)[0]]
+        projects = self.listing_cache.children(group, "projects")
+        self.model.clear()
+        self.model.append_children(ROOT_REF, projects[:1])
+        self.add_result("tree.populate", time.perf_counter() - start, len(projects))
+        project_ref = self.model.table.child_nodes(ROOT_REF)[0] * SLOTS
+
+        seconds = self._expand([project_ref])
+        self.add_result(
+            "tree.expand_project", seconds, len(self._children([project_ref]))
+        )
+
+        folder = self.model.item_for_ref(project_ref + CHILDREN)
+        expander = self.tree_management.expander
+        start = time.perf_counter()
+        while expander.can_fetch_more(folder):
+            expander.fetch_more(folder)
+            state = self.model.folder_state(folder.ref)
+            wait_for(lambda: not state.fetching)
+        subjects = self._children([project_ref])
+        seconds = time.perf_counter() - start
+        self.add_result("tree.page_subjects", seconds, len(subjects))
+
+        self.model.clear()
+        self.model.append_children(ROOT_REF, projects[:1])
+        project_ref = self.model.table.child_nodes(ROOT_REF)[0] * SLOTS
+        seconds = self._expand([project_ref])
+        self.add_result(
+            "tree.expand_project_warm", seconds, len(self._children([project_ref]))
+        )
+
+        subjects = self._children([project_ref])[: args.expand]
+        seconds = self._expand(subjects)
+        sessions = self._children(subjects)
+        self.add_result("tree.expand_subjects", seconds, len(sessions))
+        seconds = self._expand(sessions)
+        acquisitions = self._children(sessions)
+        self.add_result("tree.expand_sessions", seconds, len(acquisitions))
+        seconds = self._expand(acquisitions)
+        files = self._children(acquisitions, FILES)
+        self.add_result("tree.expand_acquisitions", seconds, len(files))
+        self.file_refs = files
+
+    def bench_downloads(self):
+        """
+        Download files of the expanded acquisitions, then request them again.
+        """
+        refs = self.file_refs[: self.args.downloads]
+        file_items = [self.model.item_for_ref(ref) for ref in refs]
+        for name in ("download.files", "download.cached"):
+            batches = []
+            start = time.perf_counter()
+            self.download_manager.download(file_items, on_finished=batches.append)
+            wait_for(lambda: batches)
+            batch = batches[0]
+            self.add_result(
+                name,
+                time.perf_counter() - start,
+                len(batch.results),
+                batch.bytes_done,
+                errors=len(batch.errors),
+            )
+
+    def bench_cache_state(self):
+        """
+        Check the cached state of listed files against the manifest.
+        """
+        table = self.model.table
+        records = [
+            table.records[node]
+            for node in range(len(table.ids))
+            if table.kinds[node] == FILE and table.records[node] is not None
+        ]
+        if not records:
+            return
+        rounds = max(1, self.args.checks // len(records))
+        start = time.perf_counter()
+        for _ in range(rounds):
+            for record in records:
+                self.cache_manifest.is_current(record)
+        seconds = time.perf_counter() - start
+        self.add_result("cache.is_current", seconds, rounds * len(records))
+        start = time.perf_counter()
+        self.model.refresh_cached({record.id for record in records})
+        self.add_result("cache.refresh_tree", time.perf_counter() - start, len(records))
+
+    def bench_search_index(self):
+        """
+        Index the first project and search it.
+        """
+        project = self.model.table.records[self.model.table.child_nodes(ROOT_REF)[0]]
+        start = time.perf_counter()
+        index = SearchIndex(project).build(self.listing_cache).fetch(self.listing_cache)
+        self.add_result("search.build", time.perf_counter() - start, len(index))
+        start = time.perf_counter()
+        for query in ("s", "su", "sub", "subject 0-1", "nifti"):
+            matches = index.search(query)
+        self.add_result("search.type_ahead", time.perf_counter() - start, len(matches))
+
+    def bench_dicom(self):
+        """
+        Stream and extract a synthetic DICOM archive and create its volumes.
+        """
+        try:
+            import slicer
+
+            from management.dicom_stream import ZipDicomReader
+        except ImportError as exc:
+            print(f"Skipping DICOM benchmarks: {exc}")
+            return
+        args = self.args
+        archive = self.work_dir / "series.dicom.zip"
+        dicom_archive(archive, args.dicom_series, args.dicom_slices, args.dicom_size)
+        size = archive.stat().st_size
+        start = time.perf_counter()
+        with ZipDicomReader(archive) as reader:
+            volumes = [
+                (series, reader.read_volume(series)) for series in reader.read_series()
+            ]
+        self.add_result("dicom.stream", time.perf_counter() - start, len(volumes), size)
+        start = time.perf_counter()
+        for series, volume in volumes:
+            slicer.util.addVolumeFromArray(
+                volume, slicer.util.vtkMatrixFromArray(series.ijk_to_ras), series.name
+            )
+        self.add_result("dicom.add_volumes", time.perf_counter() - start, len(volumes))
+        slicer.mrmlScene.Clear(0)
+        dicom_cache = DicomExtractCache(self.cache_manifest)
+        start = time.perf_counter()
+        dicom_cache.extract(archive, "benchmark-dicom", 1)
+        self.add_result(
+            "dicom.extract",
+            time.perf_counter() - start,
+            args.dicom_series * args.dicom_slices,
+            size,
+        )
+        dicom_cache.shutdown()
+
+    def bench_uploads(self):
+        """
+        Upload files to an acquisition, then upload them again unchanged.
+        """
+        args = self.args
+        upload_dir = self.work_dir / "upload"
+        upload_dir.mkdir()
+        paths = []
+        for index in range(args.uploads):
+            path = upload_dir / f"output_{index}.nrrd"
+            path.write_bytes(os.urandom(args.file_size))
+            paths.append(path)
+        acquisition = self.hierarchy.make_id((0, 0, 0, 0))
+        for name in ("upload.files", "upload.unchanged"):
+            batches = []
+            start = time.perf_counter()
+            self.upload_manager.upload(acquisition, paths, on_finished=batches.append)
+            wait_for(lambda: batches)
+            batch = batches[0]
+            self.add_result(
+                name,
+                time.perf_counter() - start,
+                len(batch.results),
+                batch.bytes_sent,
+                errors=len(batch.errors),
+            )
+
+    def run(self, skip=()):
+        """
+        Run the benchmarks in order.
+
+        Args:
+            skip (iterable): Names of benchmarks to leave out, e.g. "dicom".
+        """
+        self.file_refs = []
+        for name in BENCHMARKS:
+            if name not in skip:
+                getattr(self, f"bench_{name}")()
+
+    def report(self):
+        """
+        Returns:
+            dict: Parameters, environment, results, spans and API call counts.
+        """
+        return {
+            "version": RESULTS_VERSION,
+            "parameters": vars(self.args),
+            "environment": {
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "cpus": os.cpu_count(),
+            },
+            "results": self.results,
+            "spans": [
+                {
+                    "name": name,
+                    "count": count,
+                    **{f"p{p}": percentiles[p] for p in PERCENTILES},
+                    "max": longest,
+                    "bytes": size,
+                    "items": items,
+                }
+                for name, count, percentiles, longest, size, items in recorder.summary()
+            ],
+            "api_calls": dict(self.fake.calls),
+            "coalesced": self.fw_client.coalesced,
+        }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--projects", type=int, default=50)
+    parser.add_argument("--subjects", type=int, default=20000)
+    parser.add_argument("--sessions", type=int, default=5)
+    parser.add_argument("--acquisitions", type=int, default=1)
+    parser.add_argument("--files", type=int, default=10)
+    parser.add_argument("--file-size", type=int, default=256 * 1024)
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds")
+    parser.add_argument("--bandwidth", type=float, default=50e6, help="bytes/s")
+    parser.add_argument("--expand", type=int, default=20, help="subjects expanded")
+    parser.add_argument("--downloads", type=int, default=200)
+    parser.add_argument("--download-workers", type=int, default=4)
+    parser.add_argument("--checks", type=int, default=100000)
+    parser.add_argument("--uploads", type=int, default=20)
+    parser.add_argument("--dicom-series", type=int, default=4)
+    parser.add_argument("--dicom-slices", type=int, default=100)
+    parser.add_argument("--dicom-size", type=int, default=256)
+    parser.add_argument(
+        "--skip",
+        nargs="*",
+        default=[],
+        choices=BENCHMARKS,
+    )
+    parser.add_argument("--output", help="JSON file receiving the results")
+    args = parser.parse_args(argv)
+
+    work_dir = Path(tempfile.mkdtemp(prefix="fw-benchmark-"))
+    # Files are cached under ~/flywheelIO; keep the user's cache out of it.
+    os.environ["HOME"] = os.environ["USERPROFILE"] = str(work_dir)
+    benchmark = OfflineBenchmark(args, work_dir)
+    try:
+        benchmark.run(skip=args.skip)
+        report = benchmark.report()
+    finally:
+        benchmark.close()
+        shutil.rmtree(work_dir, ignore_errors=True)
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(report, output, indent=2)
+
+
+if __name__ == "__main__":
+    main([arg for arg in sys.argv[1:] if arg != "--"])
+    sys.exit(0)
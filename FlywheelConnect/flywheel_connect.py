@@ -1,13 +1,16 @@
-import shutil
 import datetime
+import gzip
+import hashlib
 import logging
 import os
 import os.path as op
+import shutil
 import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
 from glob import glob
-from zipfile import ZipFile
-from importlib import import_module
 from pathlib import Path
+from zipfile import ZipFile
 
 import DICOMLib
 import ctk
@@ -16,7 +19,30 @@ import slicer
 import vtk
 from slicer.ScriptedLoadableModule import *
 
+from management.background import MainThreadQueue
+from management.cache_manifest import CacheManifest, file_id_for_path
+from management.cache_policy import GIGABYTE, CachePolicy
+from management.dicom_cache import DicomExtractCache
+from management.dicom_index import (
+    DicomIndex,
+    deserialize_loadables,
+    serialize_loadables,
+)
+from management.dicom_stream import StreamingUnsupported, ZipDicomReader
+from management.download_manager import CHUNK_SIZE, DownloadJob, DownloadManager
+from management.instrumentation import PERCENTILES, recorder, span
+from management.listing_cache import ListingCache
+from management.load_pipeline import LoadPipeline
+from management.records import PARENT_TYPES, ROOT
+from management.remote_zip import RemoteDicomZip
+from management.sdk_loader import flywheel_sdk
+from management.transport import FlywheelTransport
 from management.tree_management import TreeManagement
+from management.upload_manager import KEEP_BOTH, OVERWRITE, UploadManager
+
+# Node attribute holding the Flywheel id of the file a node was loaded from, for
+# nodes without a storage node in the cache (e.g. streamed DICOM series)
+FILE_ID_ATTRIBUTE = "Flywheel.FileId"
 
 #
 # flywheel_connect
@@ -42,14 +68,8 @@ class flywheel_connect(ScriptedLoadableModule):
         slicer.app.connect("startupCompleted()", self.onStartupCompleted)
 
     def onStartupCompleted(self):
-        FlyW = ""
-        try:
-            FlyW = import_module("flywheel")
-        except ModuleNotFoundError as e:
-            if slicer.util.confirmOkCancelDisplay("Flywheel Connect requires 'flywheel-sdk' Python package. Click OK to install it now."):
-                slicer.util.pip_install("flywheel-sdk")
-                FlyW = import_module("flywheel")
-        globals()["flywheel"] = FlyW
+        # Import the SDK in the background rather than on the startup path.
+        flywheel_sdk.warm_up()
 
 #
 # flywheel_connectWidget
@@ -69,6 +89,35 @@ class flywheel_connectWidget(ScriptedLoadableModuleWidget):
         # Declare Cache path
         self.CacheDir = os.path.expanduser("~") + "/flywheelIO/"
 
+        # Index of cached files, built with a single scan of the cache directory
+        self.cache_manifest = CacheManifest(self.CacheDir)
+
+        # Background downloads report back to the main thread through this queue
+        self.main_queue = MainThreadQueue()
+        self.download_manager = DownloadManager(self.main_queue)
+        self.download_manager.cache_manifest = self.cache_manifest
+        self.upload_manager = UploadManager(self.main_queue)
+        self.cache_policy = CachePolicy(self.cache_manifest, self.main_queue)
+        self.dicom_cache = DicomExtractCache(self.cache_manifest)
+        self.dicom_index = DicomIndex(self.CacheDir)
+        self.listing_workers = 4
+        self.listing_executor = ThreadPoolExecutor(
+            max_workers=self.listing_workers, thread_name_prefix="fw-listing"
+        )
+        # Cached files are decompressed and parsed here before their nodes are created
+        self.decode_executor = ThreadPoolExecutor(
+            max_workers=2, thread_name_prefix="fw-decode"
+        )
+        self.decode_dir = Path(tempfile.mkdtemp(prefix="fw-decode-"))
+        self.listing_cache = None
+        self.fw_client = None
+        # Records of the groups and projects listed in the selectors, by id
+        self.selector_records = {}
+        # Token of the connection being established, see connect_handshake
+        self.connection = None
+        # Group, project and expanded rows of the last session, to be restored
+        self.restored = {}
+
         # #################Declare form elements#######################
 
         # Give a line_edit and label for the API key
@@ -108,13 +157,50 @@ class flywheel_connectWidget(ScriptedLoadableModuleWidget):
         self.useCacheCheckBox = qt.QCheckBox("Cache Images")
         self.useCacheCheckBox.toolTip = (
             """Images cached to "Disk Cache"."""
-            "Otherwise, deleted at every new retrieval."
+            "Otherwise, deleted at every new retrieval unless loaded in the scene."
         )
 
         apiKeyFormLayout.addWidget(self.useCacheCheckBox)
         self.useCacheCheckBox.setCheckState(True)
         self.useCacheCheckBox.setTristate(False)
 
+        #
+        # Download Workers SpinBox
+        #
+        self.downloadWorkersLabel = qt.QLabel("Concurrent downloads:")
+        apiKeyFormLayout.addWidget(self.downloadWorkersLabel)
+        self.downloadWorkersSpinBox = qt.QSpinBox()
+        self.downloadWorkersSpinBox.setRange(1, 16)
+        self.downloadWorkersSpinBox.setValue(self.download_manager.max_workers)
+        self.downloadWorkersSpinBox.toolTip = (
+            "Number of files downloaded from Flywheel in parallel."
+        )
+        apiKeyFormLayout.addWidget(self.downloadWorkersSpinBox)
+
+        #
+        # Cache Budget SpinBox
+        #
+        self.cacheBudgetLabel = qt.QLabel("Cache budget (GB):")
+        apiKeyFormLayout.addWidget(self.cacheBudgetLabel)
+        self.cacheBudgetSpinBox = qt.QDoubleSpinBox()
+        self.cacheBudgetSpinBox.setRange(0.5, 10000)
+        self.cacheBudgetSpinBox.setValue(self.cache_policy.budget / GIGABYTE)
+        self.cacheBudgetSpinBox.toolTip = (
+            "Least recently used files are removed from the disk cache when it grows "
+            "beyond this size. Files loaded in the scene are kept."
+        )
+        apiKeyFormLayout.addWidget(self.cacheBudgetSpinBox)
+
+        #
+        # Prefetch CheckBox
+        #
+        self.prefetchCheckBox = qt.QCheckBox("Prefetch files")
+        self.prefetchCheckBox.toolTip = (
+            "Download the NIfTI and DICOM files of the expanded or selected session "
+            "or acquisition in the background, at low priority."
+        )
+        apiKeyFormLayout.addWidget(self.prefetchCheckBox)
+
         # Data View Section
         self.dataCollapsibleGroupBox = ctk.ctkCollapsibleGroupBox()
         self.dataCollapsibleGroupBox.setTitle("Data")
@@ -122,6 +208,18 @@ class flywheel_connectWidget(ScriptedLoadableModuleWidget):
 
         dataFormLayout = qt.QFormLayout(self.dataCollapsibleGroupBox)
 
+        #
+        # Go To LineEdit
+        #
+        self.goToLabel = qt.QLabel("Go to:")
+        dataFormLayout.addWidget(self.goToLabel)
+        self.goToEdit = qt.QLineEdit()
+        self.goToEdit.placeholderText = (
+            "group/project/subject/session/acquisition or container id"
+        )
+        self.goToEdit.enabled = False
+        dataFormLayout.addWidget(self.goToEdit)
+
         #
         # group Selector ComboBox
         #
@@ -146,6 +244,15 @@ class flywheel_connectWidget(ScriptedLoadableModuleWidget):
         self.projectSelector.setMinimumWidth(200)
         dataFormLayout.addWidget(self.projectSelector)
 
+        # Tree Filter LineEdit
+        self.treeFilterEdit = qt.QLineEdit()
+        self.treeFilterEdit.placeholderText = (
+            "Filter by label, file name, type or modality"
+        )
+        self.treeFilterEdit.clearButtonEnabled = True
+        self.treeFilterEdit.enabled = False
+        dataFormLayout.addWidget(self.treeFilterEdit)
+
         # TreeView for Single Projects containers:
         self.treeView = qt.QTreeView()
 
@@ -153,6 +260,7 @@ class flywheel_connectWidget(ScriptedLoadableModuleWidget):
         self.treeView.setMinimumWidth(200)
         self.treeView.setMinimumHeight(350)
         self.tree_management = TreeManagement(self)
+        self.tree_management.source_model.cache_manifest = self.cache_manifest
         dataFormLayout.addWidget(self.treeView)
 
         # Load Files Button
@@ -160,6 +268,11 @@ class flywheel_connectWidget(ScriptedLoadableModuleWidget):
         self.loadFilesButton.enabled = False
         dataFormLayout.addWidget(self.loadFilesButton)
 
+        # Download Progress Bar
+        self.downloadProgressBar = qt.QProgressBar()
+        self.downloadProgressBar.visible = False
+        dataFormLayout.addWidget(self.downloadProgressBar)
+
         # Upload to Flywheel Button
         self.uploadFilesButton = qt.QPushButton(
             "Upload to Flywheel\nas Container Files"
@@ -176,6 +289,50 @@ class flywheel_connectWidget(ScriptedLoadableModuleWidget):
 
         dataFormLayout.addWidget(self.asAnalysisCheck)
 
+        # Conflict Policy ComboBox
+        self.uploadConflictLabel = qt.QLabel("Existing files with the same name:")
+        dataFormLayout.addWidget(self.uploadConflictLabel)
+        self.uploadConflictSelector = qt.QComboBox()
+        self.uploadConflictSelector.addItem("Overwrite (keep old version)", OVERWRITE)
+        self.uploadConflictSelector.addItem("Keep both", KEEP_BOTH)
+        self.uploadConflictSelector.toolTip = (
+            "Files whose content is already in the container are never uploaded. "
+            "A changed file with the name of an existing file replaces it, Flywheel "
+            'keeping the old one as an earlier version, or is uploaded as "name (2)".'
+        )
+        dataFormLayout.addWidget(self.uploadConflictSelector)
+
+        # Performance Section
+        self.performanceCollapsibleGroupBox = ctk.ctkCollapsibleGroupBox()
+        self.performanceCollapsibleGroupBox.setTitle("Performance")
+        self.performanceCollapsibleGroupBox.collapsed = True
+        self.layout.addWidget(self.performanceCollapsibleGroupBox)
+
+        performanceFormLayout = qt.QFormLayout(self.performanceCollapsibleGroupBox)
+
+        # Span Timings Table
+        self.performanceTable = qt.QTableWidget()
+        self.performanceTable.setColumnCount(5 + len(PERCENTILES))
+        self.performanceTable.setHorizontalHeaderLabels(
+            ["Span", "Count"]
+            + [f"p{p} (ms)" for p in PERCENTILES]
+            + ["Max (ms)", "MB", "Items"]
+        )
+        self.performanceTable.setEditTriggers(qt.QAbstractItemView.NoEditTriggers)
+        self.performanceTable.setMinimumHeight(200)
+        performanceFormLayout.addWidget(self.performanceTable)
+
+        self.refreshPerformanceButton = qt.QPushButton("Refresh")
+        performanceFormLayout.addWidget(self.refreshPerformanceButton)
+        self.clearPerformanceButton = qt.QPushButton("Clear")
+        performanceFormLayout.addWidget(self.clearPerformanceButton)
+        self.exportTraceButton = qt.QPushButton("Export Chrome Trace...")
+        self.exportTraceButton.toolTip = (
+            "Save the recorded timings as a trace file for chrome://tracing or "
+            "Perfetto, e.g. to attach to a ticket."
+        )
+        performanceFormLayout.addWidget(self.exportTraceButton)
+
         # ################# Connect form elements #######################
         self.connectAPIButton.connect("clicked(bool)", self.onConnectAPIPushed)
 
@@ -185,46 +342,225 @@ class flywheel_connectWidget(ScriptedLoadableModuleWidget):
             "currentIndexChanged(QString)", self.onProjectSelected
         )
 
+        self.downloadWorkersSpinBox.connect(
+            "valueChanged(int)", self.onDownloadWorkersChanged
+        )
+
+        self.cacheBudgetSpinBox.connect(
+            "valueChanged(double)", self.onCacheBudgetChanged
+        )
+
+        self.prefetchCheckBox.connect("toggled(bool)", self.onPrefetchToggled)
+
+        self.treeFilterEdit.connect("textChanged(QString)", self.onTreeFilterChanged)
+
+        self.goToEdit.connect("returnPressed()", self.onGoTo)
+
         self.loadFilesButton.connect("clicked(bool)", self.onLoadFilesPushed)
 
         self.uploadFilesButton.connect("clicked(bool)", self.save_scene_to_flywheel)
 
         self.asAnalysisCheck.stateChanged.connect(self.onAnalysisCheckChanged)
 
+        self.performanceCollapsibleGroupBox.connect(
+            "toggled(bool)", self.onPerformanceToggled
+        )
+        self.refreshPerformanceButton.connect(
+            "clicked(bool)", self.refresh_performance_table
+        )
+        self.clearPerformanceButton.connect("clicked(bool)", self.onClearPerformance)
+        self.exportTraceButton.connect("clicked(bool)", self.onExportTrace)
+
         # Add vertical spacer
         self.layout.addStretch(1)
 
+    def enter(self):
+        """
+        Finish importing the flywheel SDK while the API key is entered.
+        """
+        flywheel_sdk.warm_up()
+
+    def load_flywheel(self):
+        """
+        Import the flywheel SDK, offering to install it if missing.
+
+        The import usually completed in the background since startup.
+
+        Returns:
+            module: The flywheel package, None if it is not installed.
+        """
+        try:
+            FlyW = flywheel_sdk.get()
+        except ModuleNotFoundError:
+            if not slicer.util.confirmOkCancelDisplay(
+                "Flywheel Connect requires 'flywheel-sdk' Python package. "
+                "Click OK to install it now."
+            ):
+                return None
+            slicer.util.pip_install("flywheel-sdk")
+            flywheel_sdk.reset()
+            FlyW = flywheel_sdk.get()
+        globals()["flywheel"] = FlyW
+        return FlyW
+
     def onConnectAPIPushed(self):
         """
         Connect to a Flywheel instance for valid api-key.
         """
         try:
+            if self.load_flywheel() is None:
+                return
             # Instantiate and connect widgets ...
             if self.apiKeyTextBox.text:
-                self.fw_client = flywheel.Client(self.apiKeyTextBox.text)
+                fw_client = flywheel.Client(self.apiKeyTextBox.text)
             else:
-                self.fw_client = flywheel.Client()
-            fw_user = self.fw_client.get_current_user()["email"]
-            fw_site = self.fw_client.get_config()["site"]["api_url"]
-            self.logAlertTextLabel.setText(
-                f"You are logged in as {fw_user} to {fw_site}"
+                fw_client = flywheel.Client()
+            # All modules share the pooled, retrying transport wrapping the client
+            self.fw_client = FlywheelTransport(
+                fw_client, pool_size=self.connection_pool_size()
+            )
+            if self.listing_cache:
+                self.listing_cache.close()
+            self.listing_cache = ListingCache(
+                self.fw_client, self.CacheDir, account=self.account_key()
             )
-            # if client valid: TODO
-            groups = self.fw_client.groups()
-            self.groupSelector.enabled = True
-            self.groupSelector.clear()
-            for group in groups:
-                self.groupSelector.addItem(group.label, group.id)
+            self.download_manager.fw_client = self.fw_client
+            self.download_manager.transport = self.fw_client
+            self.upload_manager.fw_client = self.fw_client
+            self.tree_management.expander.listing_cache = self.listing_cache
+            self.tree_management.prefetcher.listing_cache = self.listing_cache
+            self.tree_management.bulk_downloader.listing_cache = self.listing_cache
 
             # Clear out any other instance's data from Slicer before proceeding.
             slicer.mrmlScene.Clear(0)
         except Exception as e:
-            self.groupSelector.clear()
-            self.groupSelector.enabled = False
-            self.apiKeyTextBox.clear()
-            self.projectSelector.clear()
-            self.projectSelector.enabled = False
-            slicer.util.errorDisplay(e)
+            self.connection_failed(e)
+            return
+        self.logAlertTextLabel.setText("Connecting to Flywheel...")
+        self.goToEdit.enabled = True
+        self.restored = self.load_session_state()
+        self.connect_handshake()
+
+    def connect_handshake(self):
+        """
+        Check the api-key and list the groups with concurrent requests.
+
+        The cached groups are listed right away and the group, project and expanded
+        rows of the last session are restored from the listing cache, so the tree is
+        usable before Flywheel answers. The groups are always revalidated, as the
+        permissions of the user may have changed. A failed request undoes the
+        connection.
+        """
+        connection = self.connection = object()
+        replies = {}
+
+        def _replied(name, value):
+            if connection is not self.connection:
+                return
+            replies[name] = value
+            if len(replies) == 2:
+                self.logAlertTextLabel.setText(
+                    f"You are logged in as {replies['user']} to {replies['site']}"
+                )
+
+        def _failed(exc):
+            if connection is self.connection:
+                self.connection = None
+                self.connection_failed(exc)
+
+        self.main_queue.submit(
+            self.listing_executor,
+            self.fw_client.get_current_user,
+            callback=lambda user: _replied("user", user["email"]),
+            errback=_failed,
+        )
+        self.main_queue.submit(
+            self.listing_executor,
+            self.fw_client.get_config,
+            callback=lambda config: _replied("site", config["site"]["api_url"]),
+            errback=_failed,
+        )
+        self.list_into_selector(
+            self.groupSelector,
+            ROOT,
+            "groups",
+            self.onGroupSelected,
+            preferred=self.restored.get("group"),
+            errback=_failed,
+            revalidate=True,
+        )
+
+    def connection_failed(self, exc):
+        """
+        Reset the data widgets after a failed connection.
+
+        Args:
+            exc (Exception): Error of the connection.
+        """
+        self.groupSelector.clear()
+        self.groupSelector.enabled = False
+        self.apiKeyTextBox.clear()
+        self.projectSelector.clear()
+        self.projectSelector.enabled = False
+        self.goToEdit.enabled = False
+        self.logAlertTextLabel.setText("")
+        self.restored = {}
+        slicer.util.errorDisplay(exc)
+
+    def session_key(self):
+        """
+        Returns:
+            str: Digest of the api-key, telling sessions of different users apart
+                without storing the key.
+        """
+        return hashlib.sha256(self.apiKeyTextBox.text.encode()).hexdigest()
+
+    def account_key(self):
+        """
+        Returns:
+            str: Digest of the site URL and the api-key, scoping cached listings to
+                the account they were fetched with.
+        """
+        api_client = getattr(self.fw_client, "api_client", None)
+        host = getattr(getattr(api_client, "configuration", None), "host", None)
+        return hashlib.sha256(
+            f"{host or ''}\n{self.session_key()}".encode()
+        ).hexdigest()
+
+    def load_session_state(self):
+        """
+        Read the group, project and expanded rows saved for the api-key.
+
+        Returns:
+            dict: "group" and "project" ids and "expanded" row state keys, empty if
+                the last session used another api-key.
+        """
+        settings = qt.QSettings()
+        if settings.value("FlywheelConnect/session") != self.session_key():
+            return {}
+        expanded = settings.value("FlywheelConnect/expanded") or ""
+        return {
+            "group": settings.value("FlywheelConnect/group") or None,
+            "project": settings.value("FlywheelConnect/project") or None,
+            "expanded": [key for key in expanded.split(",") if key],
+        }
+
+    def save_session_state(self):
+        """
+        Save the selected group and project and the expanded rows of the tree.
+        """
+        if self.fw_client is None or self.connection is None:
+            return
+        settings = qt.QSettings()
+        settings.setValue("FlywheelConnect/session", self.session_key())
+        settings.setValue("FlywheelConnect/group", self.groupSelector.currentData or "")
+        settings.setValue(
+            "FlywheelConnect/project", self.projectSelector.currentData or ""
+        )
+        settings.setValue(
+            "FlywheelConnect/expanded",
+            ",".join(sorted(self.tree_management.expanded)),
+        )
 
     def onGroupSelected(self, item):
         """
@@ -235,12 +571,139 @@ class flywheel_connectWidget(ScriptedLoadableModuleWidget):
         """
         if item:
             group_id = self.groupSelector.currentData
-            self.group = self.fw_client.get(group_id)
-            projects = self.group.projects()
-            self.projectSelector.enabled = len(projects) > 0
-            self.projectSelector.clear()
-            for project in projects:
-                self.projectSelector.addItem(project.label, project.id)
+            self.group = self.selector_records[group_id]
+            self.list_into_selector(
+                self.projectSelector,
+                self.group,
+                "projects",
+                self.onProjectSelected,
+                preferred=self.restored.get("project"),
+            )
+
+    def list_into_selector(
+        self,
+        selector,
+        parent,
+        kind,
+        on_changed,
+        preferred=None,
+        errback=None,
+        revalidate=False,
+    ):
+        """
+        Fill a selector from the listing cache and refresh it in the background.
+
+        The cached listing is shown immediately. If it is stale or missing, Flywheel
+        is queried on a worker thread and the selector is refilled only if the
+        listing changed.
+
+        Args:
+            selector (qt.QComboBox): Group or project selector.
+            parent (ContainerRecord): Parent of the listing.
+            kind (str): Kind of children (e.g. "projects").
+            on_changed (callable): Selection handler of the selector.
+            preferred (str, optional): Id of the container to select if nothing is.
+            errback (callable, optional): Called with the error of the query.
+            revalidate (bool): Query Flywheel even if the cached listing is fresh.
+        """
+        def _refreshed(result):
+            fresh_records, changed, _ = result
+            if changed:
+                self._fill_selector(selector, fresh_records, on_changed, preferred)
+
+        records, fresh, complete = self.listing_cache.peek(parent, kind)
+        if revalidate or records is None or not fresh or not complete:
+            self.main_queue.submit(
+                self.listing_executor,
+                self.listing_cache.refresh,
+                parent,
+                kind,
+                callback=_refreshed,
+                errback=errback,
+            )
+        self._fill_selector(selector, records or [], on_changed, preferred)
+
+    def _fill_selector(self, selector, records, on_changed, preferred=None):
+        """
+        Replace the items of a selector, keeping the current selection if possible.
+
+        Args:
+            selector (qt.QComboBox): Group or project selector.
+            records (list): ContainerRecords to list.
+            on_changed (callable): Called with the new text if the selection changed.
+            preferred (str, optional): Id of the container to select if nothing is.
+        """
+        current = selector.currentData
+        selector.blockSignals(True)
+        selector.clear()
+        for record in records:
+            self.selector_records[record.id] = record
+            selector.addItem(record.label, record.id)
+        selected = current or preferred
+        index = selector.findData(selected) if selected else -1
+        selector.setCurrentIndex(max(index, 0) if records else -1)
+        selector.blockSignals(False)
+        selector.enabled = len(records) > 0
+        if selector.currentData != current:
+            on_changed(selector.currentText)
+
+    def onGoTo(self):
+        """
+        Jump to the container whose path or id was entered in "Go to".
+
+        The container is found with a single lookup on a worker thread. Only its
+        ancestors missing from the listing cache are fetched.
+        """
+        text = self.goToEdit.text.strip()
+        if not text:
+            return
+        slicer.util.showStatusMessage(f"Looking up {text}...")
+        self.main_queue.submit(
+            self.listing_executor,
+            self.listing_cache.resolve,
+            text,
+            callback=self.go_to,
+            errback=slicer.util.errorDisplay,
+        )
+
+    def go_to(self, path):
+        """
+        Select the group and project of a container and reveal it in the tree.
+
+        Only the rows leading to the container are created. The other projects of
+        the group are listed in the background.
+
+        Args:
+            path (list): ContainerRecords from the group down to the container.
+        """
+        # Analyses are not listed with the child containers; reveal their parent.
+        if path[-1].container_type not in PARENT_TYPES:
+            path = path[:-1]
+        group = path[0]
+        index = self.groupSelector.findData(group.id)
+        if index < 0:
+            slicer.util.errorDisplay(f"Group {group.label} is not accessible.")
+            return
+        self.groupSelector.blockSignals(True)
+        self.groupSelector.setCurrentIndex(index)
+        self.groupSelector.blockSignals(False)
+        self.group = group
+        if len(path) == 1:
+            self.onGroupSelected(self.groupSelector.currentText)
+            return
+        self.treeFilterEdit.clear()
+        self._fill_selector(self.projectSelector, [path[1]], self.onProjectSelected)
+        self.main_queue.submit(
+            self.listing_executor,
+            self.listing_cache.children,
+            group,
+            "projects",
+            callback=lambda records: self._fill_selector(
+                self.projectSelector, records, self.onProjectSelected
+            ),
+        )
+        self.tree_management.reveal(path[1:])
+        slicer.util.showStatusMessage(" / ".join(r.label for r in path), 5000)
 
     def onProjectSelected(self, item):
         """
@@ -249,21 +712,24 @@ class flywheel_connectWidget(ScriptedLoadableModuleWidget):
         Args:
             item (str): Name of project or empty string
         """
-        tree_rows = self.tree_management.source_model.rowCount()
         if item:
             project_id = self.projectSelector.currentData
-            self.project = self.fw_client.get(project_id)
+            self.project = self.selector_records[project_id]
 
             # Remove the rows from the tree and repopulate
-            if tree_rows > 0:
-                self.tree_management.source_model.removeRows(0, tree_rows)
+            self.tree_management.clear_tree()
+            self.treeFilterEdit.clear()
             self.tree_management.populateTreeFromProject(self.project)
+            if self.restored.get("project") == project_id:
+                self.tree_management.restore_expanded(self.restored["expanded"])
+            self.restored = {}
             self.treeView.enabled = True
+            self.treeFilterEdit.enabled = True
         else:
             self.treeView.enabled = False
+            self.treeFilterEdit.enabled = False
             # Remove the rows from the tree and don't repopulate
-            if tree_rows > 0:
-                self.tree_management.source_model.removeRows(0, tree_rows)
+            self.tree_management.clear_tree()
             self.loadFilesButton.enabled = False
 
             self.segmentationButton.enabled = False
@@ -284,6 +750,39 @@ class flywheel_connectWidget(ScriptedLoadableModuleWidget):
 
         return False
 
+    def decode_dicom_archive(self, file_path):
+        """
+        Read a DICOM archive off the main thread.
+
+        Series that can be streamed are decoded straight from the zip. Otherwise the
+        archive is extracted once per Flywheel file version and the extraction
+        is kept in the cache, so re-loading skips decompression.
+
+        Args:
+            file_path (str): path to the cached dicom archive.
+
+        Returns:
+            callable: Creates the nodes of the archive on the main thread.
+        """
+        try:
+            with span("load.dicom_stream", file=Path(file_path).name) as measures:
+                with ZipDicomReader(file_path) as reader:
+                    volumes = [
+                        (series, reader.read_volume(series))
+                        for series in reader.read_series()
+                    ]
+                measures["items"] = len(volumes)
+            file_id = file_id_for_path(file_path)
+            return lambda: self.add_streamed_volumes(file_id, volumes)
+        except StreamingUnsupported as exc:
+            logging.info("Extracting %s: %s", file_path, exc)
+        file_id = file_id_for_path(file_path)
+        entry = self.cache_manifest.get(file_id)
+        version = entry and entry.version
+        with span("load.dicom_extract", file=Path(file_path).name):
+            dicomDataDir = str(self.dicom_cache.extract(file_path, file_id, version))
+        return lambda: self.load_extracted_dicom(file_id, version, dicomDataDir)
+
     def load_dicom_archive(self, file_path):
         """
         Load unzipped DICOMs into Slicer.
@@ -293,41 +792,495 @@ class flywheel_connectWidget(ScriptedLoadableModuleWidget):
 
         https://discourse.slicer.org/t/fastest-way-to-load-dicom/9317/2
         """
-        with tempfile.TemporaryDirectory() as dicomDataDir:
-            dicom_zip = ZipFile(file_path)
-            dicom_zip.extractall(path=dicomDataDir)
-            DICOMLib.importDicom(dicomDataDir)
-            dicomFiles = slicer.util.getFilesInDirectory(dicomDataDir)
-            loadablesByPlugin, loadEnabled = DICOMLib.getLoadablesFromFileLists([dicomFiles])
+        with span("load.dicom_archive", file=Path(file_path).name):
+            self.decode_dicom_archive(file_path)()
+
+    def add_streamed_volumes(self, file_id, volumes):
+        """
+        Add volumes streamed from a DICOM archive to the scene.
+
+        The volumes have no storage node in the cache, so the id of the archive is
+        recorded on them for pinning and analysis provenance (see loaded_file_ids).
+
+        Args:
+            file_id (str): Flywheel id of the archive.
+            volumes (list): (DicomSeries, numpy.ndarray) of each series.
+        """
+        for series, volume in volumes:
+            volumeNode = slicer.util.addVolumeFromArray(
+                volume,
+                slicer.util.vtkMatrixFromArray(series.ijk_to_ras),
+                series.name,
+            )
+            volumeNode.SetAttribute("DICOM.SeriesInstanceUID", series.uid)
+            volumeNode.SetAttribute(FILE_ID_ATTRIBUTE, file_id)
+
+    def load_extracted_dicom(self, file_id, version, dicomDataDir):
+        """
+        Load an extracted DICOM archive through the DICOM database.
+
+        The series and loadables found on the first load are indexed per file
+        version, so re-loading an archive whose series are still in the DICOM
+        database skips the import and loadable discovery.
+
+        Args:
+            file_id (str): Flywheel id of the archive.
+            version (int): Flywheel version of the archive.
+            dicomDataDir (str): Directory of the extracted archive.
+        """
+        loadablesByPlugin = self.indexed_loadables(file_id, version)
+        if loadablesByPlugin is None:
+            with span("load.dicom_import", file=file_id):
+                DICOMLib.importDicom(dicomDataDir)
+            with span("load.dicom_examine", file=file_id) as measures:
+                dicomFiles = slicer.util.getFilesInDirectory(dicomDataDir)
+                measures["items"] = len(dicomFiles)
+                loadablesByPlugin, loadEnabled = DICOMLib.getLoadablesFromFileLists(
+                    [dicomFiles]
+                )
+            self.index_loadables(file_id, version, loadablesByPlugin)
+        with span("load.dicom_load", file=file_id):
             loadedNodeIDs = DICOMLib.loadLoadables(loadablesByPlugin)
 
+    def indexed_loadables(self, file_id, version):
+        """
+        Rebuild the loadables of a DICOM archive loaded before.
+
+        Args:
+            file_id (str): Flywheel id of the archive.
+            version (int): Flywheel version of the archive.
+
+        Returns:
+            dict: Plugin instance -> list of DICOMLoadables, or None if the archive
+                must be imported again.
+        """
+        index_entry = self.dicom_index.get(file_id, version)
+        if index_entry is None or not index_entry.files_exist():
+            return None
+        database = slicer.dicomDatabase
+        if not all(database.filesForSeries(uid) for uid in index_entry.series_uids):
+            return None
+        return deserialize_loadables(
+            index_entry.loadables, slicer.modules.dicomPlugins, DICOMLib.DICOMLoadable
+        )
+
+    def index_loadables(self, file_id, version, loadablesByPlugin):
+        """
+        Index the series and loadables of an imported DICOM archive.
+
+        Args:
+            file_id (str): Flywheel id of the archive.
+            version (int): Flywheel version of the archive.
+            loadablesByPlugin (dict): Plugin instance -> list of DICOMLoadables.
+        """
+        plugin_names = {
+            plugin_class: name
+            for name, plugin_class in slicer.modules.dicomPlugins.items()
+        }
+        loadables = serialize_loadables(loadablesByPlugin, plugin_names)
+        if loadables is None:
+            # Re-loading the archive examines its files again.
+            return
+        # The files of a loadable belong to a single series
+        series_uids = {
+            slicer.dicomDatabase.seriesForFile(attributes["files"][0])
+            for plugin_loadables in loadables.values()
+            for attributes in plugin_loadables
+            if attributes.get("files")
+        }
+        series_uids.discard("")
+        self.dicom_index.put(file_id, version, series_uids, loadables)
+
     def onLoadFilesPushed(self):
         """
         Load tree-selected files into 3D Slicer for viewing.
+
+        Files go through a LoadPipeline: each file is decoded on a worker thread
+        as soon as it lands in the cache, while other files are still downloading,
+        and its nodes are created on the main thread.
         """
 
-        # If Cache not checked, delete CacheDir recursively
+        # Files about to be opened are never evicted
+        file_ids = self.tree_management.selected_file_ids()
+        self.cache_policy.pin(file_ids)
+
+        # If Cache not checked, empty the cache except for files in use
         if not self.useCacheCheckBox.checkState():
-            shutil.rmtree(self.CacheDir)
-            Path(self.CacheDir).mkdir(parents=True, exist_ok=True)
-
-        # Cache all selected files
-        self.tree_management.cache_selected_for_open()
-
-        # Walk through cached files... This could use "types"
-        for k, file_dict in self.tree_management.cache_files.items():
-            file_path = file_dict["file_path"]
-            file_type = file_dict["file_type"]
-            # Check for Flywheel compressed dicom
-            if self.is_compressed_dicom(file_path, file_type):
-                try:
-                    self.load_dicom_archive(file_path)
-                    continue
-                except Exception as e:
-                    print("Not a valid DICOM archive.")
-            # Load using Slicer default node reader
-            if not slicer.app.ioManager().loadFile(file_path):
-                print("Failed to read file: "+file_path)
+            self.cache_policy.schedule(self.loaded_file_ids(), budget=0)
+
+        pipeline = LoadPipeline(
+            self.main_queue,
+            self.decode_executor,
+            self.decode_file,
+            on_finished=lambda timings: self.onFilesLoaded(timings, file_ids),
+        )
+
+        def _downloads_finished(batch):
+            pipeline.finish_submitting()
+            self.onDownloadsFinished(batch)
+
+        # Cache all selected files, decoding each as soon as it is cached
+        self.tree_management.cache_selected_for_open(
+            on_file_cached=lambda item, file_path, file_type: pipeline.submit(
+                item.container.id, file_path, file_type
+            ),
+            on_finished=_downloads_finished,
+        )
+
+    def onFilesLoaded(self, timings, file_ids):
+        """
+        Report stage timings and release the pins of opened files.
+
+        Args:
+            timings (StageTimings): Timings of the opened files.
+            file_ids (list): Flywheel ids of the files pinned for opening.
+        """
+        self.cache_policy.unpin(file_ids)
+        slicer.util.showStatusMessage(timings.report(), 5000)
+
+    def onDownloadsFinished(self, batch):
+        """
+        Report a cancelled batch and evict least recently used files if the cache
+        grew beyond its budget.
+
+        Args:
+            batch (DownloadBatch): Finished or cancelled batch of downloads.
+        """
+        if batch.cancelled:
+            self.downloadProgressBar.visible = False
+            slicer.util.showStatusMessage(
+                f"Download cancelled, {batch.files_done} of {batch.files_total} "
+                "files cached.",
+                5000,
+            )
+        if self.useCacheCheckBox.checkState():
+            self.cache_policy.schedule(self.loaded_file_ids())
+
+    def onContainerCached(self, record, batch):
+        """
+        Report a finished bulk download of a container.
+
+        Args:
+            record (ContainerRecord): Container whose files were cached.
+            batch (DownloadBatch): Finished or cancelled bulk download.
+        """
+        self.downloadProgressBar.visible = False
+        if batch.cancelled:
+            self.onDownloadsFinished(batch)
+            return
+        message = f"Cached {len(batch.results)} files under {record.label}"
+        if batch.errors:
+            message += f", {len(batch.errors)} failed"
+        slicer.util.showStatusMessage(message, 5000)
+        self.onDownloadsFinished(batch)
+
+    def loaded_file_ids(self):
+        """
+        Collect the Flywheel ids of cached files loaded in the MRML scene.
+
+        Returns:
+            set: Ids of the files backing storage nodes of the scene, and of the
+                archives nodes were streamed from.
+        """
+        cache_dir = str(Path(self.CacheDir))
+        file_ids = set()
+        for node in slicer.util.getNodesByClass("vtkMRMLStorageNode"):
+            file_name = node.GetFileName()
+            if file_name and file_name.startswith(cache_dir):
+                file_ids.add(file_id_for_path(file_name))
+        for node in slicer.util.getNodesByClass("vtkMRMLStorableNode"):
+            file_id = node.GetAttribute(FILE_ID_ATTRIBUTE)
+            if file_id:
+                file_ids.add(file_id)
+        return file_ids
+
+    def decode_file(self, file_path, file_type):
+        """
+        Decode a cached Flywheel file on a worker thread.
+
+        DICOM archives are streamed or extracted, gzipped files are decompressed
+        to a temporary file and other files are read ahead into the OS cache, so
+        the main thread only creates nodes.
+
+        Args:
+            file_path (str): Path to the cached file.
+            file_type (str): Type of Flywheel file.
+
+        Returns:
+            callable: Loads the file on the main thread.
+        """
+        # Check for Flywheel compressed dicom
+        if self.is_compressed_dicom(file_path, file_type):
+            try:
+                return self.decode_dicom_archive(file_path)
+            except Exception as e:
+                logging.error("Not a valid DICOM archive %s: %s", file_path, e)
+        if file_path.endswith(".gz"):
+            decompressed = (
+                self.decode_dir / file_id_for_path(file_path) / Path(file_path).stem
+            )
+            decompressed.parent.mkdir(parents=True, exist_ok=True)
+            with span("load.gunzip", file=Path(file_path).name) as measures:
+                with gzip.open(file_path, "rb") as source:
+                    with open(decompressed, "wb") as target:
+                        shutil.copyfileobj(source, target, CHUNK_SIZE)
+                measures["bytes"] = decompressed.stat().st_size
+            return lambda: self.load_decompressed_file(decompressed, file_path)
+        with open(file_path, "rb") as cached_file:
+            while cached_file.read(CHUNK_SIZE):
+                pass
+        return lambda: self.load_cached_file(file_path)
+
+    def load_decompressed_file(self, decompressed, file_path):
+        """
+        Load a file decompressed by decode_file and delete the decompressed copy.
+
+        The storage node is pointed back at the cached file.
+
+        Args:
+            decompressed (pathlib.Path): Decompressed copy of the cached file.
+            file_path (str): Path to the cached file.
+        """
+        try:
+            fileType = slicer.app.coreIOManager().fileType(str(decompressed))
+            with span("load.load_node", file=Path(file_path).name):
+                node = slicer.util.loadNodeFromFile(str(decompressed), fileType)
+        except RuntimeError:
+            logging.error("Failed to read file: %s", file_path)
+            slicer.util.showStatusMessage(
+                f"Failed to read {Path(file_path).name}", 5000
+            )
+            return
+        finally:
+            shutil.rmtree(decompressed.parent, ignore_errors=True)
+        storageNode = node.GetStorageNode()
+        if storageNode:
+            storageNode.SetFileName(file_path)
+
+    def load_cached_file(self, file_path):
+        """
+        Load a cached Flywheel file into 3D Slicer.
+
+        Args:
+            file_path (str): Path to the cached file.
+        """
+        # Load using Slicer default node reader
+        with span("load.load_file", file=Path(file_path).name):
+            loaded = slicer.app.ioManager().loadFile(file_path)
+        if not loaded:
+            logging.error("Failed to read file: %s", file_path)
+            slicer.util.showStatusMessage(
+                f"Failed to read {Path(file_path).name}", 5000
+            )
+
+    def onLoadDicomSeries(self, file_item):
+        """
+        Load chosen series of a DICOM archive without downloading the archive.
+
+        Only the central directory and the headers of the archive are fetched to
+        list its series, then only the members of the chosen series.
+
+        Args:
+            file_item (FileItem): Tree item of the DICOM archive.
+        """
+        file_name = file_item.file.name
+        slicer.util.showStatusMessage(f"Listing the series of {file_name}...")
+        self.main_queue.submit(
+            self.listing_executor,
+            self._list_remote_series,
+            file_item.parent_container.id,
+            file_name,
+            callback=self._choose_remote_series,
+            errback=slicer.util.errorDisplay,
+        )
+
+    def _list_remote_series(self, parent_id, file_name):
+        """
+        Open a remote DICOM archive and list its series. Runs on a worker thread.
+
+        Args:
+            parent_id (str): Id of the container holding the archive.
+            file_name (str): Name of the archive.
+
+        Returns:
+            RemoteDicomZip, list: The open archive and its RemoteSeries.
+        """
+        url = self.fw_client.get_container_download_url(parent_id, file_name)
+        remote_zip = RemoteDicomZip(url, session=self.fw_client.session)
+        try:
+            return remote_zip, remote_zip.list_series()
+        except Exception:
+            remote_zip.close()
+            raise
+
+    def _choose_remote_series(self, result):
+        """
+        Ask which series of a remote archive to load and download them.
+
+        Args:
+            result (tuple): RemoteDicomZip and its RemoteSeries.
+        """
+        remote_zip, series = result
+        chosen = self.select_series_dialog(series)
+        if not chosen:
+            remote_zip.close()
+            return
+        download_dir = tempfile.mkdtemp(prefix="fw-series-")
+
+        def _failed(exc):
+            shutil.rmtree(download_dir, ignore_errors=True)
+            remote_zip.close()
+            slicer.util.errorDisplay(exc)
+
+        self.main_queue.submit(
+            self.listing_executor,
+            remote_zip.download_series,
+            chosen,
+            download_dir,
+            callback=lambda paths: self._load_remote_series(
+                remote_zip, chosen, download_dir
+            ),
+            errback=_failed,
+        )
+
+    def _load_remote_series(self, remote_zip, chosen, download_dir):
+        """
+        Import downloaded series into the DICOM database and load them.
+
+        The files are copied into the database, so the download is discarded.
+
+        Args:
+            remote_zip (RemoteDicomZip): Archive the series were downloaded from.
+            chosen (list): Downloaded RemoteSeries.
+            download_dir (str): Directory holding the downloaded files.
+        """
+        try:
+            DICOMLib.importDicom(download_dir, copyFiles=True)
+        finally:
+            shutil.rmtree(download_dir, ignore_errors=True)
+            remote_zip.close()
+        fileLists = [slicer.dicomDatabase.filesForSeries(s.uid) for s in chosen]
+        loadablesByPlugin, loadEnabled = DICOMLib.getLoadablesFromFileLists(fileLists)
+        loadedNodeIDs = DICOMLib.loadLoadables(loadablesByPlugin)
+
+    def select_series_dialog(self, series):
+        """
+        Let the user choose series of a DICOM archive.
+
+        Args:
+            series (list): RemoteSeries of the archive.
+
+        Returns:
+            list: Chosen RemoteSeries, empty if cancelled.
+        """
+        dialog = qt.QDialog(slicer.util.mainWindow())
+        dialog.setWindowTitle("Load DICOM Series")
+        layout = qt.QVBoxLayout(dialog)
+        seriesList = qt.QListWidget()
+        seriesList.setSelectionMode(qt.QAbstractItemView.ExtendedSelection)
+        for one_series in series:
+            item = qt.QListWidgetItem(
+                f"{one_series.name} ({len(one_series.members)} files, "
+                f"{one_series.size / 2**20:.1f} MB)"
+            )
+            item.setToolTip(
+                "\n".join(f"{tag}: {value}" for tag, value in one_series.tags.items())
+            )
+            seriesList.addItem(item)
+        layout.addWidget(seriesList)
+        buttons = qt.QDialogButtonBox(
+            qt.QDialogButtonBox.Ok | qt.QDialogButtonBox.Cancel
+        )
+        buttons.connect("accepted()", dialog.accept)
+        buttons.connect("rejected()", dialog.reject)
+        layout.addWidget(buttons)
+        if not dialog.exec_():
+            return []
+        return [series[seriesList.row(item)] for item in seriesList.selectedItems()]
+
+    def onDownloadProgress(self, files_done, files_total, bytes_done, bytes_total):
+        """
+        Report aggregate progress of background downloads.
+
+        Args:
+            files_done (int): Number of files finished.
+            files_total (int): Number of files requested.
+            bytes_done (int): Bytes of the finished files.
+            bytes_total (int): Bytes of all requested files.
+        """
+        self.downloadProgressBar.setMaximum(files_total)
+        self.downloadProgressBar.setValue(files_done)
+        self.downloadProgressBar.setFormat(
+            f"%v/%m files ({bytes_done / 2**20:.1f}/{bytes_total / 2**20:.1f} MB)"
+        )
+        self.downloadProgressBar.visible = files_done < files_total
+        slicer.util.showStatusMessage(
+            f"Downloaded {files_done} of {files_total} files from Flywheel.", 2000
+        )
+
+    def onCacheBudgetChanged(self, value):
+        """
+        Apply a new cache budget and evict files if the cache exceeds it.
+
+        Args:
+            value (float): Budget in gigabytes.
+        """
+        self.cache_policy.budget = int(value * GIGABYTE)
+        if self.useCacheCheckBox.checkState():
+            self.cache_policy.schedule(self.loaded_file_ids())
+
+    def onTreeFilterChanged(self, text):
+        """
+        Filter the tree of the project as the user types.
+
+        Args:
+            text (str): Words to look for in labels, file names, types and
+                modalities.
+        """
+        matches = self.tree_management.filter_tree(text)
+        if matches is None or not text.strip():
+            return
+        search_index = self.tree_management.search_index
+        message = f"{matches} matches"
+        if search_index and not search_index.complete:
+            message += " (still indexing the project)"
+        slicer.util.showStatusMessage(message, 2000)
+
+    def onPrefetchToggled(self, checked):
+        """
+        Enable or disable speculative downloads.
+
+        Args:
+            checked (bool): Whether files are prefetched.
+        """
+        self.tree_management.prefetcher.enabled = checked
+        if not checked:
+            self.tree_management.prefetcher.cancel()
+
+    def onDownloadWorkersChanged(self, value):
+        """
+        Resize the download worker pool.
+
+        Args:
+            value (int): Number of concurrent downloads.
+        """
+        self.download_manager.max_workers = value
+        if self.fw_client is not None:
+            self.fw_client.pool_size = self.connection_pool_size()
+
+    def connection_pool_size(self):
+        """
+        Returns:
+            int: Connections kept alive to Flywheel, one per worker thread that may
+                send requests at the same time.
+        """
+        return (
+            self.download_manager.max_workers
+            + self.listing_workers
+            + self.upload_manager.max_workers
+            # Bulk download and prefetch threads
+            + 2
+        )
 
     def save_analysis(self, parent_container_item, output_path):
         """
@@ -337,94 +1290,247 @@ class flywheel_connectWidget(ScriptedLoadableModuleWidget):
             parent_container_item (ContainerItem): Tree Item representation of parent
                 container.
             output_path (Path): Temporary path to where Slicer files are saved.
-        """
-        parent_container = self.fw_client.get(parent_container_item.data())
 
-        # Get all cached paths represented in Slicer
-        input_files_paths = [
-            Path(node.GetFileName())
-            for node in slicer.util.getNodesByClass("vtkMRMLStorageNode")
-            if self.CacheDir in node.GetFileName()
-        ]
+        Returns:
+            UploadBatch: Progress of the upload of the analysis outputs.
+        """
+        parent = parent_container_item.container
 
-        # Represent those files as file reference from their respective parents
-        input_files = [
-            self.fw_client.get(str(input_path.parents[1]).split("/")[-1])
-            .get_file(input_path.name)
-            .ref()
-            for input_path in input_files_paths
-        ]
+        # Represent the loaded files as references built from their cache provenance
+        input_files = self.analysis_inputs(self.loaded_file_ids())
 
         # Generic name... could be improved.
         analysis_name = "3D Slicer " + datetime.datetime.now().strftime(
             "%Y-%m-%d %H:%M:%S"
         )
 
-        # Create analysis container
-        analysis = parent_container.add_analysis(
-            label=analysis_name, inputs=input_files
+        # Create analysis container with a single request
+        add_analysis = getattr(self.fw_client, f"add_{parent.container_type}_analysis")
+        analysis_id = add_analysis(
+            parent.id, flywheel.AnalysisInput(label=analysis_name, inputs=input_files)
         )
 
-        # Get all files from temp directory
-        outputs = [
-            file_path
-            for file_path in glob(str(output_path / "*"))
-            if Path(file_path).is_file()
-        ]
-
         # Finalize analysis
-        analysis.upload_file(outputs)
+        return self.upload_outputs(analysis_id, output_path)
+
+    def analysis_inputs(self, file_ids):
+        """
+        Build references to cached Flywheel files without asking Flywheel.
+
+        The container hosting each file is recorded in the CacheManifest when the
+        file is downloaded. Files indexed by a scan of the cache only know the id of
+        their container; its type is read from the ListingCache.
+
+        Args:
+            file_ids (iterable): Flywheel ids of cached files.
+
+        Returns:
+            list: flywheel.FileReference of each file.
+        """
+        input_files = []
+        for file_id in sorted(file_ids):
+            entry = self.cache_manifest.get(file_id)
+            if entry is None or entry.parent_id is None:
+                logging.warning(
+                    "No Flywheel container recorded for cached file %s", file_id
+                )
+                continue
+            parent_type = entry.parent_type
+            if parent_type is None:
+                parent_type = self.listing_cache.get_record(
+                    entry.parent_id
+                ).container_type
+            input_files.append(
+                flywheel.FileReference(
+                    id=entry.parent_id, type=parent_type, name=entry.name
+                )
+            )
+        return input_files
 
     def save_files_to_container(self, parent_container_item, output_path):
         """
         Save selected files to a parent Flywheel container.
 
-        Files that already exist in the container are ignored.
-
-        TODO: Update the file version
+        Files whose content is already in the container are not uploaded again. A
+        changed file with the name of an existing file overwrites it or is uploaded
+        next to it, as chosen in the conflict selector.
 
         Args:
             parent_container_item (ContainerItem):  Tree Item representation of parent
                 container.
             output_path (Path): Temporary path to where Slicer files are saved.
+
+        Returns:
+            UploadBatch: Progress of the upload.
+        """
+        return self.upload_outputs(
+            parent_container_item.data(),
+            output_path,
+            conflict=self.uploadConflictSelector.itemData(
+                self.uploadConflictSelector.currentIndex
+            ),
+        )
+
+    def upload_outputs(self, container_id, output_path, conflict=OVERWRITE):
+        """
+        Upload the files saved in output_path in the background.
+
+        output_path is removed once the upload finished.
+
+        Args:
+            container_id (str): Id of the container receiving the files.
+            output_path (Path): Temporary path to where Slicer files are saved.
+            conflict (str): Policy for files whose name exists in the container.
+
+        Returns:
+            UploadBatch: Progress of the upload.
         """
-        parent_container = self.fw_client.get(parent_container_item.data()).reload()
-        parent_container_files = [fl.name for fl in parent_container.files]
-        for output_file in [
+        outputs = [
             file_path
             for file_path in glob(str(output_path / "*"))
-            if (
-                Path(file_path).is_file()
-                and Path(file_path).name not in parent_container_files
+            if Path(file_path).is_file()
+        ]
+        started = time.perf_counter()
+
+        def _finished(batch):
+            recorder.record(
+                "upload.batch",
+                started,
+                time.perf_counter() - started,
+                bytes=batch.bytes_sent,
+                items=batch.files_total,
+            )
+            shutil.rmtree(output_path, ignore_errors=True)
+            self.onUploadsFinished(batch)
+
+        return self.upload_manager.upload(
+            container_id,
+            outputs,
+            conflict=conflict,
+            on_progress=self.onUploadProgress,
+            on_finished=_finished,
+        )
+
+    def onUploadProgress(self, files_done, files_total, bytes_done, bytes_total):
+        """
+        Report aggregate progress of background uploads.
+
+        Args:
+            files_done (int): Number of files uploaded or skipped.
+            files_total (int): Number of files to upload.
+            bytes_done (int): Bytes of the finished files.
+            bytes_total (int): Bytes of all files.
+        """
+        self.downloadProgressBar.setMaximum(files_total)
+        self.downloadProgressBar.setValue(files_done)
+        self.downloadProgressBar.setFormat(
+            f"Uploading %v/%m files ({bytes_done / 2**20:.1f}/"
+            f"{bytes_total / 2**20:.1f} MB)"
+        )
+        self.downloadProgressBar.visible = files_done < files_total
+        slicer.util.showStatusMessage(
+            f"Uploaded {files_done} of {files_total} files to Flywheel.", 2000
+        )
+
+    def onUploadsFinished(self, batch):
+        """
+        Report a finished upload.
+
+        Args:
+            batch (UploadBatch): Finished upload.
+        """
+        self.downloadProgressBar.visible = False
+        message = (
+            f"Uploaded {len(batch.uploaded)} files "
+            f"({batch.bytes_sent / 2**20:.1f} MB), "
+            f"{len(batch.unchanged)} unchanged files skipped."
+        )
+        slicer.util.showStatusMessage(message, 5000)
+        if batch.errors:
+            slicer.util.errorDisplay(
+                "Failed to upload:\n"
+                + "\n".join(f"{name}: {error}" for name, error in batch.errors.items())
             )
-        ]:
-            parent_container.upload_file(output_file)
 
     def save_scene_to_flywheel(self):
         """
         Save selected files in the current Slicer scene to a Flywheel Analysis or
         Container.
         """
-        with tempfile.TemporaryDirectory() as tmp_output_path:
-            output_path = Path(tmp_output_path)
-            slicer.mrmlScene.SetRootDirectory(str(output_path))
-            slicer.mrmlScene.SetURL(str(output_path/"Slicer_Scene.mrml"))
-            if slicer.util.openSaveDataDialog():
-                index = self.treeView.selectedIndexes()[0]
-                container_item = self.tree_management.source_model.itemFromIndex(index)
-                save_as_analysis = self.asAnalysisCheck.isChecked()
+        # Removed by upload_outputs once uploaded, as uploads run in the background
+        tmp_output_path = tempfile.mkdtemp(prefix="fw-upload-")
+        output_path = Path(tmp_output_path)
+        slicer.mrmlScene.SetRootDirectory(str(output_path))
+        slicer.mrmlScene.SetURL(str(output_path/"Slicer_Scene.mrml"))
+        if slicer.util.openSaveDataDialog():
+            index = self.treeView.selectedIndexes()[0]
+            container_item = self.tree_management.get_id(index)
+            save_as_analysis = self.asAnalysisCheck.isChecked()
+            # Time spent preparing the upload; the upload itself is "upload.batch"
+            with span("upload.save_scene", analysis=save_as_analysis):
                 if save_as_analysis:
                     self.save_analysis(container_item, output_path)
                 else:
                     self.save_files_to_container(container_item, output_path)
+        else:
+            shutil.rmtree(output_path, ignore_errors=True)
 
-            # Remove storage nodes with the tmp_output_path in them
-            for node in [
-                node
-                for node in slicer.util.getNodesByClass("vtkMRMLStorageNode")
-                if tmp_output_path in node.GetFileName()
-            ]:
-                slicer.mrmlScene.RemoveNode(node)
+        # Remove storage nodes with the tmp_output_path in them
+        for node in [
+            node
+            for node in slicer.util.getNodesByClass("vtkMRMLStorageNode")
+            if tmp_output_path in node.GetFileName()
+        ]:
+            slicer.mrmlScene.RemoveNode(node)
+
+    def onPerformanceToggled(self, checked):
+        """
+        Refresh the timings when the performance section is expanded.
+
+        Args:
+            checked (bool): True if the section is expanded.
+        """
+        if checked:
+            self.refresh_performance_table()
+
+    def refresh_performance_table(self):
+        """
+        Show the percentiles of the recorded span durations.
+        """
+        rows = recorder.summary()
+        self.performanceTable.setRowCount(len(rows))
+        for row, (name, count, percentiles, longest, size, items) in enumerate(rows):
+            values = (
+                [name, str(count)]
+                + [f"{percentiles[p] * 1000:.1f}" for p in PERCENTILES]
+                + [f"{longest * 1000:.1f}", f"{size / 2 ** 20:.1f}", str(items)]
+            )
+            for column, value in enumerate(values):
+                self.performanceTable.setItem(row, column, qt.QTableWidgetItem(value))
+        self.performanceTable.resizeColumnsToContents()
+
+    def onClearPerformance(self):
+        """
+        Forget the recorded timings.
+        """
+        recorder.clear()
+        self.refresh_performance_table()
+
+    def onExportTrace(self):
+        """
+        Save the recorded timings as a Chrome trace JSON file.
+        """
+        file_path = qt.QFileDialog.getSaveFileName(
+            None, "Export Chrome Trace", "flywheel_connect_trace.json", "*.json"
+        )
+        if not file_path:
+            return
+        try:
+            recorder.export_chrome_trace(file_path)
+        except OSError as e:
+            slicer.util.errorDisplay(e)
+            return
+        slicer.util.showStatusMessage(f"Trace saved to {file_path}", 5000)
 
     def onAnalysisCheckChanged(self, item):
         """
@@ -439,8 +1545,24 @@ class flywheel_connectWidget(ScriptedLoadableModuleWidget):
             text = "Upload to Flywheel\nas Container Files"
         self.uploadFilesButton.setText(text)
 
+    def exit(self):
+        self.save_session_state()
+
     def cleanup(self):
-        pass
+        self.save_session_state()
+        self.tree_management.cancel_pending()
+        self.tree_management.bulk_downloader.shutdown()
+        self.download_manager.shutdown()
+        self.upload_manager.shutdown()
+        self.cache_policy.shutdown()
+        self.dicom_cache.shutdown()
+        self.listing_executor.shutdown(wait=False)
+        self.decode_executor.shutdown(wait=False)
+        shutil.rmtree(self.decode_dir, ignore_errors=True)
+        if self.listing_cache:
+            self.listing_cache.close()
+        self.cache_manifest.close()
+        self.dicom_index.close()
 
 
 #
@@ -545,6 +1667,12 @@ class flywheel_connectTest(ScriptedLoadableModuleTest):
         """Run as few or as many tests as needed here."""
         self.setUp()
         self.test_flywheel_connect1()
+        self.setUp()
+        self.test_remote_dicom_zip()
+        self.setUp()
+        self.test_download_queued_prefetch()
+        self.setUp()
+        self.test_flywheel_transport()
 
     def test_flywheel_connect1(self):
         """Ideally you should have several levels of tests.  At the lowest level
@@ -560,18 +1688,294 @@ class flywheel_connectTest(ScriptedLoadableModuleTest):
 
         self.delayDisplay("Starting the test")
         #
-        # first, get some data
+        # first, create some data; the test runs offline
         #
-        import SampleData
-
-        SampleData.downloadFromURL(
-            nodeNames="FA",
-            fileNames="FA.nrrd",
-            uris="http://slicer.kitware.com/midas3/download?items=5767",
+        imageData = vtk.vtkImageData()
+        imageData.SetDimensions(16, 16, 16)
+        imageData.AllocateScalars(vtk.VTK_SHORT, 1)
+        volumeNode = slicer.mrmlScene.AddNewNodeByClass(
+            "vtkMRMLScalarVolumeNode", "FA"
         )
-        self.delayDisplay("Finished with download and loading")
+        volumeNode.SetAndObserveImageData(imageData)
+        self.delayDisplay("Finished creating the volume")
 
-        volumeNode = slicer.util.getNode(pattern="FA")
         logic = flywheel_connectLogic()
-        self.assertIsNotNone(logic.hasImageData(volumeNode))
+        self.assertTrue(logic.hasImageData(volumeNode))
+        self.assertFalse(logic.hasImageData(None))
+        self.delayDisplay("Test passed!")
+
+    @staticmethod
+    def _dicom_slice(series_uid, series_number, slice_index):
+        """
+        Args:
+            series_uid (str): SeriesInstanceUID of the slice.
+            series_number (int): SeriesNumber of the slice.
+            slice_index (int): Position of the slice in the series.
+
+        Returns:
+            bytes: A 256x256 CT slice in DICOM format.
+        """
+        import io
+
+        import pydicom
+        from pydicom.dataset import FileDataset, FileMetaDataset
+        from pydicom.uid import ExplicitVRLittleEndian, generate_uid
+
+        file_meta = FileMetaDataset()
+        file_meta.MediaStorageSOPClassUID = "1.2.840.10008.5.1.4.1.1.2"
+        file_meta.MediaStorageSOPInstanceUID = generate_uid()
+        file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+        ds = FileDataset(None, {}, file_meta=file_meta, preamble=b"\0" * 128)
+        ds.is_little_endian = True
+        ds.is_implicit_VR = False
+        ds.SOPClassUID = file_meta.MediaStorageSOPClassUID
+        ds.SOPInstanceUID = file_meta.MediaStorageSOPInstanceUID
+        ds.PatientName = "Remote^Zip"
+        ds.Modality = "CT"
+        ds.SeriesInstanceUID = series_uid
+        ds.SeriesNumber = series_number
+        ds.SeriesDescription = f"Series {series_number}"
+        ds.InstanceNumber = slice_index + 1
+        ds.ImagePositionPatient = [0, 0, slice_index]
+        ds.ImageOrientationPatient = [1, 0, 0, 0, 1, 0]
+        ds.PixelSpacing = [1, 1]
+        ds.Rows = ds.Columns = 256
+        ds.SamplesPerPixel = 1
+        ds.PhotometricInterpretation = "MONOCHROME2"
+        ds.BitsAllocated = ds.BitsStored = 16
+        ds.HighBit = 15
+        ds.PixelRepresentation = 0
+        ds.PixelData = bytes(256 * 256 * 2)
+        buffer = io.BytesIO()
+        pydicom.dcmwrite(buffer, ds, write_like_original=False)
+        return buffer.getvalue()
+
+    def test_remote_dicom_zip(self):
+        """
+        List the series of a zip served over HTTP and download one of them, without
+        fetching the whole archive.
+        """
+        import io
+        import threading
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+        from pydicom import dcmread
+        from pydicom.uid import generate_uid
+
+        class RangeRequestHandler(BaseHTTPRequestHandler):
+            """
+            Serve `content` with HTTP Range support, as a stand-in for Flywheel
+            storage.
+            """
+
+            content = b""
+
+            def do_GET(self):
+                size = len(self.content)
+                first, last = self.headers["Range"][len("bytes=") :].split("-")
+                if first:
+                    first, last = int(first), min(int(last or size - 1), size - 1)
+                else:
+                    first, last = max(size - int(last), 0), size - 1
+                self.send_response(206)
+                self.send_header("Content-Range", f"bytes {first}-{last}/{size}")
+                self.send_header("Content-Length", str(last - first + 1))
+                self.end_headers()
+                self.wfile.write(self.content[first : last + 1])
+
+            def log_message(self, *args):
+                pass
+
+        self.delayDisplay("Starting the remote DICOM zip test")
+        series_uids = [generate_uid(), generate_uid()]
+        archive = io.BytesIO()
+        with ZipFile(archive, "w") as dicom_zip:
+            for series_number, series_uid in enumerate(series_uids, 1):
+                for slice_index in range(5):
+                    dicom_zip.writestr(
+                        f"{series_number}/{slice_index}.dcm",
+                        self._dicom_slice(series_uid, series_number, slice_index),
+                    )
+        RangeRequestHandler.content = archive.getvalue()
+        server = ThreadingHTTPServer(("127.0.0.1", 0), RangeRequestHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            url = f"http://127.0.0.1:{server.server_port}/dicom.zip"
+            with RemoteDicomZip(url) as remote_zip:
+                series = remote_zip.list_series()
+                self.assertEqual([s.uid for s in series], series_uids)
+                self.assertEqual([len(s.members) for s in series], [5, 5])
+                self.assertEqual(series[1].tags["SeriesDescription"], "Series 2")
+                with tempfile.TemporaryDirectory() as download_dir:
+                    paths = remote_zip.download_series(series[1:], download_dir)
+                    self.assertEqual(
+                        {dcmread(str(path)).SeriesInstanceUID for path in paths},
+                        {series_uids[1]},
+                    )
+                self.assertEqual(len(paths), 5)
+                self.assertLess(
+                    remote_zip.reader.bytes_fetched, len(archive.getvalue())
+                )
+        finally:
+            server.shutdown()
+            server.server_close()
+        self.delayDisplay("Test passed!")
+
+    def test_download_queued_prefetch(self):
+        """
+        Download a file queued behind a running prefetch. The running prefetch
+        pauses while the download is open, so the queued file must not wait for it.
+        """
+        import threading
+
+        chunk = b"x" * 1024
+        started = threading.Event()
+
+        class Response:
+            status_code = 200
+
+            def __enter__(self):
+                return self
+
+            def __exit__(self, *exc_info):
+                pass
+
+            def raise_for_status(self):
+                pass
+
+            def iter_content(self, chunk_size):
+                started.set()
+                for _ in range(8):
+                    yield chunk
+
+        class Session:
+            def get(self, url, headers=None, stream=False, timeout=None):
+                return Response()
+
+        class Client:
+            session = Session()
+
+            def get_container_download_url(self, parent_id, file_name):
+                return f"http://127.0.0.1/{parent_id}/{file_name}"
+
+        class Item:
+            def __init__(self, job):
+                self.job = job
+                self.container = job
+
+            def _download_job(self):
+                return self.job
+
+            def _mark_cached(self):
+                pass
+
+        self.delayDisplay("Starting the queued prefetch test")
+        main_queue = MainThreadQueue()
+        manager = DownloadManager(main_queue)
+        manager.fw_client = manager.transport = Client()
+        with tempfile.TemporaryDirectory() as cache_dir:
+            running, queued = [
+                DownloadJob(
+                    file_id,
+                    f"{file_id}.nii",
+                    "nifti",
+                    8 * len(chunk),
+                    "acquisition",
+                    Path(cache_dir) / "acquisition" / file_id / f"{file_id}.nii",
+                )
+                for file_id in ("running", "queued")
+            ]
+            # 1 KB/s: the running prefetch takes 8 s unless it is paused.
+            manager.prefetch([running, queued], rate=1024)
+            self.assertTrue(started.wait(10))
+            batch = manager.download([Item(queued)])
+            deadline = time.monotonic() + 5
+            while not batch.finished and time.monotonic() < deadline:
+                slicer.app.processEvents()
+                time.sleep(0.05)
+            self.assertTrue(batch.finished)
+            self.assertEqual(batch.errors, {})
+            self.assertTrue(queued.dest_path.exists())
+            manager.shutdown()
+        self.delayDisplay("Test passed!")
+
+    def test_flywheel_transport(self):
+        """
+        Coalesce identical reads, retry reads and writes within the retry budget and
+        halve the concurrency limit when throttled, against a fake client.
+        """
+        import threading
+        from collections import Counter
+
+        class ApiException(Exception):
+            def __init__(self, status):
+                super().__init__(f"HTTP {status}")
+                self.status = status
+
+        class Client:
+            def __init__(self):
+                self.calls = Counter()
+                self.gate = threading.Event()
+                self.throttled = 0
+
+            def get(self, container_id):
+                self.calls["get"] += 1
+                self.gate.wait(10)
+                return {"id": container_id}
+
+            def get_current_user(self):
+                self.calls["get_current_user"] += 1
+                raise ApiException(500)
+
+            def modify_session(self, session_id, update):
+                self.calls["modify_session"] += 1
+                raise ApiException(500)
+
+            def add_note(self, container_id, note):
+                self.calls["add_note"] += 1
+                if self.calls["add_note"] <= self.throttled:
+                    raise ApiException(429)
+                return note
+
+        self.delayDisplay("Starting the transport test")
+        client = Client()
+        transport = FlywheelTransport(client, pool_size=8, max_retries=3, backoff=0)
+
+        # Identical concurrent reads send one request and share its response.
+        results = []
+        threads = [
+            threading.Thread(target=lambda: results.append(transport.get("abc")))
+            for _ in range(8)
+        ]
+        for thread in threads:
+            thread.start()
+        deadline = time.monotonic() + 5
+        while transport.coalesced < 7 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        client.gate.set()
+        for thread in threads:
+            thread.join(10)
+        self.assertEqual(client.calls["get"], 1)
+        self.assertEqual(len(results), 8)
+        self.assertTrue(all(result is results[0] for result in results))
+
+        # A failing read is sent at most max_retries + 1 times.
+        with self.assertRaises(ApiException):
+            transport.get_current_user()
+        self.assertEqual(client.calls["get_current_user"], 4)
+
+        # A write is not retried on a server error, only when throttled.
+        with self.assertRaises(ApiException):
+            transport.modify_session("session", {"label": "renamed"})
+        self.assertEqual(client.calls["modify_session"], 1)
+        self.assertEqual(transport.limit.limit, 8)
+        client.throttled = 1
+        self.assertEqual(transport.add_note("acquisition", "note"), "note")
+        self.assertEqual(client.calls["add_note"], 2)
+
+        # A throttled request halves the limit; it grows back one at a time.
+        self.assertEqual(transport.limit.limit, 4)
+        for _ in range(4):
+            transport.add_note("acquisition", "note")
+        self.assertEqual(transport.limit.limit, 5)
         self.delayDisplay("Test passed!")
@@ -0,0 +1,132 @@
+import logging
+import queue
+import time
+
+log = logging.getLogger(__name__)
+
+
+class MainThreadQueue:
+    """
+    Deliver callbacks from worker threads on the Qt main thread.
+
+    PythonQt cannot declare new Qt signals from Python, so worker threads post
+    callables to this queue and a QTimer owned by the main thread drains it in short,
+    time-boxed batches. This is the same hand-off a queued signal/slot connection
+    would perform.
+    """
+
+    def __init__(self, interval_ms=25, budget_ms=20):
+        """
+        Initialize an idle queue. The drain timer is created on first use.
+
+        Args:
+            interval_ms (int): Milliseconds between drains of the queue.
+            budget_ms (int): Maximum milliseconds spent running callbacks per drain.
+        """
+        self._queue = queue.Queue()
+        self._interval_ms = interval_ms
+        self._budget = budget_ms / 1000.0
+        self._outstanding = 0
+        self._timer = None
+
+    def _ensure_timer(self):
+        """
+        Create the drain timer on the main thread if it does not exist.
+
+        Returns:
+            qt.QTimer: Timer draining this queue.
+        """
+        if self._timer is None:
+            import qt
+
+            self._timer = qt.QTimer()
+            self._timer.setInterval(self._interval_ms)
+            self._timer.timeout.connect(self.drain)
+        return self._timer
+
+    def acquire(self):
+        """
+        Keep the drain timer running until a matching release().
+
+        Must be called from the main thread.
+        """
+        self._outstanding += 1
+        timer = self._ensure_timer()
+        if not timer.isActive():
+            timer.start()
+
+    def release(self):
+        """
+        Release a hold taken with acquire(). Must be called from the main thread.
+        """
+        self._outstanding = max(self._outstanding - 1, 0)
+
+    def post(self, callback, *args):
+        """
+        Queue callback(*args) to run on the main thread.
+
+        Safe to call from any thread while a hold from acquire() is outstanding.
+
+        Args:
+            callback (callable): Function to call on the main thread.
+        """
+        self._queue.put((callback, args))
+
+    def submit(self, executor, fn, *args, callback=None, errback=None):
+        """
+        Run fn(*args) on executor and deliver its outcome on the main thread.
+
+        Args:
+            executor (concurrent.futures.Executor): Executor to run fn on.
+            fn (callable): Function to run in the background.
+            callback (callable, optional): Called with the result of fn.
+            errback (callable, optional): Called with the exception raised by fn.
+
+        Returns:
+            concurrent.futures.Future: Future of the background call.
+        """
+        self.acquire()
+        future = executor.submit(fn, *args)
+        future.add_done_callback(
+            lambda fut: self.post(self._deliver, fut, callback, errback)
+        )
+        return future
+
+    def _deliver(self, future, callback, errback):
+        """
+        Hand the outcome of a finished future to its callbacks.
+
+        Args:
+            future (concurrent.futures.Future): Finished future.
+            callback (callable): Called with the result, if any.
+            errback (callable): Called with the exception, if any.
+        """
+        self.release()
+        if future.cancelled():
+            return
+        exc = future.exception()
+        if exc is not None:
+            if errback:
+                errback(exc)
+            else:
+                log.error("Background task failed: %s", exc)
+        elif callback:
+            callback(future.result())
+
+    def drain(self):
+        """
+        Run queued callbacks until the queue is empty or the time budget is spent.
+        """
+        deadline = time.perf_counter() + self._budget
+        while time.perf_counter() < deadline:
+            try:
+                callback, args = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                callback(*args)
+            except Exception:
+                log.exception("Error in main thread callback.")
+
+        if self._outstanding == 0 and self._queue.empty() and self._timer:
+            self._timer.stop()
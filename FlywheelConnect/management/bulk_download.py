@@ -0,0 +1,374 @@
+import logging
+import os
+import tarfile
+from concurrent.futures import ThreadPoolExecutor
+
+from .download_manager import (
+    CHUNK_SIZE,
+    DownloadBatch,
+    DownloadCancelled,
+    DownloadError,
+    Throttle,
+)
+from .fw_container_items import download_job
+from .instrumentation import span
+
+log = logging.getLogger(__name__)
+
+# Containers whose files can be cached in bulk
+BULK_CONTAINER_TYPES = ("project", "subject", "session", "acquisition")
+
+
+class BulkDownloader:
+    """
+    Cache every file under a container with a single Flywheel bulk download.
+
+    The containers below the chosen one are listed with a query per level (see
+    ListingCache.fetch_descendants) and files already cached or in flight are left
+    out. The remaining files are reserved with the DownloadManager, so a download
+    of one of them waits for the bulk download instead of writing the same ".part"
+    file. A download ticket is created for them and the tar archive is streamed
+    over one connection, each member being unpacked straight into its cache path,
+    verified and recorded in the CacheManifest like a regular download.
+    """
+
+    def __init__(self, download_manager, main_queue):
+        """
+        Initialize the downloader.
+
+        Args:
+            download_manager (DownloadManager): Provides the client, session and
+                manifest, and verifies the unpacked files.
+            main_queue (MainThreadQueue): Queue delivering results to the main thread.
+        """
+        self.download_manager = download_manager
+        self.main_queue = main_queue
+        self.listing_cache = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="fw-bulk")
+        # (DownloadBatch, Throttle) of each running bulk download
+        self._running = []
+
+    def download(self, record, on_progress=None, on_finished=None):
+        """
+        Cache all files under a container in the background.
+
+        Args:
+            record (ContainerRecord): Project, subject, session or acquisition.
+            on_progress (callable, optional): See DownloadBatch.
+            on_finished (callable, optional): See DownloadBatch.
+
+        Returns:
+            DownloadBatch: Progress of the bulk download.
+        """
+        batch = DownloadBatch(on_progress=on_progress, on_finished=on_finished)
+        throttle = Throttle()
+        running = (batch, throttle)
+        self._running.append(running)
+        reserved = {}
+
+        def _finished(error=None):
+            self._running.remove(running)
+            self._unreserve(reserved, error or DownloadCancelled())
+            if batch.on_finished:
+                batch.on_finished(batch)
+
+        def _failed(exc):
+            if not batch.cancelled:
+                log.error("Bulk download of %s failed: %s", record.label, exc)
+                batch.errors[record.id] = exc
+            _finished(exc)
+
+        def _start(planned):
+            if batch.cancelled:
+                _finished()
+                return
+            reserved.update(self.download_manager.reserve([job for _, job in planned]))
+            planned = [
+                (container, job)
+                for container, job in planned
+                if job.file_id in reserved
+            ]
+            self._planned(batch, [job for _, job in planned])
+            if not planned:
+                _finished()
+                return
+            self.main_queue.submit(
+                self._executor,
+                self._run,
+                planned,
+                batch,
+                throttle,
+                reserved,
+                callback=lambda result: _finished(),
+                errback=_failed,
+            )
+
+        self.main_queue.submit(
+            self._executor,
+            self._plan,
+            record,
+            callback=_start,
+            errback=_failed,
+        )
+        return batch
+
+    def _unreserve(self, reserved, error):
+        """
+        Release the files reserved for a finished bulk download.
+
+        Files the bulk download did not resolve fail for the downloads waiting for
+        them.
+
+        Args:
+            reserved (dict): File id -> Future returned by DownloadManager.reserve.
+            error (Exception): Error of the files not resolved.
+        """
+        for file_id, future in reserved.items():
+            if not future.done():
+                future.set_exception(error)
+            self.download_manager.unreserve(file_id, future)
+
+    def _plan(self, record):
+        """
+        List the uncached files under a container. Runs on the bulk thread.
+
+        Args:
+            record (ContainerRecord): Top container.
+
+        Returns:
+            list: (ContainerRecord, DownloadJob) of each uncached file.
+        """
+        with span("download.bulk_plan", container=record.label) as measures:
+            jobs = []
+            for container in [record] + self.listing_cache.fetch_descendants(record):
+                for file_record in container.files or []:
+                    job = download_job(container, file_record)
+                    if not self.download_manager.is_cached(job):
+                        jobs.append((container, job))
+            measures["items"] = len(jobs)
+        return jobs
+
+    def _create_ticket(self, planned):
+        """
+        Create a bulk download ticket for the planned files.
+
+        Files are requested one by one so cached files are not sent. If the server
+        does not accept file nodes, the containers of the files are requested
+        instead and their cached files are skipped while unpacking.
+
+        Args:
+            planned (list): (ContainerRecord, DownloadJob) of the files.
+
+        Returns:
+            str: Id of the ticket.
+        """
+        import flywheel
+
+        fw_client = self.download_manager.fw_client
+        try:
+            nodes = [
+                flywheel.DownloadNode(level="file", id=job.file_id)
+                for _, job in planned
+            ]
+            ticket = fw_client.create_download_ticket(
+                flywheel.DownloadInput(nodes=nodes, optional=True)
+            )
+        except flywheel.ApiException as exc:
+            log.info("File level bulk download refused (%s), using containers", exc)
+            containers = {container.id: container for container, _ in planned}
+            nodes = [
+                flywheel.DownloadNode(level=container.container_type, id=container.id)
+                for container in containers.values()
+            ]
+            ticket = fw_client.create_download_ticket(
+                flywheel.DownloadInput(nodes=nodes, optional=True)
+            )
+        return ticket.ticket
+
+    def _run(self, planned, batch, throttle, reserved):
+        """
+        Request and unpack a bulk download. Runs on the bulk thread.
+
+        Args:
+            planned (list): (ContainerRecord, DownloadJob) of the reserved files.
+            batch (DownloadBatch): Progress of the bulk download.
+            throttle (Throttle): Cancels the download.
+            reserved (dict): File id -> Future resolved as each file is cached.
+        """
+        if throttle.cancelled:
+            raise DownloadCancelled()
+        fw_client = self.download_manager.fw_client
+        labels = {job.file_id: container.label for container, job in planned}
+        by_name = {}
+        for _, job in planned:
+            by_name.setdefault(job.file_name, []).append(job)
+
+        url = fw_client.api_client.configuration.host.rstrip("/") + "/download"
+        ticket = self._create_ticket(planned)
+        with self.download_manager.get_session().get(
+            url, params={"ticket": ticket}, stream=True, timeout=60
+        ) as response:
+            response.raise_for_status()
+            response.raw.decode_content = True
+            with tarfile.open(fileobj=response.raw, mode="r|*") as archive:
+                for member in archive:
+                    if not member.isfile():
+                        continue
+                    job = self._match(member, by_name, labels)
+                    if job is None:
+                        continue
+                    error = None
+                    try:
+                        with span("download.unpack", bytes=member.size):
+                            self._unpack(archive, member, job, throttle)
+                    except DownloadCancelled:
+                        raise
+                    except (DownloadError, OSError) as exc:
+                        error = exc
+                    self._resolve(reserved[job.file_id], job, error)
+                    self.main_queue.post(self._file_done, batch, job, error)
+        for jobs in by_name.values():
+            for job in jobs:
+                error = DownloadError(
+                    f"{job.file_name}: missing from the bulk download."
+                )
+                self._resolve(reserved[job.file_id], job, error)
+                self.main_queue.post(self._file_done, batch, job, error)
+
+    @staticmethod
+    def _resolve(future, job, error):
+        """
+        Hand the outcome of a file to the downloads waiting for it.
+
+        Args:
+            future (concurrent.futures.Future): Reservation of the file.
+            job (DownloadJob): Unpacked or missing file.
+            error (Exception): Error, if the file could not be cached.
+        """
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(job.dest_path)
+
+    @staticmethod
+    def _match(member, by_name, labels):
+        """
+        Find the planned file of an archive member.
+
+        Archive paths are built from container labels, e.g.
+        "flywheel/<group>/<project>/SUBJECTS/<subject>/FILES/<name>", so members
+        are matched by file name, size and the label of the container holding the
+        file. Even a single candidate must match all three, as an archive of whole
+        containers also holds cached files that share the name of a planned one.
+        Cached and ambiguous members are skipped.
+
+        Args:
+            member (tarfile.TarInfo): Member of the archive.
+            by_name (dict): File name -> DownloadJobs not received yet.
+            labels (dict): File id -> label of the container hosting the file.
+
+        Returns:
+            DownloadJob: Planned file, removed from by_name, or None.
+        """
+        parts = member.name.split("/")
+        candidates = [
+            job for job in by_name.get(parts[-1], []) if job.size == member.size
+        ]
+        if len(parts) > 2:
+            label = parts[-3] if parts[-2] == "FILES" else parts[-2]
+            candidates = [job for job in candidates if labels[job.file_id] == label]
+        if len(candidates) != 1:
+            if candidates:
+                log.warning("Cannot tell which file %s is, skipped", member.name)
+            return None
+        job = candidates[0]
+        by_name[parts[-1]].remove(job)
+        return job
+
+    def _unpack(self, archive, member, job, throttle):
+        """
+        Write an archive member to its cache path through a verified ".part" file.
+
+        Args:
+            archive (tarfile.TarFile): Streamed archive.
+            member (tarfile.TarInfo): Member holding the file.
+            job (DownloadJob): Planned file.
+            throttle (Throttle): Cancels the download.
+        """
+        os.makedirs(job.dest_path.parent, exist_ok=True)
+        part_path = job.part_path
+        source = archive.extractfile(member)
+        with open(part_path, "wb") as part_file:
+            for chunk in iter(lambda: source.read(CHUNK_SIZE), b""):
+                part_file.write(chunk)
+                throttle.consume(len(chunk))
+        try:
+            self.download_manager.verify(job, part_path)
+        except DownloadError:
+            part_path.unlink()
+            raise
+        os.replace(part_path, job.dest_path)
+        if self.download_manager.cache_manifest is not None:
+            self.download_manager.cache_manifest.add(
+                job.file_id,
+                job.dest_path,
+                job.version,
+                job.modified,
+                parent_id=job.parent_id,
+                parent_type=job.parent_type,
+            )
+
+    @staticmethod
+    def _planned(batch, jobs):
+        """
+        Record the files of a bulk download once planned.
+
+        Args:
+            batch (DownloadBatch): Progress of the bulk download.
+            jobs (list): DownloadJobs of the files.
+        """
+        batch.files_total = len(jobs)
+        batch.bytes_total = sum(job.size for job in jobs)
+        if batch.on_progress:
+            batch.on_progress(0, batch.files_total, 0, batch.bytes_total)
+
+    @staticmethod
+    def _file_done(batch, job, error):
+        """
+        Update the progress of a bulk download after a file was unpacked.
+
+        Args:
+            batch (DownloadBatch): Progress of the bulk download.
+            job (DownloadJob): Unpacked or missing file.
+            error (Exception): Error, if the file could not be cached.
+        """
+        if batch.cancelled:
+            return
+        batch.files_done += 1
+        batch.bytes_done += job.size
+        if error is not None:
+            log.error("Failed to cache %s: %s", job.file_name, error)
+            batch.errors[job.file_id] = error
+        else:
+            batch.results[job.file_id] = (job.dest_path, job.file_type)
+        if batch.on_progress:
+            batch.on_progress(
+                batch.files_done, batch.files_total, batch.bytes_done, batch.bytes_total
+            )
+
+    def cancel_all(self):
+        """
+        Stop running bulk downloads. Files already unpacked stay in the cache.
+
+        Their batches are marked cancelled; they finish without reporting an error.
+        """
+        for batch, throttle in self._running:
+            batch.cancelled = True
+            throttle.cancel()
+
+    def shutdown(self):
+        """
+        Cancel bulk downloads and stop the bulk thread.
+        """
+        self.cancel_all()
+        self._executor.shutdown(wait=False)
@@ -0,0 +1,399 @@
+import logging
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+from .dicom_cache import EXTRACTED_PREFIX, EXTRACTED_SUFFIX, extracted_key
+
+log = logging.getLogger(__name__)
+
+# Bumped when the layout of the manifest changes; forces a rescan of the cache.
+MANIFEST_VERSION = 4
+
+
+def base_file_id(key):
+    """
+    Args:
+        key (str): Manifest key of a cached file or of its extracted archive.
+
+    Returns:
+        str: Flywheel id of the file.
+    """
+    return key[: -len(EXTRACTED_SUFFIX)] if key.endswith(EXTRACTED_SUFFIX) else key
+
+
+def file_id_for_path(path):
+    """
+    Find the Flywheel file a path of the cache belongs to.
+
+    Cached files live in <parent_id>/<file_id>/<file_name> and extracted archives
+    in <parent_id>/<file_id>/.dicom-v<version>/...
+
+    Args:
+        path (str or pathlib.Path): Path of a cached file or of an extracted member.
+
+    Returns:
+        str: Flywheel id of the file.
+    """
+    parts = Path(path).parts
+    for index, part in enumerate(parts):
+        if part.startswith(EXTRACTED_PREFIX) and index > 0:
+            return parts[index - 1]
+    return parts[-2] if len(parts) > 1 else None
+
+
+def _dir_size(dir_path):
+    """
+    Args:
+        dir_path (str): Directory.
+
+    Returns:
+        int: Bytes used by the files under the directory.
+    """
+    size = 0
+    for walk_path, _, file_names in os.walk(dir_path):
+        for file_name in file_names:
+            try:
+                size += os.path.getsize(os.path.join(walk_path, file_name))
+            except OSError:
+                pass
+    return size
+
+
+class ManifestEntry:
+    """
+    Local copy of a Flywheel file in the disk cache.
+    """
+
+    __slots__ = (
+        "path",
+        "size",
+        "mtime",
+        "atime",
+        "version",
+        "modified",
+        "parent_id",
+        "parent_type",
+    )
+
+    def __init__(
+        self,
+        path,
+        size=0,
+        mtime=0.0,
+        atime=0.0,
+        version=None,
+        modified=None,
+        parent_id=None,
+        parent_type=None,
+    ):
+        """
+        Args:
+            path (str): Path of the cached file.
+            size (int): Size of the cached file in bytes.
+            mtime (float): Modification time of the cached file.
+            atime (float): Last time the file was opened from the cache.
+            version (int): Flywheel version of the cached file, None if unknown.
+            modified (str): Flywheel "modified" timestamp of the cached file.
+            parent_id (str): Flywheel id of the container hosting the file.
+            parent_type (str): Type of that container (e.g. "acquisition"), None if
+                unknown.
+        """
+        self.path = path
+        self.size = size
+        self.mtime = mtime
+        self.atime = atime
+        self.version = version
+        self.modified = modified
+        self.parent_id = parent_id
+        self.parent_type = parent_type
+
+    @property
+    def name(self):
+        """
+        str: Name of the file in its parent container.
+        """
+        return os.path.basename(self.path)
+
+    def matches(self, file_record):
+        """
+        Check whether the cached copy is the current version of a Flywheel file.
+
+        Copies indexed by a directory scan have no version; they are compared by
+        size instead.
+
+        Args:
+            file_record (FileRecord or DownloadJob): Current version of the file.
+
+        Returns:
+            bool: False if the file changed in Flywheel since it was cached.
+        """
+        if self.version is not None and file_record.version is not None:
+            return self.version == file_record.version
+        if self.modified is not None and file_record.modified is not None:
+            return self.modified == file_record.modified
+        return not file_record.size or self.size == file_record.size
+
+    def _row(self, file_id):
+        return (
+            file_id,
+            self.path,
+            self.size,
+            self.mtime,
+            self.atime,
+            self.version,
+            self.modified,
+            self.parent_id,
+            self.parent_type,
+        )
+
+
+class CacheManifest:
+    """
+    Index of the files in the disk cache, keyed by Flywheel file id.
+
+    Files are cached as cache_dir/<parents>/<parent_id>/<file_id>/<file_name>. The
+    manifest is built with a single walk of the cache directory the first time it is
+    opened, persisted in cache_dir/.metadata/manifest.sqlite and kept up to date by
+    the downloader, so checking whether a file is cached is a dictionary lookup.
+
+    Files removed from the cache behind the manifest's back are dropped when they
+    are about to be used (see verify).
+
+    Extracted DICOM archives are indexed as directories under
+    extracted_key(file_id).
+    """
+
+    def __init__(self, cache_dir):
+        """
+        Open the manifest of a cache directory, scanning it if never indexed.
+
+        Args:
+            cache_dir (str): Root of the Flywheel disk cache.
+        """
+        self.cache_dir = Path(cache_dir)
+        self._entries = {}
+        self._lock = threading.Lock()
+        db_dir = self.cache_dir / ".metadata"
+        db_dir.mkdir(parents=True, exist_ok=True)
+        self._db = sqlite3.connect(
+            str(db_dir / "manifest.sqlite"), check_same_thread=False
+        )
+        version = self._db.execute("PRAGMA user_version").fetchone()[0]
+        if version != MANIFEST_VERSION:
+            with self._db:
+                self._db.execute("DROP TABLE IF EXISTS files")
+        with self._db:
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS files ("
+                "file_id TEXT PRIMARY KEY, path TEXT, size INTEGER, mtime REAL, "
+                "atime REAL, version INTEGER, modified TEXT, parent_id TEXT, "
+                "parent_type TEXT)"
+            )
+        if version != MANIFEST_VERSION:
+            self.scan()
+        else:
+            for row in self._db.execute("SELECT * FROM files"):
+                self._entries[row[0]] = ManifestEntry(*row[1:])
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, file_id):
+        return file_id in self._entries
+
+    @property
+    def total_size(self):
+        """
+        int: Bytes used by the cached files.
+        """
+        return sum(entry.size for entry in list(self._entries.values()))
+
+    def scan(self):
+        """
+        Rebuild the manifest from a single walk of the cache directory.
+        """
+        entries = {}
+        for dir_path, dir_names, file_names in os.walk(self.cache_dir):
+            file_id = os.path.basename(dir_path)
+            for dir_name in dir_names:
+                version = dir_name[len(EXTRACTED_PREFIX) :]
+                if dir_name.startswith(EXTRACTED_PREFIX) and version.isdigit():
+                    extraction = os.path.join(dir_path, dir_name)
+                    mtime = os.path.getmtime(extraction)
+                    entries[extracted_key(file_id)] = ManifestEntry(
+                        extraction,
+                        _dir_size(extraction),
+                        mtime,
+                        mtime,
+                        int(version) or None,
+                    )
+            # Skip metadata, partial downloads and extracted archives.
+            dir_names[:] = [name for name in dir_names if not name.startswith(".")]
+            if dir_path == str(self.cache_dir):
+                continue
+            for file_name in file_names:
+                if file_name.startswith("."):
+                    continue
+                path = os.path.join(dir_path, file_name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries[file_id] = ManifestEntry(
+                    path,
+                    stat.st_size,
+                    stat.st_mtime,
+                    max(stat.st_atime, stat.st_mtime),
+                    parent_id=os.path.basename(os.path.dirname(dir_path)),
+                )
+        with self._lock, self._db:
+            self._entries = entries
+            self._db.execute("DELETE FROM files")
+            self._db.executemany(
+                "INSERT INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                [entry._row(file_id) for file_id, entry in entries.items()],
+            )
+            self._db.execute(f"PRAGMA user_version = {MANIFEST_VERSION}")
+        log.info("Indexed %d cached files in %s", len(entries), self.cache_dir)
+
+    def get(self, file_id):
+        """
+        Args:
+            file_id (str): Flywheel id of the file.
+
+        Returns:
+            ManifestEntry: Entry of the cached file or None.
+        """
+        return self._entries.get(file_id)
+
+    def is_current(self, file_record):
+        """
+        Args:
+            file_record (FileRecord or DownloadJob): Current version of a file.
+
+        Returns:
+            bool: True if the current version of the file is cached.
+        """
+        entry = self._entries.get(file_record.id)
+        return entry is not None and entry.matches(file_record)
+
+    def add(
+        self,
+        file_id,
+        path,
+        version=None,
+        modified=None,
+        size=None,
+        parent_id=None,
+        parent_type=None,
+    ):
+        """
+        Record a file that landed in the cache. Safe to call from worker threads.
+
+        The parent container is kept as provenance, so a reference to the file can
+        be built without asking Flywheel.
+
+        Args:
+            file_id (str): Flywheel id of the file.
+            path (str or pathlib.Path): Path of the cached file.
+            version (int, optional): Flywheel version of the file.
+            modified (str, optional): Flywheel "modified" timestamp of the file.
+            size (int, optional): Bytes used, required if path is a directory.
+            parent_id (str, optional): Flywheel id of the container hosting the file.
+            parent_type (str, optional): Type of that container.
+
+        Returns:
+            ManifestEntry: Entry of the cached file.
+        """
+        stat = os.stat(path)
+        entry = ManifestEntry(
+            str(path),
+            stat.st_size if size is None else size,
+            stat.st_mtime,
+            time.time(),
+            version,
+            modified,
+            parent_id,
+            parent_type,
+        )
+        with self._lock, self._db:
+            self._entries[file_id] = entry
+            self._db.execute(
+                "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                entry._row(file_id),
+            )
+        return entry
+
+    def touch(self, file_id):
+        """
+        Record that a cached file was opened, for least recently used eviction.
+
+        Args:
+            file_id (str): Flywheel id of the file.
+        """
+        entry = self._entries.get(file_id)
+        if entry is None:
+            return
+        entry.atime = time.time()
+        with self._lock, self._db:
+            self._db.execute(
+                "UPDATE files SET atime = ? WHERE file_id = ?", (entry.atime, file_id)
+            )
+
+    def by_access_time(self):
+        """
+        Returns:
+            list: (file_id, ManifestEntry) pairs, least recently used first.
+        """
+        with self._lock:
+            items = list(self._entries.items())
+        return sorted(items, key=lambda item: item[1].atime)
+
+    def remove(self, file_id):
+        """
+        Forget a file that was removed from the cache.
+
+        Args:
+            file_id (str): Flywheel id of the file.
+        """
+        with self._lock, self._db:
+            self._entries.pop(file_id, None)
+            self._db.execute("DELETE FROM files WHERE file_id = ?", (file_id,))
+
+    def verify(self, file_record):
+        """
+        Check that the current version of a file is cached and still on disk.
+
+        Entries of files deleted from disk are forgotten.
+
+        Args:
+            file_record (FileRecord or DownloadJob): Current version of the file.
+
+        Returns:
+            bool: True if the file can be served from the cache.
+        """
+        entry = self._entries.get(file_record.id)
+        if entry is None:
+            return False
+        if not os.path.exists(entry.path):
+            self.remove(file_record.id)
+            return False
+        return entry.matches(file_record)
+
+    def clear(self):
+        """
+        Forget all files, e.g. after the cache directory was wiped.
+        """
+        with self._lock, self._db:
+            self._entries = {}
+            self._db.execute("DELETE FROM files")
+
+    def close(self):
+        """
+        Close the database.
+        """
+        with self._lock:
+            self._db.close()
@@ -0,0 +1,153 @@
+import logging
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+
+from .cache_manifest import base_file_id
+
+log = logging.getLogger(__name__)
+
+GIGABYTE = 2 ** 30
+
+
+class CachePolicy:
+    """
+    Keep the disk cache within a byte budget by evicting least recently used files.
+
+    Access times come from the CacheManifest. Pinned files, e.g. files loaded in the
+    MRML scene or about to be opened, are never evicted. Eviction runs on a single
+    background thread so the tree and downloads are not blocked by file deletion.
+
+    Extracted DICOM archives are evicted like files, and are pinned along with the
+    archive they were extracted from.
+    """
+
+    def __init__(self, cache_manifest, main_queue, budget=20 * GIGABYTE):
+        """
+        Initialize the policy.
+
+        Args:
+            cache_manifest (CacheManifest): Index of the cached files.
+            main_queue (MainThreadQueue): Queue delivering results to the main thread.
+            budget (int): Bytes the cache may use before files are evicted.
+        """
+        self.cache_manifest = cache_manifest
+        self.main_queue = main_queue
+        self.budget = budget
+        self._pins = set()
+        self._executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="fw-evict"
+        )
+        self._pending = None
+
+    def pin(self, file_ids):
+        """
+        Keep files in the cache until unpinned, e.g. while they are being opened.
+
+        Args:
+            file_ids (iterable): Flywheel ids of the files.
+        """
+        self._pins = self._pins.union(file_ids)
+
+    def unpin(self, file_ids):
+        """
+        Allow pinned files to be evicted again.
+
+        Args:
+            file_ids (iterable): Flywheel ids of the files.
+        """
+        self._pins = self._pins.difference(file_ids)
+
+    def schedule(self, pinned=(), budget=None, on_finished=None):
+        """
+        Evict files in the background if the cache is over budget.
+
+        A pass that is queued but not started yet is replaced by this one.
+
+        Args:
+            pinned (iterable): Flywheel ids of files that must stay in the cache.
+            budget (int, optional): Budget of this pass, defaults to self.budget.
+                0 empties the cache except for pinned files.
+            on_finished (callable, optional): Called on the main thread with the
+                number of files and bytes evicted.
+
+        Returns:
+            concurrent.futures.Future: The eviction pass.
+        """
+        budget = self.budget if budget is None else budget
+        if self._pending is not None:
+            self._pending.cancel()
+        self._pending = self.main_queue.submit(
+            self._executor,
+            self.evict,
+            frozenset(pinned),
+            budget,
+            callback=on_finished and (lambda result: on_finished(*result)),
+            errback=lambda exc: log.error("Cache eviction failed: %s", exc),
+        )
+        return self._pending
+
+    def evict(self, pinned, budget):
+        """
+        Delete least recently used files until the cache fits the budget.
+
+        Runs on the eviction thread.
+
+        Args:
+            pinned (frozenset): Flywheel ids of files that must stay in the cache.
+            budget (int): Bytes the cache may use.
+
+        Returns:
+            int, int: Number of files and bytes evicted.
+        """
+        used = self.cache_manifest.total_size
+        files, freed = 0, 0
+        for key, entry in self.cache_manifest.by_access_time():
+            if used <= budget:
+                break
+            file_id = base_file_id(key)
+            if file_id in pinned or file_id in self._pins:
+                continue
+            try:
+                if os.path.isdir(entry.path):
+                    shutil.rmtree(entry.path)
+                else:
+                    os.remove(entry.path)
+            except FileNotFoundError:
+                pass
+            except OSError as exc:
+                log.warning("Could not evict %s: %s", entry.path, exc)
+                continue
+            self._prune_dirs(os.path.dirname(entry.path))
+            self.cache_manifest.remove(key)
+            used -= entry.size
+            files += 1
+            freed += entry.size
+        if files:
+            log.info(
+                "Evicted %d files (%.1f MB) from the cache", files, freed / 2 ** 20
+            )
+        return files, freed
+
+    def _prune_dirs(self, dir_path):
+        """
+        Remove empty directories left by an evicted file, up to the cache root.
+
+        Args:
+            dir_path (str): Directory of the evicted file.
+        """
+        cache_dir = str(self.cache_manifest.cache_dir)
+        while os.path.commonpath([dir_path, cache_dir]) == cache_dir:
+            if dir_path == cache_dir:
+                break
+            try:
+                os.rmdir(dir_path)
+            except OSError:
+                break
+            dir_path = os.path.dirname(dir_path)
+
+    def shutdown(self):
+        """
+        Stop the eviction thread once the current pass finished.
+        """
+        self._executor.shutdown(wait=False)
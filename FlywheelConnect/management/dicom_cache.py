@@ -0,0 +1,144 @@
+import logging
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from zipfile import ZipFile
+
+log = logging.getLogger(__name__)
+
+# Manifest key suffix of the extracted series of a DICOM archive
+EXTRACTED_SUFFIX = "#dicom"
+# Prefix of the hidden directory holding the extraction next to the archive
+EXTRACTED_PREFIX = ".dicom-v"
+
+
+def extracted_key(file_id):
+    """
+    Args:
+        file_id (str): Flywheel id of a DICOM archive.
+
+    Returns:
+        str: Manifest key of the extracted archive.
+    """
+    return file_id + EXTRACTED_SUFFIX
+
+
+def extracted_dir(zip_path, version):
+    """
+    Args:
+        zip_path (pathlib.Path): Cached DICOM archive.
+        version (int): Flywheel version of the archive, None if unknown.
+
+    Returns:
+        pathlib.Path: Directory of the extracted archive, next to the archive.
+    """
+    return Path(zip_path).parent / f"{EXTRACTED_PREFIX}{version or 0}"
+
+
+class DicomExtractCache:
+    """
+    Persistent cache of extracted DICOM archives.
+
+    Archives are extracted once per Flywheel file version into a hidden directory
+    next to the cached zip and indexed in the CacheManifest under
+    extracted_key(file_id), so they are evicted by the same CachePolicy as the zip
+    files. Members are decompressed on several threads, each reading the archive
+    through its own handle.
+    """
+
+    def __init__(self, cache_manifest, max_workers=4):
+        """
+        Initialize the cache.
+
+        Args:
+            cache_manifest (CacheManifest): Index of the cached files.
+            max_workers (int): Number of threads decompressing members.
+        """
+        self.cache_manifest = cache_manifest
+        self.max_workers = max_workers
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="fw-extract"
+        )
+
+    def extract(self, zip_path, file_id, version=None):
+        """
+        Return the extracted archive, extracting it if not cached.
+
+        Args:
+            zip_path (str or pathlib.Path): Cached DICOM archive.
+            file_id (str): Flywheel id of the archive.
+            version (int, optional): Flywheel version of the archive.
+
+        Returns:
+            pathlib.Path: Directory holding the extracted DICOM files.
+        """
+        key = extracted_key(file_id)
+        entry = self.cache_manifest.get(key)
+        if (
+            entry is not None
+            and entry.version == version
+            and os.path.isdir(entry.path)
+        ):
+            self.cache_manifest.touch(key)
+            return Path(entry.path)
+
+        target = extracted_dir(zip_path, version)
+        staging = target.with_name(f"{target.name}.tmp-{os.getpid()}")
+        shutil.rmtree(staging, ignore_errors=True)
+        try:
+            size = self._extract_parallel(zip_path, staging)
+            shutil.rmtree(target, ignore_errors=True)
+            os.replace(staging, target)
+        except Exception:
+            shutil.rmtree(staging, ignore_errors=True)
+            raise
+        if entry is not None and entry.path != str(target):
+            shutil.rmtree(entry.path, ignore_errors=True)
+        self.cache_manifest.add(key, target, version=version, size=size)
+        return target
+
+    def _extract_parallel(self, zip_path, dest_dir):
+        """
+        Extract all members of an archive, split across the worker threads.
+
+        Args:
+            zip_path (str or pathlib.Path): Archive to extract.
+            dest_dir (pathlib.Path): Directory receiving the members.
+
+        Returns:
+            int: Uncompressed size of the archive in bytes.
+        """
+        with ZipFile(zip_path) as dicom_zip:
+            members = [info for info in dicom_zip.infolist() if not info.is_dir()]
+        # Largest members first, dealt round robin, to balance the threads.
+        members.sort(key=lambda info: info.file_size, reverse=True)
+        groups = [members[i :: self.max_workers] for i in range(self.max_workers)]
+        futures = [
+            self._executor.submit(self._extract_members, zip_path, group, dest_dir)
+            for group in groups
+            if group
+        ]
+        for future in futures:
+            future.result()
+        return sum(info.file_size for info in members)
+
+    @staticmethod
+    def _extract_members(zip_path, members, dest_dir):
+        """
+        Extract some members of an archive through a private handle.
+
+        Args:
+            zip_path (str or pathlib.Path): Archive to extract.
+            members (list): ZipInfo of the members to extract.
+            dest_dir (pathlib.Path): Directory receiving the members.
+        """
+        with ZipFile(zip_path) as dicom_zip:
+            for info in members:
+                dicom_zip.extract(info, dest_dir)
+
+    def shutdown(self):
+        """
+        Stop the extraction threads.
+        """
+        self._executor.shutdown(wait=False)
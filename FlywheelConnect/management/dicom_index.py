@@ -0,0 +1,220 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+log = logging.getLogger(__name__)
+
+# Types of the loadable attributes that can be indexed
+_SERIALIZABLE = (str, int, float, bool, type(None))
+
+
+def _serializable(value):
+    """
+    Args:
+        value (object): Attribute value of a DICOM loadable.
+
+    Returns:
+        bool: Whether the value can be stored as JSON and restored unchanged.
+    """
+    if isinstance(value, (list, tuple)):
+        return all(isinstance(item, _SERIALIZABLE) for item in value)
+    return isinstance(value, _SERIALIZABLE)
+
+
+def serialize_loadables(loadables_by_plugin, plugin_names):
+    """
+    Convert the selected loadables of DICOMLib.getLoadablesFromFileLists to JSON.
+
+    Args:
+        loadables_by_plugin (dict): Plugin instance -> list of DICOMLoadables.
+        plugin_names (dict): Plugin class -> name in slicer.modules.dicomPlugins.
+
+    Returns:
+        dict: Plugin name -> list of loadable attribute dicts, or None if an
+            attribute cannot be stored, since the loadable could not be rebuilt.
+    """
+    serialized = {}
+    for plugin, loadables in loadables_by_plugin.items():
+        name = plugin_names.get(type(plugin))
+        if name is None:
+            continue
+        selected = []
+        for loadable in loadables:
+            if not loadable.selected:
+                continue
+            attributes = vars(loadable)
+            for attr, value in attributes.items():
+                if not _serializable(value):
+                    log.info(
+                        "Not indexing %s loadable %s: %s is a %s",
+                        name,
+                        getattr(loadable, "name", ""),
+                        attr,
+                        type(value).__name__,
+                    )
+                    return None
+            selected.append(dict(attributes))
+        if selected:
+            serialized[name] = selected
+    return serialized
+
+
+def deserialize_loadables(serialized, plugin_classes, loadable_class):
+    """
+    Rebuild the argument of DICOMLib.loadLoadables from serialize_loadables output.
+
+    Args:
+        serialized (dict): Plugin name -> list of loadable attribute dicts.
+        plugin_classes (dict): slicer.modules.dicomPlugins.
+        loadable_class (type): DICOMLib.DICOMLoadable.
+
+    Returns:
+        dict: Plugin instance -> list of DICOMLoadables, or None if a plugin is no
+            longer available.
+    """
+    loadables_by_plugin = {}
+    for name, loadable_dicts in serialized.items():
+        plugin_class = plugin_classes.get(name)
+        if plugin_class is None:
+            return None
+        loadables = []
+        for attributes in loadable_dicts:
+            loadable = loadable_class()
+            for attr, value in attributes.items():
+                setattr(loadable, attr, value)
+            loadables.append(loadable)
+        loadables_by_plugin[plugin_class()] = loadables
+    return loadables_by_plugin
+
+
+class DicomIndexEntry:
+    """
+    Series and loadables of an imported DICOM archive.
+    """
+
+    __slots__ = ("series_uids", "loadables")
+
+    def __init__(self, series_uids, loadables):
+        """
+        Args:
+            series_uids (list): SeriesInstanceUIDs imported from the archive.
+            loadables (dict): Output of serialize_loadables.
+        """
+        self.series_uids = series_uids
+        self.loadables = loadables
+
+    @property
+    def files(self):
+        """
+        list: Files referenced by the loadables.
+        """
+        return [
+            file_path
+            for loadable_dicts in self.loadables.values()
+            for attributes in loadable_dicts
+            for file_path in attributes.get("files", [])
+        ]
+
+    def files_exist(self):
+        """
+        Returns:
+            bool: True if every file of the loadables is still on disk.
+        """
+        return all(os.path.exists(file_path) for file_path in self.files)
+
+
+class DicomIndex:
+    """
+    Persistent map of Flywheel DICOM archives to their imported series.
+
+    Keyed by Flywheel file id and version, each entry lists the SeriesInstanceUIDs
+    imported into the Slicer DICOM database and the selected loadables found by
+    the DICOM plugins, so re-opening an archive can skip importing and loadable
+    discovery and go straight to loading. Stored in
+    cache_dir/.metadata/dicom_index.sqlite.
+    """
+
+    def __init__(self, cache_dir):
+        """
+        Open the index.
+
+        Args:
+            cache_dir (str): Root of the Flywheel disk cache.
+        """
+        self._lock = threading.Lock()
+        db_dir = Path(cache_dir) / ".metadata"
+        db_dir.mkdir(parents=True, exist_ok=True)
+        self._db = sqlite3.connect(
+            str(db_dir / "dicom_index.sqlite"), check_same_thread=False
+        )
+        with self._db:
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS archives ("
+                "file_id TEXT, version INTEGER, series TEXT, loadables TEXT, "
+                "indexed_at REAL, PRIMARY KEY (file_id, version))"
+            )
+
+    def get(self, file_id, version):
+        """
+        Args:
+            file_id (str): Flywheel id of the archive.
+            version (int): Flywheel version of the archive.
+
+        Returns:
+            DicomIndexEntry: Indexed series and loadables, None if not indexed.
+        """
+        with self._lock:
+            row = self._db.execute(
+                "SELECT series, loadables FROM archives "
+                "WHERE file_id = ? AND version IS ?",
+                (file_id, version),
+            ).fetchone()
+        if row is None:
+            return None
+        return DicomIndexEntry(json.loads(row[0]), json.loads(row[1]))
+
+    def put(self, file_id, version, series_uids, loadables):
+        """
+        Record the series and loadables of an imported archive.
+
+        Entries of other versions of the archive are dropped.
+
+        Args:
+            file_id (str): Flywheel id of the archive.
+            version (int): Flywheel version of the archive.
+            series_uids (iterable): SeriesInstanceUIDs imported from the archive.
+            loadables (dict): Output of serialize_loadables.
+        """
+        with self._lock, self._db:
+            self._db.execute("DELETE FROM archives WHERE file_id = ?", (file_id,))
+            self._db.execute(
+                "INSERT INTO archives VALUES (?, ?, ?, ?, ?)",
+                (
+                    file_id,
+                    version,
+                    json.dumps(sorted(series_uids)),
+                    json.dumps(loadables),
+                    time.time(),
+                ),
+            )
+
+    def remove(self, file_id):
+        """
+        Forget all versions of an archive.
+
+        Args:
+            file_id (str): Flywheel id of the archive.
+        """
+        with self._lock, self._db:
+            self._db.execute("DELETE FROM archives WHERE file_id = ?", (file_id,))
+
+    def close(self):
+        """
+        Close the database.
+        """
+        with self._lock:
+            self._db.close()
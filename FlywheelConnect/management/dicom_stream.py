@@ -0,0 +1,337 @@
+import io
+import mmap
+import struct
+from zipfile import ZIP_STORED, ZipFile
+
+import numpy as np
+import pydicom
+from pydicom.errors import InvalidDicomError
+
+# Transfer syntaxes whose pixel data pydicom decodes without extra libraries
+STREAMABLE_SYNTAXES = (
+    "1.2.840.10008.1.2",  # Implicit VR Little Endian
+    "1.2.840.10008.1.2.1",  # Explicit VR Little Endian
+    "1.2.840.10008.1.2.1.99",  # Deflated Explicit VR Little Endian
+    "1.2.840.10008.1.2.2",  # Explicit VR Big Endian
+)
+
+# Fixed part of a zip local file header, up to the name and extra field lengths
+_LOCAL_HEADER = struct.Struct("<4s5H3I2H")
+# Relative tolerance on the spacing between slices of a series
+_SPACING_TOLERANCE = 0.01
+# LPS (DICOM) to RAS (Slicer) patient coordinates
+_LPS_TO_RAS = np.diag([-1.0, -1.0, 1.0, 1.0])
+
+
+class StreamingUnsupported(Exception):
+    """
+    The archive holds data that can only be loaded through the DICOM database.
+    """
+
+
+class _MemberView(io.RawIOBase):
+    """
+    Read-only file over a memory-mapped stored zip member.
+
+    pydicom reads the member through this view, so parsing headers touches only
+    the pages holding them and nothing is copied to disk.
+    """
+
+    def __init__(self, view):
+        """
+        Args:
+            view (memoryview): Bytes of the member.
+        """
+        super().__init__()
+        self._view = view
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, buffer):
+        size = min(len(buffer), len(self._view) - self._pos)
+        if size <= 0:
+            return 0
+        buffer[:size] = self._view[self._pos : self._pos + size]
+        self._pos += size
+        return size
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._pos
+        elif whence == io.SEEK_END:
+            offset += len(self._view)
+        self._pos = max(0, offset)
+        return self._pos
+
+    def tell(self):
+        return self._pos
+
+    def close(self):
+        # Release the view so the archive can be unmapped
+        self._view.release()
+        super().close()
+
+
+class DicomSeries:
+    """
+    Single-frame slices of a series, sorted along the slice normal.
+    """
+
+    __slots__ = ("uid", "name", "members", "headers", "ijk_to_ras")
+
+    def __init__(self, uid, name, members, headers, ijk_to_ras):
+        """
+        Args:
+            uid (str): SeriesInstanceUID.
+            name (str): Volume name, "<SeriesNumber>: <SeriesDescription>".
+            members (list): ZipInfo of the slices, in slice order.
+            headers (list): pydicom Datasets of the slices, without pixel data.
+            ijk_to_ras (numpy.ndarray): 4x4 IJK to RAS matrix of the volume.
+        """
+        self.uid = uid
+        self.name = name
+        self.members = members
+        self.headers = headers
+        self.ijk_to_ras = ijk_to_ras
+
+
+class ZipDicomReader:
+    """
+    Read DICOM series straight out of a cached zip archive.
+
+    Stored members are parsed through a memory-mapped view of the archive and
+    compressed members through a zip stream, so nothing is extracted to disk.
+    Headers are read first to group slices by series; pixel data is decoded into
+    a numpy volume per series, ready for slicer.util.addVolumeFromArray.
+
+    Only regularly spaced, single-frame grayscale series with an uncompressed
+    transfer syntax are supported. StreamingUnsupported is raised for anything
+    else, e.g. JPEG compressed, multi-frame or non-image objects, so the caller
+    can fall back to extraction and the DICOM database.
+    """
+
+    def __init__(self, zip_path):
+        """
+        Open the archive.
+
+        Args:
+            zip_path (str or pathlib.Path): Cached DICOM archive.
+        """
+        self._file = open(zip_path, "rb")
+        try:
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            self._zip = ZipFile(self._file)
+        except Exception:
+            self._file.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _open_member(self, info):
+        """
+        Args:
+            info (zipfile.ZipInfo): Member of the archive.
+
+        Returns:
+            file: Seekable read-only file over the member.
+        """
+        if info.compress_type != ZIP_STORED:
+            return self._zip.open(info)
+        header = _LOCAL_HEADER.unpack_from(self._map, info.header_offset)
+        name_length, extra_length = header[-2:]
+        start = info.header_offset + _LOCAL_HEADER.size + name_length + extra_length
+        return _MemberView(memoryview(self._map)[start : start + info.file_size])
+
+    def _read_header(self, info):
+        """
+        Args:
+            info (zipfile.ZipInfo): Member of the archive.
+
+        Returns:
+            pydicom.Dataset: Header of the member, None if it is not DICOM.
+        """
+        with self._open_member(info) as member:
+            try:
+                return pydicom.dcmread(member, stop_before_pixels=True)
+            except InvalidDicomError:
+                return None
+
+    def read_series(self):
+        """
+        Group the slices of the archive by series.
+
+        Returns:
+            list: DicomSeries of the archive.
+
+        Raises:
+            StreamingUnsupported: The archive holds objects that cannot be streamed.
+        """
+        by_uid = {}
+        for info in self._zip.infolist():
+            if info.is_dir() or info.filename.upper().endswith("DICOMDIR"):
+                continue
+            header = self._read_header(info)
+            if header is None:
+                continue
+            _check_streamable(header, info.filename)
+            by_uid.setdefault(header.SeriesInstanceUID, []).append((info, header))
+        if not by_uid:
+            raise StreamingUnsupported("No DICOM images in the archive")
+        return [_sorted_series(uid, slices) for uid, slices in by_uid.items()]
+
+    def read_volume(self, series):
+        """
+        Decode the pixel data of a series.
+
+        Args:
+            series (DicomSeries): Series of the archive.
+
+        Returns:
+            numpy.ndarray: Volume in KJI order, rescaled to modality values.
+
+        Raises:
+            StreamingUnsupported: pydicom cannot decode the pixel data.
+        """
+        slopes = [float(getattr(h, "RescaleSlope", 1) or 1) for h in series.headers]
+        intercepts = [float(getattr(h, "RescaleIntercept", 0)) for h in series.headers]
+        rescaled = any(
+            slope != 1 or not intercept.is_integer()
+            for slope, intercept in zip(slopes, intercepts)
+        )
+        first = series.headers[0]
+        volume = np.empty(
+            (len(series.members), int(first.Rows), int(first.Columns)),
+            dtype=np.float32 if rescaled else np.int32,
+        )
+        for k, info in enumerate(series.members):
+            with self._open_member(info) as member:
+                try:
+                    pixels = pydicom.dcmread(member).pixel_array
+                except (
+                    AttributeError,
+                    NotImplementedError,
+                    RuntimeError,
+                    ValueError,
+                ) as exc:
+                    raise StreamingUnsupported(f"{info.filename}: {exc}") from exc
+            volume[k] = pixels * slopes[k] + intercepts[k]
+        if not rescaled:
+            limits = np.iinfo(np.int16)
+            if volume.min() >= limits.min and volume.max() <= limits.max:
+                volume = volume.astype(np.int16)
+        return volume
+
+    def close(self):
+        """
+        Close the archive.
+        """
+        self._zip.close()
+        self._map.close()
+        self._file.close()
+
+
+def _check_streamable(header, file_name):
+    """
+    Args:
+        header (pydicom.Dataset): Header of a member.
+        file_name (str): Name of the member in the archive.
+
+    Raises:
+        StreamingUnsupported: The member cannot be loaded as a volume slice.
+    """
+    syntax = getattr(getattr(header, "file_meta", None), "TransferSyntaxUID", None)
+    if syntax not in STREAMABLE_SYNTAXES:
+        raise StreamingUnsupported(f"{file_name}: transfer syntax {syntax}")
+    for keyword in (
+        "SeriesInstanceUID",
+        "Rows",
+        "ImagePositionPatient",
+        "ImageOrientationPatient",
+        "PixelSpacing",
+    ):
+        if keyword not in header:
+            raise StreamingUnsupported(f"{file_name}: no {keyword}")
+    if int(getattr(header, "NumberOfFrames", 1) or 1) > 1:
+        raise StreamingUnsupported(f"{file_name}: multi-frame image")
+    if int(getattr(header, "SamplesPerPixel", 1)) != 1:
+        raise StreamingUnsupported(f"{file_name}: color image")
+
+
+def _sorted_series(uid, slices):
+    """
+    Sort the slices of a series and compute its geometry.
+
+    Args:
+        uid (str): SeriesInstanceUID.
+        slices (list): (ZipInfo, header) pairs of the series.
+
+    Returns:
+        DicomSeries: The series.
+
+    Raises:
+        StreamingUnsupported: The slices do not form a regular volume.
+    """
+    first = slices[0][1]
+    orientation = np.array(first.ImageOrientationPatient, dtype=float)
+    shape = (first.Rows, first.Columns)
+    for _, header in slices:
+        if (header.Rows, header.Columns) != shape or not np.allclose(
+            np.array(header.ImageOrientationPatient, dtype=float),
+            orientation,
+            atol=1e-4,
+        ):
+            raise StreamingUnsupported(f"Series {uid}: slices differ in geometry")
+
+    row, column = orientation[:3], orientation[3:]
+    normal = np.cross(row, column)
+    positions = [
+        float(np.dot(np.array(h.ImagePositionPatient, dtype=float), normal))
+        for _, h in slices
+    ]
+    order = np.argsort(positions)
+    slices = [slices[i] for i in order]
+    spacings = np.diff(np.sort(positions))
+    if len(spacings) and (
+        spacings.min() <= 0
+        or spacings.max() - spacings.min() > _SPACING_TOLERANCE * spacings.mean()
+    ):
+        raise StreamingUnsupported(f"Series {uid}: irregular slice spacing")
+
+    origin = np.array(slices[0][1].ImagePositionPatient, dtype=float)
+    if len(slices) > 1:
+        last = np.array(slices[-1][1].ImagePositionPatient, dtype=float)
+        slice_step = (last - origin) / (len(slices) - 1)
+    else:
+        slice_step = normal * float(getattr(first, "SliceThickness", 1) or 1)
+    # PixelSpacing is (between rows, between columns)
+    row_spacing, column_spacing = (float(value) for value in first.PixelSpacing)
+    ijk_to_lps = np.eye(4)
+    ijk_to_lps[:3, 0] = row * column_spacing
+    ijk_to_lps[:3, 1] = column * row_spacing
+    ijk_to_lps[:3, 2] = slice_step
+    ijk_to_lps[:3, 3] = origin
+
+    name = ": ".join(
+        str(value)
+        for value in (
+            getattr(first, "SeriesNumber", None),
+            getattr(first, "SeriesDescription", None),
+        )
+        if value not in (None, "")
+    )
+    return DicomSeries(
+        uid,
+        name or uid,
+        [info for info, _ in slices],
+        [header for _, header in slices],
+        _LPS_TO_RAS @ ijk_to_lps,
+    )
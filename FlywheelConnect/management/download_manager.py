@@ -0,0 +1,640 @@
+import glob
+import hashlib
+import logging
+import os
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from .instrumentation import span
+
+log = logging.getLogger(__name__)
+
+# Bytes read or written per chunk when transferring and hashing files
+CHUNK_SIZE = 2 ** 20
+
+
+class DownloadError(Exception):
+    """
+    A downloaded file does not match the size or hash reported by Flywheel.
+    """
+
+
+class DownloadCancelled(Exception):
+    """
+    A throttled download was cancelled. Its partial file is kept for resuming.
+    """
+
+
+class Throttle:
+    """
+    Limit the rate of a download, pause it or cancel it from another thread.
+    """
+
+    def __init__(self, rate=None, paused=None):
+        """
+        Args:
+            rate (float, optional): Bytes per second, None for no limit.
+            paused (callable, optional): The download waits while this returns True.
+        """
+        self.rate = rate
+        self.paused = paused
+        self.cancelled = False
+        self._last = time.monotonic()
+
+    def consume(self, size):
+        """
+        Account for a received chunk, sleeping to keep within the rate.
+
+        Called by the downloading thread.
+
+        Args:
+            size (int): Bytes received.
+
+        Raises:
+            DownloadCancelled: The download was cancelled.
+        """
+        while not self.cancelled and self.paused and self.paused():
+            time.sleep(0.2)
+            self._last = time.monotonic()
+        if self.cancelled:
+            raise DownloadCancelled()
+        if self.rate:
+            wait = size / self.rate - (time.monotonic() - self._last)
+            if wait > 0:
+                time.sleep(wait)
+        self._last = time.monotonic()
+
+    def release(self):
+        """
+        Let the download run at full speed, e.g. once a user is waiting for it.
+        """
+        self.rate = None
+        self.paused = None
+
+    def cancel(self):
+        """
+        Stop the download at its next chunk.
+        """
+        self.cancelled = True
+
+
+class DownloadJob:
+    """
+    Everything a worker thread needs to download a single Flywheel file.
+
+    Jobs are built on the main thread so that workers never touch Qt tree items.
+    """
+
+    __slots__ = (
+        "file_id",
+        "file_name",
+        "file_type",
+        "size",
+        "parent_id",
+        "dest_path",
+        "hash",
+        "version",
+        "modified",
+        "parent_type",
+    )
+
+    def __init__(
+        self,
+        file_id,
+        file_name,
+        file_type,
+        size,
+        parent_id,
+        dest_path,
+        hash=None,
+        version=None,
+        modified=None,
+        parent_type=None,
+    ):
+        """
+        Initialize a download job.
+
+        Args:
+            file_id (str): Flywheel id of the file.
+            file_name (str): Name of the file in its parent container.
+            file_type (str): Flywheel file type (e.g. "dicom", "nifti").
+            size (int): Size of the file in bytes, or 0 if unknown.
+            parent_id (str): Flywheel id of the container hosting the file.
+            dest_path (pathlib.Path): Path of the file in the cache.
+            hash (str, optional): Flywheel hash of the file (e.g. "v0-sha384-...").
+            version (int, optional): Flywheel version of the file.
+            modified (str, optional): Flywheel "modified" timestamp of the file.
+            parent_type (str, optional): Type of the container hosting the file.
+        """
+        self.file_id = file_id
+        self.file_name = file_name
+        self.file_type = file_type
+        self.size = size or 0
+        self.parent_id = parent_id
+        self.dest_path = dest_path
+        self.hash = hash
+        self.version = version
+        self.modified = modified
+        self.parent_type = parent_type
+
+    @property
+    def id(self):
+        """
+        str: Flywheel id of the file.
+        """
+        return self.file_id
+
+    @property
+    def part_path(self):
+        """
+        pathlib.Path: Hidden file receiving the download until it is verified.
+
+        The version is part of the name so a new version never resumes the
+        partial download of an older one.
+        """
+        return self.dest_path.with_name(
+            f".{self.dest_path.name}.{self.version or 0}.part"
+        )
+
+
+class DownloadBatch:
+    """
+    Aggregate progress of a set of files requested together.
+    """
+
+    def __init__(self, on_file_cached=None, on_progress=None, on_finished=None):
+        """
+        Initialize an empty batch.
+
+        Args:
+            on_file_cached (callable, optional): Called with (file_item, file_path,
+                file_type) as each file lands in the cache.
+            on_progress (callable, optional): Called with (files_done, files_total,
+                bytes_done, bytes_total) after each file.
+            on_finished (callable, optional): Called with the batch when every file
+                has completed or failed, or once the batch was cancelled.
+        """
+        self.on_file_cached = on_file_cached
+        self.on_progress = on_progress
+        self.on_finished = on_finished
+        self.files_total = 0
+        self.files_done = 0
+        self.bytes_total = 0
+        self.bytes_done = 0
+        self.results = {}
+        self.errors = {}
+        self.cancelled = False
+
+    @property
+    def finished(self):
+        """
+        bool: True when every file in the batch completed or failed.
+        """
+        return self.files_done >= self.files_total
+
+
+class DownloadManager:
+    """
+    Download Flywheel files to the cache on a pool of worker threads.
+
+    Completion is reported on the Qt main thread through a MainThreadQueue so file
+    items can update their icon and tooltip as each file finishes.
+
+    Files are downloaded to a hidden ".part" file next to their cache path, checked
+    against the size and hash reported by Flywheel and renamed into place, so an
+    interrupted download is never mistaken for a cached file. Interrupted downloads
+    resume where they stopped with an HTTP Range request.
+
+    Speculative downloads (see prefetch) run on their own thread, are throttled and
+    pause while files requested by the user are downloading.
+    """
+
+    def __init__(self, main_queue, max_workers=4):
+        """
+        Initialize the download manager.
+
+        Args:
+            main_queue (MainThreadQueue): Queue delivering results to the main thread.
+            max_workers (int): Number of concurrent downloads.
+        """
+        self.main_queue = main_queue
+        self.fw_client = None
+        self.cache_manifest = None
+        self.transport = None
+        self._max_workers = max_workers
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="fw-download"
+        )
+        self._prefetch_executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="fw-prefetch"
+        )
+        self._inflight = {}
+        self._prefetches = {}
+        self._batches = []
+        self._session = None
+
+    @property
+    def max_workers(self):
+        """
+        int: Number of concurrent downloads.
+        """
+        return self._max_workers
+
+    @max_workers.setter
+    def max_workers(self, value):
+        if value == self._max_workers:
+            return
+        # Running downloads finish on the old pool, new ones go to the new pool.
+        self._executor.shutdown(wait=False)
+        self._max_workers = value
+        self._executor = ThreadPoolExecutor(
+            max_workers=value, thread_name_prefix="fw-download"
+        )
+
+    def download(
+        self, file_items, on_file_cached=None, on_progress=None, on_finished=None
+    ):
+        """
+        Queue file items for download and return immediately.
+
+        Files that are already cached are reported without being downloaded.
+
+        Args:
+            file_items (list): FileItems to bring into the cache.
+            on_file_cached (callable, optional): See DownloadBatch.
+            on_progress (callable, optional): See DownloadBatch.
+            on_finished (callable, optional): See DownloadBatch.
+
+        Returns:
+            DownloadBatch: Progress of the requested files.
+        """
+        batch = DownloadBatch(on_file_cached, on_progress, on_finished)
+        self._batches.append(batch)
+        self.main_queue.acquire()
+        for file_item in file_items:
+            job = file_item._download_job()
+            batch.files_total += 1
+            batch.bytes_total += job.size
+            if self.is_cached(job):
+                self.main_queue.post(self._file_done, batch, file_item, job, None)
+                continue
+
+            # Files already in flight for another batch share its download.
+            future = self._inflight.get(job.file_id)
+            if job.file_id in self._prefetches:
+                # Someone is waiting for this speculative download now.
+                prefetch, throttle = self._prefetches.pop(job.file_id)
+                if prefetch.cancel():
+                    # It was queued behind a prefetch that pauses while this batch
+                    # is open; download it with the user's downloads instead.
+                    future = None
+                else:
+                    throttle.release()
+            if future is None:
+                future = self._executor.submit(self._fetch, job)
+                self._inflight[job.file_id] = future
+            self.main_queue.acquire()
+            future.add_done_callback(
+                lambda fut, item=file_item, job=job: self.main_queue.post(
+                    self._future_done, batch, item, job, fut
+                )
+            )
+        # Release the hold taken for this batch once everything queued so far ran.
+        self.main_queue.post(self.main_queue.release)
+        if batch.files_total == 0:
+            self.main_queue.post(self._finish, batch)
+        return batch
+
+    def prefetch(self, jobs, rate=None, on_file_cached=None):
+        """
+        Download files speculatively, one at a time, replacing earlier prefetches.
+
+        Prefetches pause while files requested with download() are in flight and
+        are limited to rate bytes per second until a download() requests them.
+
+        Args:
+            jobs (list): DownloadJobs, most wanted first.
+            rate (float, optional): Bytes per second, None for no limit.
+            on_file_cached (callable, optional): Called with the DownloadJob of each
+                prefetched file.
+        """
+        self.cancel_prefetch()
+        for job in jobs:
+            if job.file_id in self._inflight or self.is_cached(job):
+                continue
+            throttle = Throttle(rate, paused=lambda: bool(self._batches))
+            future = self._prefetch_executor.submit(self._fetch, job, throttle)
+            self._inflight[job.file_id] = future
+            self._prefetches[job.file_id] = (future, throttle)
+            self.main_queue.acquire()
+            future.add_done_callback(
+                lambda fut, job=job: self.main_queue.post(
+                    self._prefetch_done, job, fut, on_file_cached
+                )
+            )
+
+    def _prefetch_done(self, job, future, on_file_cached):
+        """
+        Report a finished speculative download.
+
+        Args:
+            job (DownloadJob): Download job of the file.
+            future (concurrent.futures.Future): Finished download.
+            on_file_cached (callable): Called with the job if the file was cached.
+        """
+        self.main_queue.release()
+        if self._inflight.get(job.file_id) is future:
+            del self._inflight[job.file_id]
+        if self._prefetches.get(job.file_id, (None,))[0] is future:
+            del self._prefetches[job.file_id]
+        if future.cancelled():
+            return
+        if future.exception() is not None:
+            log.debug("Prefetch of %s stopped: %s", job.file_name, future.exception())
+            return
+        if on_file_cached:
+            on_file_cached(job)
+
+    def cancel_prefetch(self):
+        """
+        Cancel speculative downloads. Partial files are kept and resumed later.
+        """
+        for file_id, (future, throttle) in self._prefetches.items():
+            future.cancel()
+            throttle.cancel()
+            if self._inflight.get(file_id) is future:
+                del self._inflight[file_id]
+        self._prefetches = {}
+
+    def reserve(self, jobs):
+        """
+        Mark files as in flight for a transfer made outside the manager, e.g. a
+        bulk download, so download() and prefetch() wait for it instead of writing
+        the same ".part" file.
+
+        Must be called from the main thread. The transfer resolves each returned
+        future with the cache path of its file or with an exception, then hands it
+        to unreserve().
+
+        Args:
+            jobs (list): DownloadJobs of the files.
+
+        Returns:
+            dict: File id -> running Future, for the files not in flight already.
+        """
+        reserved = {}
+        for job in jobs:
+            if job.file_id in self._inflight:
+                continue
+            future = Future()
+            # A running future cannot be cancelled by cancel_all.
+            future.set_running_or_notify_cancel()
+            self._inflight[job.file_id] = future
+            reserved[job.file_id] = future
+        return reserved
+
+    def unreserve(self, file_id, future):
+        """
+        Forget a file reserved with reserve(). Must be called from the main thread.
+
+        Args:
+            file_id (str): Flywheel id of the file.
+            future (concurrent.futures.Future): Future returned by reserve().
+        """
+        if self._inflight.get(file_id) is future:
+            del self._inflight[file_id]
+
+    def is_cached(self, job):
+        """
+        Check whether a file can be served from the cache.
+
+        Args:
+            job (DownloadJob): Download job of the file.
+
+        Returns:
+            bool: True if the file is on disk.
+        """
+        if self.cache_manifest is not None:
+            return self.cache_manifest.verify(job)
+        return job.dest_path.exists()
+
+    def _fetch(self, job, throttle=None):
+        """
+        Download a single file to its cache path. Runs on a worker thread.
+
+        Args:
+            job (DownloadJob): File to download.
+            throttle (Throttle, optional): Limits the transfer.
+
+        Returns:
+            pathlib.Path: Path to the downloaded file.
+        """
+        os.makedirs(job.dest_path.parent, exist_ok=True)
+        part_path = job.part_path
+        name = glob.escape(job.dest_path.name)
+        for stale_part in job.dest_path.parent.glob(f".{name}.*.part"):
+            if stale_part != part_path:
+                stale_part.unlink()
+        with span("download.transfer", bytes=job.size, file=job.file_name):
+            self._transfer(job, part_path, throttle)
+        try:
+            with span("download.verify", bytes=job.size, file=job.file_name):
+                self.verify(job, part_path)
+        except DownloadError:
+            part_path.unlink()
+            raise
+        os.replace(part_path, job.dest_path)
+        if self.cache_manifest is not None:
+            self.cache_manifest.add(
+                job.file_id,
+                job.dest_path,
+                job.version,
+                job.modified,
+                parent_id=job.parent_id,
+                parent_type=job.parent_type,
+            )
+        return job.dest_path
+
+    def _transfer(self, job, part_path, throttle=None):
+        """
+        Download a file to its ".part" file, resuming a previous partial download.
+
+        Falls back to a plain SDK download if no download URL can be obtained.
+
+        Args:
+            job (DownloadJob): File to download.
+            part_path (pathlib.Path): File receiving the download.
+            throttle (Throttle, optional): Limits the transfer.
+        """
+        try:
+            url = self.fw_client.get_container_download_url(
+                job.parent_id, job.file_name
+            )
+        except Exception as exc:
+            log.debug("No download URL for %s, not resumable: %s", job.file_name, exc)
+            # The cache policy may have pruned the directory if it was empty.
+            part_path.parent.mkdir(parents=True, exist_ok=True)
+            self.fw_client.download_file_from_container(
+                job.parent_id, job.file_name, str(part_path)
+            )
+            return
+
+        offset = part_path.stat().st_size if part_path.exists() else 0
+        if job.size and offset == job.size:
+            return
+        if job.size and offset > job.size:
+            offset = 0
+        headers = {"Range": f"bytes={offset}-"} if offset else {}
+        with self.get_session().get(
+            url, headers=headers, stream=True, timeout=60
+        ) as response:
+            if response.status_code == 416:
+                # The partial file does not fit the remote file; start over.
+                part_path.unlink()
+                return self._transfer(job, part_path, throttle)
+            response.raise_for_status()
+            resumed = offset and response.status_code == 206
+            if offset and not resumed:
+                log.info("Server ignored Range for %s, restarting.", job.file_name)
+            part_path.parent.mkdir(parents=True, exist_ok=True)
+            with open(part_path, "ab" if resumed else "wb") as part_file:
+                for chunk in response.iter_content(CHUNK_SIZE):
+                    part_file.write(chunk)
+                    if throttle:
+                        throttle.consume(len(chunk))
+
+    def get_session(self):
+        """
+        Returns:
+            requests.Session: Session shared by the download threads, the pooled
+                session of the FlywheelTransport if there is one.
+        """
+        if self.transport is not None:
+            return self.transport.session
+        if self._session is None:
+            import requests
+
+            self._session = requests.Session()
+        return self._session
+
+    @staticmethod
+    def verify(job, part_path):
+        """
+        Check a downloaded file against the size and hash reported by Flywheel.
+
+        Args:
+            job (DownloadJob): Downloaded file.
+            part_path (pathlib.Path): Downloaded data.
+
+        Raises:
+            DownloadError: If the size or hash do not match.
+        """
+        size = part_path.stat().st_size
+        if job.size and size != job.size:
+            raise DownloadError(
+                f"{job.file_name}: expected {job.size} bytes, received {size}."
+            )
+        # Flywheel hashes look like "v0-sha384-<hex digest>"
+        parts = (job.hash or "").split("-")
+        if len(parts) != 3 or parts[0] != "v0":
+            return
+        try:
+            digest = hashlib.new(parts[1])
+        except ValueError:
+            return
+        with open(part_path, "rb") as part_file:
+            for chunk in iter(lambda: part_file.read(CHUNK_SIZE), b""):
+                digest.update(chunk)
+        if digest.hexdigest() != parts[2]:
+            raise DownloadError(f"{job.file_name}: hash does not match Flywheel.")
+
+    def _future_done(self, batch, file_item, job, future):
+        """
+        Route a finished download future to the batch that requested it.
+
+        Args:
+            batch (DownloadBatch): Batch requesting the file.
+            file_item (FileItem): Tree item of the file.
+            job (DownloadJob): Download job of the file.
+            future (concurrent.futures.Future): Finished download.
+        """
+        self.main_queue.release()
+        if self._inflight.get(job.file_id) is future:
+            del self._inflight[job.file_id]
+        if future.cancelled():
+            self._file_done(batch, file_item, job, "Download cancelled.")
+        elif future.exception() is not None:
+            self._file_done(batch, file_item, job, future.exception())
+        else:
+            self._file_done(batch, file_item, job, None)
+
+    def _file_done(self, batch, file_item, job, error):
+        """
+        Update the tree item and batch progress after a file finished.
+
+        Args:
+            batch (DownloadBatch): Batch requesting the file.
+            file_item (FileItem): Tree item of the file.
+            job (DownloadJob): Download job of the file.
+            error (Exception or str): Error raised by the download, if any.
+        """
+        if batch.cancelled:
+            return
+        batch.files_done += 1
+        batch.bytes_done += job.size
+        if error is not None:
+            log.error("Failed to download %s: %s", job.file_name, error)
+            batch.errors[job.file_id] = error
+        else:
+            if self.cache_manifest is not None:
+                self.cache_manifest.touch(job.file_id)
+            file_item._mark_cached()
+            batch.results[job.file_id] = (job.dest_path, job.file_type)
+            if batch.on_file_cached:
+                batch.on_file_cached(file_item, job.dest_path, job.file_type)
+        if batch.on_progress:
+            batch.on_progress(
+                batch.files_done, batch.files_total, batch.bytes_done, batch.bytes_total
+            )
+        if batch.finished:
+            self._finish(batch)
+
+    def _finish(self, batch):
+        """
+        Report a finished batch and stop tracking it.
+
+        Args:
+            batch (DownloadBatch): Finished batch.
+        """
+        if batch in self._batches:
+            self._batches.remove(batch)
+        if batch.on_finished and not batch.cancelled:
+            batch.on_finished(batch)
+
+    def cancel_all(self):
+        """
+        Cancel pending downloads and stop reporting on running ones.
+
+        Used when the tree is repopulated and its file items are discarded. Files
+        already being transferred still land in the cache. Each open batch is
+        finished with its `cancelled` flag set, so its caller can release what it
+        holds for the batch and report it.
+        """
+        self.cancel_prefetch()
+        batches, self._batches = self._batches, []
+        for batch in batches:
+            batch.cancelled = True
+        for future in list(self._inflight.values()):
+            future.cancel()
+        self._inflight.clear()
+        for batch in batches:
+            if batch.on_finished:
+                batch.on_finished(batch)
+
+    def shutdown(self):
+        """
+        Cancel all downloads and stop the worker threads.
+        """
+        self.cancel_all()
+        self._executor.shutdown(wait=False)
+        self._prefetch_executor.shutdown(wait=False)
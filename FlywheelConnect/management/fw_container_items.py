@@ -1,283 +1,303 @@
 import os
 from pathlib import Path
 
-from PythonQt import QtGui
-from PythonQt.QtCore import Qt
-from qt import QAbstractItemView
-
-
-class FolderItem(QtGui.QStandardItem):
-    """
-    Folder Items are for the convenience of collapsing long lists into a tree node.
+from .download_manager import DownloadJob
+from .node_table import (
+    ANALYSES_LISTED,
+    ANALYSES_REQUESTED,
+    CACHED,
+    CHILDREN,
+    FILES,
+    KIND_FOLDERS,
+    LISTED,
+    ROOT_REF,
+    SLOTS,
+)
+
+
+def container_cache_dir(file_parent):
     """
+    Construct cache directory of the files of a container (e.g. cache_root/group/...).
 
-    def __init__(self, parent_item, folder_name):
-        """
-        Initialize Folder Items unpopulated.
-
-        Args:
-            parent_item (ContainerItem): Container Item parent for Folder Item.
-            folder_name (str): A name for the folder item (e.g. SESSIONS).
-        """
-        super(FolderItem, self).__init__()
-        self.source_dir = parent_item.source_dir
-        icon_path = "Resources/Icons/folder.png"
-        icon = QtGui.QIcon(str(self.source_dir / icon_path))
-        self.parent_item = parent_item
-        self.parent_container = parent_item.container
-        self.folderItem = QtGui.QStandardItem()
-        self.setText(folder_name)
-        self.setIcon(icon)
-        parent_item.appendRow(self)
+    Args:
+        file_parent (ContainerRecord): Record of the container hosting the files.
 
-
-class AnalysisFolderItem(FolderItem):
-    """
-    Folder Item specifically for analyses.
+    Returns:
+        pathlib.Path: Cache directory of the container.
     """
+    file_path = Path(os.path.expanduser("~") + "/flywheelIO/")
 
-    def __init__(self, parent_item):
-        """
-        Initialize AnalysisFolderItem unpopulated.
+    for par in ["group", "project", "subject", "session", "acquisition"]:
+        if file_parent.parents.get(par):
+            file_path /= file_parent.parents[par]
+    file_path /= file_parent.id
+    return file_path
 
-        Args:
-            parent_item (ContainerItem): Container that hosts analyses
-                (projects, subjects, sessions, acquisitions)
-        """
-        folder_name = "ANALYSES"
-        super(AnalysisFolderItem, self).__init__(parent_item, folder_name)
-        # TODO: put folder w/ download icon
-        icon_path = "Resources/Icons/dwnld-folder.png"
-        icon = QtGui.QIcon(str(self.source_dir / icon_path))
-        self.setIcon(icon)
-        # TODO: ensure that these work.
-        self.setToolTip("Double-Click to list Analyses.")
 
-    def _dblclicked(self):
-        if hasattr(self.parent_container, "analyses"):
-            self.parent_container = self.parent_container.reload()
-            icon_path = "Resources/Icons/folder.png"
-            icon = QtGui.QIcon(str(self.source_dir / icon_path))
-            self.setIcon(icon)
-            if not self.hasChildren() and self.parent_container.analyses:
-
-                for analysis in self.parent_container.analyses:
-                    AnalysisItem(self, analysis)
+def download_job(file_parent, file_record):
+    """
+    Describe the download of a file for a worker thread.
 
+    Args:
+        file_parent (ContainerRecord): Record of the container hosting the file.
+        file_record (FileRecord): Record of the file.
 
-class ContainerItem(QtGui.QStandardItem):
+    Returns:
+        DownloadJob: File id, name, type, size, parent and cache path.
     """
-    TreeView node to host all common functionality for Flywheel containers.
+    return DownloadJob(
+        file_record.id,
+        file_record.name,
+        file_record.type,
+        file_record.size,
+        file_parent.id,
+        container_cache_dir(file_parent) / file_record.id / file_record.name,
+        hash=file_record.hash,
+        version=file_record.version,
+        modified=file_record.modified,
+        parent_type=file_parent.container_type,
+    )
+
+
+class TreeItem:
     """
+    Handle on a row of the FlywheelTreeModel.
 
-    def __init__(self, parent_item, container):
+    Items are created on demand from a model index and only hold the model and the
+    reference of the row, so they are cheap to create and to throw away. The tree
+    itself is stored in the NodeTable of the model.
+    """
+
+    __slots__ = ("model", "ref", "generation")
+
+    def __init__(self, model, ref):
         """
-        Initialize new container item with its parent and flywheel container object.
+        Initialize a handle on a tree row.
 
         Args:
-            parent_item (QtGui.QStandardItem): Parent of this item to instantiate.
-            container (flywheel.Container): Flywheel container (e.g. group, project,...)
+            model (FlywheelTreeModel): Model hosting the row.
+            ref (int): Reference of the row in the model.
         """
-        super(ContainerItem, self).__init__()
-        self.has_analyses = False
-        self.parent_item = parent_item
-        self.container = container
-        self.source_dir = Path(os.path.realpath(__file__)).parents[1]
-        title = container.label
-        self.setData(container.id)
-        self.setText(title)
-        self._set_icon()
-        self.parent_item.appendRow(self)
-        self._files_folder()
-        self._analyses_folder()
-        self._child_container_folder()
+        self.model = model
+        self.ref = ref
+        self.generation = model.generation
 
-    def _set_icon(self):
+    @property
+    def node(self):
         """
-        Set the icon for the container item.
+        int: Node of the row, or of the container owning a folder row.
         """
-        icon = QtGui.QIcon(str(self.source_dir / self.icon_path))
-        self.setIcon(icon)
+        return self.ref // SLOTS
 
-    def _files_folder(self):
+    @property
+    def valid(self):
         """
-        Create a "FILES" folder if self.container has one.
+        bool: False once the tree was cleared after this item was created.
         """
-        if hasattr(self.container, "files"):
-            self.filesItem = FolderItem(self, "FILES")
+        return self.generation == self.model.generation
 
-    def _list_files(self):
-        """
-        List all file items of a container object under the "FILES" folder.
-        TODO: Make this a part of a filesFolderItem???
-        """
-        if hasattr(self.container, "files"):
-            if not self.filesItem.hasChildren() and self.container.files:
-                for fl in self.container.files:
-                    FileItem(self.filesItem, fl)
+    def __eq__(self, other):
+        return (
+            isinstance(other, TreeItem)
+            and self.model is other.model
+            and self.ref == other.ref
+            and self.generation == other.generation
+        )
+
+    def __hash__(self):
+        return hash((self.ref, self.generation))
 
-    def _analyses_folder(self):
+    def index(self):
         """
-        Create "ANALYSES" folder, if container has analyses object.
+        Returns:
+            QtCore.QModelIndex: Index of the row in the model.
         """
-        if hasattr(self.container, "analyses"):
-            self.analysesItem = AnalysisFolderItem(self)
+        return self.model.index_for_ref(self.ref)
 
-    def _child_container_folder(self):
+    def text(self):
         """
-        Create a folder with the name of the child containers (e.g. SESSIONS)
+        Returns:
+            str: Text displayed for the row.
         """
-        if hasattr(self, "child_container_name"):
-            self.folderItem = FolderItem(self, self.child_container_name)
+        return self.model.display_text(self.ref)
 
-    def _on_expand(self):
+    def parent(self):
         """
-        On expansion of container tree node, list all files.
+        Returns:
+            TreeItem: Item of the parent row, None for top-level rows.
         """
-        # super(ContainerItem, self)._on_expand()
-        self._list_files()
+        parent_ref = self.model.parent_ref(self.ref)
+        if parent_ref == ROOT_REF:
+            return None
+        return self.model.item_for_ref(parent_ref)
 
 
-class GroupItem(ContainerItem):
+class LoadingItem(TreeItem):
     """
-    TreeView Node for the functionality of group containers.
+    Placeholder row shown in a folder while its children are fetched.
     """
 
-    def __init__(self, parent_item, group):
-        """
-        Initialize Group Item with parent and group container.
+    __slots__ = ()
 
-        Args:
-            parent_item (QtGui.QStandardItemModel): Top-level tree item or model.
-            group (flywheel.Group): Flywheel group container to attach as tree node.
-        """
-        self.icon_path = "Resources/Icons/group.png"
-        self.child_container_name = "PROJECTS"
-        self.group = group
-        super(GroupItem, self).__init__(parent_item, group)
 
-    def _list_projects(self):
+class FolderItem(TreeItem):
+    """
+    Folder Items are for the convenience of collapsing long lists into a tree node.
+
+    Folders are not stored in the node table, they are derived from their container.
+    """
+
+    __slots__ = ()
+    icon_path = "Resources/Icons/folder.png"
+
+    @property
+    def parent_item(self):
         """
-        Populate with flywheel projects.
+        ContainerItem: Container Item parent of the Folder Item.
         """
-        if not self.folderItem.hasChildren():
-            for project in self.group.projects():
-                ProjectItem(self.folderItem, project)
+        return self.parent()
 
-    def _on_expand(self):
+    @property
+    def parent_container(self):
         """
-        On expansion of group tree node, list all projects.
+        ContainerRecord: Record of the container hosting the folder.
         """
-        super(GroupItem, self)._on_expand()
-        self._list_projects()
+        return self.model.table.records[self.node]
 
 
-class ProjectItem(ContainerItem):
+class AnalysisFolderItem(FolderItem):
     """
-    TreeView Node for the functionality of Project containers.
+    Folder Item specifically for analyses.
     """
 
-    def __init__(self, parent_item, project):
-        """
-        Initialize Project Item with parent and project container.
+    __slots__ = ()
+    # TODO: put folder w/ download icon
+    requested_icon_path = FolderItem.icon_path
+    icon_path = "Resources/Icons/dwnld-folder.png"
+    # TODO: ensure that these work.
+    tool_tip = "Double-Click to list Analyses."
 
-        Args:
-            parent_item (FolderItem): The folder item tree node that is the parent.
-            project (flywheel.Project): Flywheel project container to attach as tree
-                node.
-        """
-        self.icon_path = "Resources/Icons/project.png"
-        self.child_container_name = "SUBJECTS"
-        super(ProjectItem, self).__init__(parent_item, project)
-        self.has_analyses = True
-        self.project = self.container
+    @property
+    def _listed(self):
+        return self.model.has_flag(self.node, ANALYSES_LISTED)
 
-    def _list_subjects(self):
+    @_listed.setter
+    def _listed(self, listed):
+        self.model.set_flag(self.node, ANALYSES_LISTED, listed)
+
+    def _dblclicked(self):
         """
-        Populate with flywheel subjects.
+        Swap the download icon for a folder icon when analyses are requested.
         """
-        if not self.folderItem.hasChildren():
-            for subject in self.project.subjects():
-                SubjectItem(self.folderItem, subject)
+        self.model.set_flag(self.node, ANALYSES_REQUESTED, True)
+        self.model.row_changed(self.ref)
 
-    def _on_expand(self):
+    def _listings(self):
         """
-        On expansion of project tree node, list all subjects.
+        Listings shown when analyses are requested.
+
+        Returns:
+            list: (folder reference, parent record, kind) tuples.
         """
-        super(ProjectItem, self)._on_expand()
-        self._list_subjects()
+        return [(self.ref, self.parent_container, "analyses")]
 
 
-class SubjectItem(ContainerItem):
+class ContainerItem(TreeItem):
     """
-    TreeView Node for the functionality of Subject containers.
+    TreeView node to host all common functionality for Flywheel containers.
     """
 
-    def __init__(self, parent_item, subject):
-        """
-        Initialize Subject Item with parent and project container.
+    __slots__ = ()
 
-        Args:
-            parent_item (FolderItem): The folder item tree node that is the parent.
-            subject (flywheel.Subject): Flywheel subject container to attach as tree
-                node.
+    @property
+    def container(self):
         """
-        self.icon_path = "Resources/Icons/subject.png"
-        self.child_container_name = "SESSIONS"
-        super(SubjectItem, self).__init__(parent_item, subject)
-        self.has_analyses = True
-        self.subject = self.container
+        ContainerRecord: Record of a Flywheel container (e.g. group, project,...)
+        """
+        return self.model.table.records[self.node]
 
-    def _list_sessions(self):
+    @property
+    def parent_item(self):
         """
-        Populate with flywheel sessions.
+        FolderItem: Folder listing this item, None for top-level items.
         """
-        if not self.folderItem.hasChildren():
-            for session in self.subject.sessions():
-                SessionItem(self.folderItem, session)
+        return self.parent()
+
+    @property
+    def _listed(self):
+        return self.model.has_flag(self.node, LISTED)
+
+    @_listed.setter
+    def _listed(self, listed):
+        self.model.set_flag(self.node, LISTED, listed)
 
-    def _on_expand(self):
+    def data(self):
         """
-        On expansion of subject tree node, list all sessions.
+        Returns:
+            str: Flywheel id of the container.
         """
-        super(SubjectItem, self)._on_expand()
-        self._list_sessions()
+        return self.model.table.ids[self.node]
 
+    def _listings(self):
+        """
+        Listings shown in the "FILES" and child container folders on expansion.
 
-class SessionItem(ContainerItem):
+        Returns:
+            list: (folder reference, parent record, kind) tuples.
+        """
+        listings = []
+        folders = KIND_FOLDERS[self.model.table.kinds[self.node]]
+        if FILES in folders and self.container.files:
+            listings.append((self.node * SLOTS + FILES, self.container, "files"))
+        if CHILDREN in folders:
+            listings.append(
+                (
+                    self.node * SLOTS + CHILDREN,
+                    self.container,
+                    self.container.child_kind,
+                )
+            )
+        return listings
+
+
+class GroupItem(ContainerItem):
     """
-    TreeView Node for the functionality of Session containers.
+    TreeView Node for the functionality of group containers.
     """
 
-    def __init__(self, parent_item, session):
-        """
-        Initialize Session Item with parent and subject container.
+    __slots__ = ()
+    icon_path = "Resources/Icons/group.png"
+    child_container_name = "PROJECTS"
 
-        Args:
-            parent_item (FolderItem): The folder item tree node that is the parent.
-            session (flywheel.Session): Flywheel session container to attach as tree
-                node.
-        """
-        self.icon_path = "Resources/Icons/session.png"
-        self.child_container_name = "ACQUISITIONS"
-        super(SessionItem, self).__init__(parent_item, session)
-        self.has_analyses = True
-        self.session = self.container
 
-    def _list_acquisitions(self):
-        """
-        Populate with flywheel acquisitions.
-        """
-        if not self.folderItem.hasChildren():
-            for acquisition in self.session.acquisitions():
-                AcquisitionItem(self.folderItem, acquisition)
+class ProjectItem(ContainerItem):
+    """
+    TreeView Node for the functionality of Project containers.
+    """
 
-    def _on_expand(self):
-        """
-        On expansion of session tree node, list all acquisitions.
-        """
-        super(SessionItem, self)._on_expand()
-        self._list_acquisitions()
+    __slots__ = ()
+    icon_path = "Resources/Icons/project.png"
+    child_container_name = "SUBJECTS"
+
+
+class SubjectItem(ContainerItem):
+    """
+    TreeView Node for the functionality of Subject containers.
+    """
+
+    __slots__ = ()
+    icon_path = "Resources/Icons/subject.png"
+    child_container_name = "SESSIONS"
+
+
+class SessionItem(ContainerItem):
+    """
+    TreeView Node for the functionality of Session containers.
+    """
+
+    __slots__ = ()
+    icon_path = "Resources/Icons/session.png"
+    child_container_name = "ACQUISITIONS"
 
 
 class AcquisitionItem(ContainerItem):
@@ -285,19 +305,8 @@ class AcquisitionItem(ContainerItem):
     TreeView Node for the functionality of Acquisition containers.
     """
 
-    def __init__(self, parent_item, acquisition):
-        """
-        Initialize Acquisition Item with parent and Acquisition container.
-
-        Args:
-            parent_item (FolderItem): The folder item tree node that is the parent.
-            acquisition (flywheel.Acquisition): Flywheel acquisitin container to attach
-                as tree node.
-        """
-        self.icon_path = "Resources/Icons/acquisition.png"
-        super(AcquisitionItem, self).__init__(parent_item, acquisition)
-        self.has_analyses = True
-        self.acquisition = self.container
+    __slots__ = ()
+    icon_path = "Resources/Icons/acquisition.png"
 
 
 class AnalysisItem(ContainerItem):
@@ -305,17 +314,8 @@ class AnalysisItem(ContainerItem):
     TreeView Node for the functionality of Analysis objects.
     """
 
-    def __init__(self, parent_item, analysis):
-        """
-        Initialize Subject Item with parent and analysis object.
-
-        Args:
-            parent_item (FolderItem): The folder item tree node that is the parent.
-            analysis (flywheel.Analysis): Flywheel analysis object to attach as tree
-                node.
-        """
-        self.icon_path = "Resources/Icons/analysis.png"
-        super(AnalysisItem, self).__init__(parent_item, analysis)
+    __slots__ = ()
+    icon_path = "Resources/Icons/analysis.png"
 
 
 class FileItem(ContainerItem):
@@ -323,29 +323,30 @@ class FileItem(ContainerItem):
     TreeView Node for the functionality of File objects.
     """
 
-    def __init__(self, parent_item, file_obj):
+    __slots__ = ()
+    icon_path = "Resources/Icons/file.png"
+    cached_icon_path = "Resources/Icons/file_cached.png"
+
+    @property
+    def file(self):
         """
-        Initialize File Item with parent and file object.
+        FileRecord: File record of the tree node.
+        """
+        return self.container
 
-        Args:
-            parent_item (FolderItem): The folder item tree node that is the parent.
-            file_obj (flywheel.FileEntry): File object of the tree node.
-        """
-        file_obj.label = file_obj.name
-        self.parent_item = parent_item
-        self.container = file_obj
-        
-        self.file = file_obj
-        self.file_type = file_obj.type
-        if self._is_cached():
-            self.icon_path = "Resources/Icons/file_cached.png"
-        else:
-            self.icon_path = "Resources/Icons/file.png"
-        super(FileItem, self).__init__(parent_item, file_obj)
-        if self._is_cached():
-            self.setToolTip("File is cached.")
-        else:
-            self.setToolTip("File is not cached")
+    @property
+    def file_type(self):
+        """
+        str: Flywheel type of the file (e.g. "dicom").
+        """
+        return self.container.type
+
+    @property
+    def parent_container(self):
+        """
+        ContainerRecord: Record of the container hosting the file.
+        """
+        return self.model.table.records[self.model.parent_ref(self.ref) // SLOTS]
 
     def _get_cache_path(self):
         """
@@ -354,13 +355,7 @@ class FileItem(ContainerItem):
         Returns:
             pathlib.Path: Cache Path to file indicated.
         """
-        file_parent = self.parent_item.parent().container
-        file_path = Path(os.path.expanduser("~") + "/flywheelIO/")
-
-        for par in ["group", "project", "subject", "session", "acquisition"]:
-            if file_parent.parents[par]:
-                file_path /= file_parent.parents[par]
-        file_path /= file_parent.id
+        file_path = container_cache_dir(self.parent_container)
         file_path /= self.container.id
         file_path /= self.container.name
         return file_path
@@ -372,22 +367,37 @@ class FileItem(ContainerItem):
         Returns:
             bool: If file is cached locally on disk.
         """
+        cache_manifest = self.model.cache_manifest
+        if cache_manifest is not None:
+            return cache_manifest.is_current(self.container)
         return self._get_cache_path().exists()
 
-    def _add_to_cache(self):
+    def _download_job(self):
         """
-        Add file to cache directory under path.
+        Describe the download of this file for a worker thread.
 
         Returns:
-            pathlib.Path, str: Path to file in cache and flywheel file_type
-        """
-        file_path = self._get_cache_path()
-        file_parent = self.parent_item.parent().container
-        if not file_path.exists():
-            if not file_path.parents[0].exists():
-                os.makedirs(file_path.parents[0])
-            file_parent.download_file(self.file.name, str(file_path))
-            self.icon_path = "Resources/Icons/file_cached.png"
-            self.setToolTip("File is cached.")
-            self._set_icon()
-        return file_path, self.file_type
+            DownloadJob: File id, name, type, size, parent and cache path.
+        """
+        return download_job(self.parent_container, self.file)
+
+    def _mark_cached(self):
+        """
+        Update icon and tooltip after the file has landed in the cache.
+        """
+        if self.valid:
+            self.model.set_flag(self.node, CACHED, True)
+            self.model.row_changed(self.ref)
+
+
+# Item classes of the node kinds of node_table
+KIND_ITEMS = (
+    None,
+    GroupItem,
+    ProjectItem,
+    SubjectItem,
+    SessionItem,
+    AcquisitionItem,
+    AnalysisItem,
+    FileItem,
+)
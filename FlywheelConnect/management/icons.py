@@ -0,0 +1,57 @@
+"""
+Registry of the tree icons.
+
+Resource paths are resolved once at import and each icon is decoded once per
+session, the first time a row needs it. All models and views share the same QIcons.
+"""
+import os
+from pathlib import Path
+
+# Root of the module resources (FlywheelConnect/)
+SOURCE_DIR = Path(os.path.realpath(__file__)).parents[1]
+
+_paths = {}
+_icons = {}
+
+
+def resource_path(relative_path):
+    """
+    Args:
+        relative_path (str): Path relative to the module directory
+            (e.g. "Resources/Icons/file.png").
+
+    Returns:
+        str: Absolute path of the resource.
+    """
+    path = _paths.get(relative_path)
+    if path is None:
+        path = _paths[relative_path] = str(SOURCE_DIR / relative_path)
+    return path
+
+
+def get_icon(relative_path):
+    """
+    Args:
+        relative_path (str): Path of the icon relative to the module directory.
+
+    Returns:
+        QtGui.QIcon: Shared icon loaded from disk on first use.
+    """
+    icon = _icons.get(relative_path)
+    if icon is None:
+        import qt
+
+        icon = _icons[relative_path] = qt.QIcon(resource_path(relative_path))
+    return icon
+
+
+def preload(relative_paths):
+    """
+    Decode icons ahead of time, e.g. before a large listing is shown.
+
+    Args:
+        relative_paths (iterable): Paths of the icons relative to the module
+            directory.
+    """
+    for relative_path in relative_paths:
+        get_icon(relative_path)
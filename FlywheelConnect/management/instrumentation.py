@@ -0,0 +1,210 @@
+import json
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+# Percentiles shown in the performance summary
+PERCENTILES = (50, 90, 99)
+
+
+class Span:
+    """
+    Timed operation, e.g. an API call or the download of a file.
+    """
+
+    __slots__ = ("name", "start", "duration", "thread_id", "args")
+
+    def __init__(self, name, start, duration, thread_id, args):
+        """
+        Args:
+            name (str): "<category>.<operation>", e.g. "api.get".
+            start (float): time.perf_counter() when the operation started.
+            duration (float): Seconds the operation took.
+            thread_id (int): Thread running the operation.
+            args (dict): Measures of the operation, e.g. "bytes" or "items".
+        """
+        self.name = name
+        self.start = start
+        self.duration = duration
+        self.thread_id = thread_id
+        self.args = args
+
+    @property
+    def category(self):
+        """
+        str: Part of the name before the first ".".
+        """
+        return self.name.split(".", 1)[0]
+
+
+def percentile(durations, percent):
+    """
+    Args:
+        durations (list): Sorted values.
+        percent (float): Percentile, 0 to 100.
+
+    Returns:
+        float: Nearest-rank percentile of the values.
+    """
+    rank = max(0, int(len(durations) * percent / 100.0 + 0.5) - 1)
+    return durations[min(rank, len(durations) - 1)]
+
+
+class SpanRecorder:
+    """
+    Record timed spans of the hot paths of the module.
+
+    Recording a span costs two clock reads and an append to a bounded deque, so
+    spans stay enabled in normal use. The latest `capacity` spans are kept. Spans
+    are recorded from any thread and summarized or exported from the main thread.
+    """
+
+    def __init__(self, capacity=20000):
+        """
+        Args:
+            capacity (int): Number of most recent spans kept.
+        """
+        self.enabled = True
+        self._spans = deque(maxlen=capacity)
+        self._lock = threading.Lock()
+        self._epoch = time.perf_counter()
+
+    @contextmanager
+    def span(self, name, **args):
+        """
+        Time the enclosed block.
+
+        The yielded dict can be updated inside the block, e.g. with the number of
+        bytes transferred. A block raising an exception is recorded with an
+        "error" argument.
+
+        Args:
+            name (str): "<category>.<operation>".
+            **args: Initial measures of the span.
+
+        Yields:
+            dict: Measures of the span.
+        """
+        if not self.enabled:
+            yield args
+            return
+        start = time.perf_counter()
+        try:
+            yield args
+        except BaseException as exc:
+            args["error"] = type(exc).__name__
+            raise
+        finally:
+            self.record(name, start, time.perf_counter() - start, **args)
+
+    def record(self, name, start, duration, **args):
+        """
+        Record a span timed by the caller, e.g. across callbacks.
+
+        Args:
+            name (str): "<category>.<operation>".
+            start (float): time.perf_counter() when the operation started.
+            duration (float): Seconds the operation took.
+            **args: Measures of the span.
+        """
+        if not self.enabled:
+            return
+        span = Span(name, start, duration, threading.get_ident(), args)
+        with self._lock:
+            self._spans.append(span)
+
+    def spans(self):
+        """
+        Returns:
+            list: Recorded Spans, oldest first.
+        """
+        with self._lock:
+            return list(self._spans)
+
+    def clear(self):
+        """
+        Forget all recorded spans.
+        """
+        with self._lock:
+            self._spans.clear()
+
+    def summary(self):
+        """
+        Aggregate the recorded spans by name.
+
+        Returns:
+            list: (name, count, {percent: seconds}, longest seconds, total bytes,
+                total items) of each span name, sorted by name.
+        """
+        by_name = {}
+        for span in self.spans():
+            by_name.setdefault(span.name, []).append(span)
+        rows = []
+        for name, spans in sorted(by_name.items()):
+            durations = sorted(span.duration for span in spans)
+            rows.append(
+                (
+                    name,
+                    len(spans),
+                    {p: percentile(durations, p) for p in PERCENTILES},
+                    durations[-1],
+                    sum(span.args.get("bytes") or 0 for span in spans),
+                    sum(span.args.get("items") or 0 for span in spans),
+                )
+            )
+        return rows
+
+    def chrome_trace(self):
+        """
+        Returns:
+            dict: Recorded spans as complete events of the Chrome trace event
+                format, readable by chrome://tracing and Perfetto.
+        """
+        pid = os.getpid()
+        events = [
+            {
+                "name": span.name,
+                "cat": span.category,
+                "ph": "X",
+                "ts": (span.start - self._epoch) * 1e6,
+                "dur": span.duration * 1e6,
+                "pid": pid,
+                "tid": span.thread_id,
+                "args": {
+                    key: value if isinstance(value, (int, float, str)) else str(value)
+                    for key, value in span.args.items()
+                },
+            }
+            for span in self.spans()
+        ]
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def export_chrome_trace(self, path):
+        """
+        Write the recorded spans as a Chrome trace JSON file.
+
+        Args:
+            path (str): Path of the trace file.
+        """
+        with open(path, "w") as trace_file:
+            json.dump(self.chrome_trace(), trace_file)
+
+
+# Recorder shared by all modules
+recorder = SpanRecorder()
+
+
+def span(name, **args):
+    """
+    Time the enclosed block with the shared recorder. See SpanRecorder.span.
+
+    Args:
+        name (str): "<category>.<operation>".
+        **args: Initial measures of the span.
+
+    Returns:
+        contextmanager: Yields the dict of measures of the span.
+    """
+    return recorder.span(name, **args)
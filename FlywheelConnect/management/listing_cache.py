@@ -0,0 +1,511 @@
+import json
+import logging
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+from .records import PARENT_TYPES, ROOT, ContainerRecord
+
+log = logging.getLogger(__name__)
+
+# Container listings under a project, fetched in bulk by fetch_descendants
+DESCENDANT_KINDS = ("subjects", "sessions", "acquisitions")
+
+
+class Listing:
+    """
+    Cached children of a container.
+    """
+
+    __slots__ = ("records", "parent_modified", "fetched_at", "complete", "pages")
+
+    def __init__(self, records, parent_modified, fetched_at, complete=True, pages=1):
+        """
+        Args:
+            records (list): ContainerRecords of the children.
+            parent_modified (str): "modified" timestamp of the parent when fetched.
+            fetched_at (float): Epoch time of the fetch.
+            complete (bool): False if more pages of children can be fetched.
+            pages (int): Number of pages stored on disk.
+        """
+        self.records = records
+        self.parent_modified = parent_modified
+        self.fetched_at = fetched_at
+        self.complete = complete
+        self.pages = pages
+
+
+class ListingCache:
+    """
+    Memory and disk cache of Flywheel container listings.
+
+    Children of groups, projects, subjects, sessions and acquisitions are kept in
+    memory and in a SQLite database under the cache directory, one per account so
+    that a user never sees the containers listed for another. A listing is fresh
+    while it is younger than the TTL and its parent's "modified" timestamp matches the
+    one it was fetched with. Stale listings are still served so the tree renders
+    instantly; callers revalidate them in the background with refresh().
+
+    Large listings are fetched in pages ordered by container id. Only the pages that
+    were requested are cached, so memory stays proportional to what was viewed.
+    """
+
+    def __init__(self, fw_client, cache_dir, ttl=900, account=None):
+        """
+        Initialize the cache and open its database.
+
+        Args:
+            fw_client (flywheel.Client): Client used to fetch listings.
+            cache_dir (str): Root of the Flywheel disk cache.
+            ttl (int): Seconds a listing is considered fresh.
+            account (str, optional): Hex digest identifying the site and user whose
+                listings are cached.
+        """
+        self.fw_client = fw_client
+        self.ttl = ttl
+        # Called with the records of each page fetched from Flywheel, on the
+        # fetching thread, e.g. to keep a SearchIndex up to date.
+        self.on_stored = None
+        self._listings = {}
+        self._records = {}
+        self._lock = threading.Lock()
+        db_dir = Path(cache_dir) / ".metadata"
+        db_dir.mkdir(parents=True, exist_ok=True)
+        db_name = f"listings-{account[:16]}.sqlite" if account else "listings.sqlite"
+        self._db = sqlite3.connect(str(db_dir / db_name), check_same_thread=False)
+        with self._db:
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS listings ("
+                "key TEXT PRIMARY KEY, parent_modified TEXT, fetched_at REAL, "
+                "complete INTEGER, pages INTEGER)"
+            )
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS listing_pages ("
+                "key TEXT, page INTEGER, payload TEXT, PRIMARY KEY (key, page))"
+            )
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS containers ("
+                "id TEXT PRIMARY KEY, fetched_at REAL, payload TEXT)"
+            )
+
+    @staticmethod
+    def _key(parent, kind):
+        """
+        Args:
+            parent (ContainerRecord): Parent of the listing.
+            kind (str): Kind of children (e.g. "subjects").
+
+        Returns:
+            str: Key of the listing in memory and on disk.
+        """
+        return f"{parent.id}/{kind}"
+
+    def _load(self, key):
+        """
+        Read a listing from disk into memory.
+
+        Args:
+            key (str): Key of the listing.
+
+        Returns:
+            Listing: The listing or None if it was never cached.
+        """
+        with self._lock:
+            row = self._db.execute(
+                "SELECT parent_modified, fetched_at, complete, pages FROM listings "
+                "WHERE key = ?",
+                (key,),
+            ).fetchone()
+            pages = self._db.execute(
+                "SELECT payload FROM listing_pages WHERE key = ? ORDER BY page",
+                (key,),
+            ).fetchall()
+        if row is None:
+            return None
+        records = [
+            ContainerRecord.from_dict(values)
+            for (payload,) in pages
+            for values in json.loads(payload)
+        ]
+        listing = Listing(records, row[0], row[1], bool(row[2]), row[3])
+        self._remember(key, listing)
+        return listing
+
+    def _remember(self, key, listing):
+        """
+        Keep a listing and its records in memory.
+
+        Args:
+            key (str): Key of the listing.
+            listing (Listing): Listing to keep.
+        """
+        with self._lock:
+            self._listings[key] = listing
+            for record in listing.records:
+                self._records[record.id] = record
+
+    def _store(self, key, listing, page_records):
+        """
+        Keep a listing in memory and write its newest page through to disk.
+
+        Args:
+            key (str): Key of the listing.
+            listing (Listing): Listing to store.
+            page_records (list): Records of the newest page. If it is the first page,
+                previously stored pages are dropped.
+        """
+        self._remember(key, listing)
+        payload = json.dumps([record.to_dict() for record in page_records])
+        with self._lock, self._db:
+            if listing.pages == 1:
+                self._db.execute("DELETE FROM listing_pages WHERE key = ?", (key,))
+            self._db.execute(
+                "INSERT OR REPLACE INTO listings VALUES (?, ?, ?, ?, ?)",
+                (
+                    key,
+                    listing.parent_modified,
+                    listing.fetched_at,
+                    int(listing.complete),
+                    listing.pages,
+                ),
+            )
+            self._db.execute(
+                "INSERT OR REPLACE INTO listing_pages VALUES (?, ?, ?)",
+                (key, listing.pages - 1, payload),
+            )
+            self._db.executemany(
+                "INSERT OR REPLACE INTO containers VALUES (?, ?, ?)",
+                [
+                    (record.id, listing.fetched_at, json.dumps(record.to_dict()))
+                    for record in page_records
+                ],
+            )
+        if self.on_stored:
+            self.on_stored(page_records)
+
+    def is_fresh(self, parent, listing):
+        """
+        Check whether a listing can be served without revalidation.
+
+        Args:
+            parent (ContainerRecord): Parent of the listing.
+            listing (Listing): Cached listing.
+
+        Returns:
+            bool: True if the listing is within the TTL and the parent is unchanged.
+        """
+        if time.time() - listing.fetched_at > self.ttl:
+            return False
+        return parent.modified is None or parent.modified == listing.parent_modified
+
+    def peek(self, parent, kind):
+        """
+        Return a cached listing without contacting Flywheel.
+
+        Args:
+            parent (ContainerRecord): Parent of the listing.
+            kind (str): Kind of children (e.g. "subjects", "files").
+
+        Returns:
+            list, bool, bool: Cached records (None if not cached), their freshness and
+                whether the listing is complete.
+        """
+        if kind == "files":
+            return parent.files or [], True, True
+        key = self._key(parent, kind)
+        listing = self._listings.get(key) or self._load(key)
+        if listing is None:
+            return None, False, False
+        return listing.records, self.is_fresh(parent, listing), listing.complete
+
+    def children(self, parent, kind):
+        """
+        Return all children of a container, fetching them if not fresh in cache.
+
+        Blocks on the network if the listing is stale. Call from a worker thread.
+
+        Args:
+            parent (ContainerRecord): Parent of the listing.
+            kind (str): Kind of children (e.g. "subjects").
+
+        Returns:
+            list: ContainerRecords of the children.
+        """
+        records, fresh, complete = self.peek(parent, kind)
+        if records is not None and fresh and complete:
+            return records
+        return self.refresh(parent, kind)[0]
+
+    def refresh(self, parent, kind, limit=None):
+        """
+        Fetch a listing, or its first page, from Flywheel and replace the cached one.
+
+        Blocks on the network. Call from a worker thread.
+
+        Args:
+            parent (ContainerRecord): Parent of the listing.
+            kind (str): Kind of children (e.g. "subjects").
+            limit (int, optional): Page size. If None, all children are fetched.
+
+        Returns:
+            list, bool, bool: Fresh records, whether they differ from the cached ones
+                and whether the listing is complete.
+        """
+        key = self._key(parent, kind)
+        previous = self._listings.get(key)
+        records = [
+            ContainerRecord.from_container(c)
+            for c in self._fetch(parent, kind, limit=limit)
+        ]
+        complete = limit is None or len(records) < limit
+        listing = Listing(records, parent.modified, time.time(), complete)
+        self._store(key, listing, records)
+        changed = previous is None or [
+            (r.id, r.label, r.modified) for r in previous.records[: len(records)]
+        ] != [(r.id, r.label, r.modified) for r in records]
+        return records, changed, complete
+
+    def fetch_page(self, parent, kind, after_id, limit):
+        """
+        Fetch the page of children following a container id.
+
+        The page is appended to the cached listing if it continues it.
+
+        Blocks on the network. Call from a worker thread.
+
+        Args:
+            parent (ContainerRecord): Parent of the listing.
+            kind (str): Kind of children (e.g. "subjects").
+            after_id (str): Id of the last child already listed.
+            limit (int): Page size.
+
+        Returns:
+            list, bool: Records of the page and whether the listing is complete.
+        """
+        key = self._key(parent, kind)
+        records = [
+            ContainerRecord.from_container(c)
+            for c in self._fetch(parent, kind, limit=limit, after_id=after_id)
+        ]
+        complete = len(records) < limit
+        listing = self._listings.get(key)
+        if listing and listing.records and listing.records[-1].id == after_id:
+            listing = Listing(
+                listing.records + records,
+                listing.parent_modified,
+                listing.fetched_at,
+                complete,
+                listing.pages + 1,
+            )
+            self._store(key, listing, records)
+        return records, complete
+
+    def _fetch(self, parent, kind, limit=None, after_id=None):
+        """
+        Query Flywheel for the children of a container.
+
+        Args:
+            parent (ContainerRecord): Parent of the listing.
+            kind (str): Kind of children (e.g. "subjects", "analyses").
+            limit (int, optional): Page size.
+            after_id (str, optional): Id of the last child of the previous page.
+
+        Returns:
+            list: Flywheel SDK containers.
+        """
+        if parent is ROOT or kind == "groups":
+            return self.fw_client.groups()
+        if kind == "analyses":
+            return self.fw_client.get(parent.id).analyses or []
+        finder = getattr(self.fw_client, kind)
+        kwargs = {}
+        if limit:
+            # Pages are keyed on container id, so they must be sorted by it.
+            kwargs.update(limit=limit, sort="_id:asc")
+        if after_id:
+            kwargs["after_id"] = after_id
+        return finder.find(f"parents.{parent.container_type}={parent.id}", **kwargs)
+
+    def get_record(self, container_id):
+        """
+        Return the record of a container, from cache if possible.
+
+        Args:
+            container_id (str): Flywheel id of the container.
+
+        Returns:
+            ContainerRecord: Record of the container.
+        """
+        record = self._records.get(container_id)
+        if record is not None:
+            return record
+        with self._lock:
+            row = self._db.execute(
+                "SELECT payload FROM containers WHERE id = ?", (container_id,)
+            ).fetchone()
+        if row is not None:
+            record = ContainerRecord.from_dict(json.loads(row[0]))
+            with self._lock:
+                self._records[container_id] = record
+        else:
+            record = self.fetch_record(container_id)
+        return record
+
+    def fetch_record(self, container_id):
+        """
+        Fetch the record of a container from Flywheel and cache it.
+
+        Blocks on the network. Call from a worker thread.
+
+        Args:
+            container_id (str): Flywheel id of the container.
+
+        Returns:
+            ContainerRecord: Record of the container.
+        """
+        record = ContainerRecord.from_container(self.fw_client.get(container_id))
+        with self._lock, self._db:
+            self._records[container_id] = record
+            self._db.execute(
+                "INSERT OR REPLACE INTO containers VALUES (?, ?, ?)",
+                (record.id, time.time(), json.dumps(record.to_dict())),
+            )
+        return record
+
+    def cached_descendants(self, project):
+        """
+        Return the containers under a project that are cached on disk.
+
+        Does not contact Flywheel.
+
+        Args:
+            project (ContainerRecord): Record of the project.
+
+        Returns:
+            list: ContainerRecords of cached subjects, sessions and acquisitions.
+        """
+        # Cheap text match on the payload, checked once parsed
+        pattern = f'%"project": {json.dumps(project.id)}%'
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT payload FROM containers WHERE payload LIKE ?", (pattern,)
+            ).fetchall()
+        records = []
+        for (payload,) in rows:
+            values = json.loads(payload)
+            if (values.get("parents") or {}).get("project") == project.id:
+                records.append(ContainerRecord.from_dict(values))
+        return records
+
+    def fetch_descendants(self, container):
+        """
+        Fetch all subjects, sessions and acquisitions under a project, subject or
+        session, with a single query per level, and cache their records.
+
+        Blocks on the network. Call from a worker thread.
+
+        Args:
+            container (ContainerRecord): Record of the project, subject or session.
+
+        Returns:
+            list: ContainerRecords of the containers under it.
+        """
+        records = []
+        if container.child_kind not in DESCENDANT_KINDS:
+            return records
+        first = DESCENDANT_KINDS.index(container.child_kind)
+        for kind in DESCENDANT_KINDS[first:]:
+            finder = getattr(self.fw_client, kind)
+            records.extend(
+                ContainerRecord.from_container(c)
+                for c in finder.find(
+                    f"parents.{container.container_type}={container.id}"
+                )
+            )
+        fetched_at = time.time()
+        with self._lock, self._db:
+            for record in records:
+                self._records[record.id] = record
+            self._db.executemany(
+                "INSERT OR REPLACE INTO containers VALUES (?, ?, ?)",
+                [
+                    (record.id, fetched_at, json.dumps(record.to_dict()))
+                    for record in records
+                ],
+            )
+        return records
+
+    def resolve(self, path):
+        """
+        Find a container and its ancestors from a path of labels or an id.
+
+        The container is found with a single lookup. Its ancestors are read from
+        the cache, only missing ones are fetched.
+
+        Blocks on the network. Call from a worker thread.
+
+        Args:
+            path (str): "group/project/subject/..." path or Flywheel id.
+
+        Returns:
+            list: ContainerRecords from the group down to the container.
+        """
+        path = path.strip().strip("/")
+        if "/" in path:
+            container = self.fw_client.lookup(path)
+        else:
+            container = self.fw_client.get(path)
+        record = ContainerRecord.from_container(container)
+        with self._lock, self._db:
+            self._records[record.id] = record
+            self._db.execute(
+                "INSERT OR REPLACE INTO containers VALUES (?, ?, ?)",
+                (record.id, time.time(), json.dumps(record.to_dict())),
+            )
+        records = []
+        for parent_type in PARENT_TYPES:
+            parent_id = record.parents.get(parent_type)
+            if not parent_id or parent_id == record.id:
+                continue
+            if parent_type == "group":
+                records.append(self._group_record(parent_id))
+            else:
+                records.append(self.get_record(parent_id))
+        return records + [record]
+
+    def _group_record(self, group_id):
+        """
+        Args:
+            group_id (str): Id of a group.
+
+        Returns:
+            ContainerRecord: Record of the group, from the cached group listing if
+                possible.
+        """
+        groups, _, _ = self.peek(ROOT, "groups")
+        for group in groups or []:
+            if group.id == group_id:
+                return group
+        return ContainerRecord.from_container(self.fw_client.get_group(group_id))
+
+    def invalidate(self, parent, kind):
+        """
+        Force the next lookup of a listing to go to Flywheel.
+
+        Args:
+            parent (ContainerRecord): Parent of the listing.
+            kind (str): Kind of children (e.g. "files", "analyses").
+        """
+        key = self._key(parent, kind)
+        with self._lock, self._db:
+            self._listings.pop(key, None)
+            self._db.execute("DELETE FROM listings WHERE key = ?", (key,))
+            self._db.execute("DELETE FROM listing_pages WHERE key = ?", (key,))
+
+    def close(self):
+        """
+        Close the database.
+        """
+        with self._lock:
+            self._db.close()
@@ -0,0 +1,205 @@
+import logging
+import time
+from collections import deque
+
+log = logging.getLogger(__name__)
+
+# Stages of a file, in order
+STAGES = ("download", "decode wait", "decode", "load wait", "load")
+
+
+class StageTimings:
+    """
+    Seconds spent by each file in each stage of a LoadPipeline.
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.finished = None
+        self.files = {}
+
+    def add(self, key, stage, seconds):
+        """
+        Args:
+            key (str): File.
+            stage (str): One of STAGES.
+            seconds (float): Time spent in the stage.
+        """
+        self.files.setdefault(key, {})[stage] = seconds
+
+    def totals(self):
+        """
+        Returns:
+            dict: Stage -> (total, longest) seconds over all files.
+        """
+        totals = {}
+        for stage in STAGES:
+            durations = [
+                stages[stage] for stages in self.files.values() if stage in stages
+            ]
+            totals[stage] = (sum(durations), max(durations, default=0.0))
+        return totals
+
+    def report(self):
+        """
+        Returns:
+            str: Wall time and per-stage total and longest time. Stages overlap, so
+                totals may add up to more than the wall time.
+        """
+        wall = (self.finished or time.perf_counter()) - self.started
+        stages = ", ".join(
+            f"{stage} {total:.2f} s (max {longest:.2f} s)"
+            for stage, (total, longest) in self.totals().items()
+        )
+        return f"Loaded {len(self.files)} files in {wall:.2f} s: {stages}"
+
+
+class _Decoded:
+    """
+    Loader returned by the decode stage, with its timestamps.
+    """
+
+    __slots__ = ("key", "load", "decoded_at")
+
+    def __init__(self, key, load, decoded_at):
+        self.key = key
+        self.load = load
+        self.decoded_at = decoded_at
+
+
+class LoadPipeline:
+    """
+    Open downloaded files in three overlapping stages.
+
+    1. download: the DownloadManager hands each file over as soon as it is cached.
+    2. decode: `decode(file_path, file_type)` runs on a worker pool, e.g. to
+       decompress or parse the file, and returns a callable creating its nodes.
+    3. load: that callable runs on the main thread through the MainThreadQueue.
+
+    Files waiting for a decoder are queued on the main thread. At most
+    max_in_flight files are decoding or decoded and waiting for the main thread,
+    which bounds the memory held by decoded data. Timings of each stage are
+    collected in a StageTimings.
+    """
+
+    def __init__(self, main_queue, executor, decode, max_in_flight=4, on_finished=None):
+        """
+        Start a pipeline. Files are timed from now.
+
+        Args:
+            main_queue (MainThreadQueue): Queue delivering results to the main thread.
+            executor (concurrent.futures.Executor): Pool running the decode stage.
+            decode (callable): Called on the pool with (file_path, file_type);
+                returns a callable loading the file on the main thread.
+            max_in_flight (int): Files decoding or waiting to be loaded at once.
+            on_finished (callable, optional): Called with the StageTimings once all
+                files are loaded and finish_submitting() was called.
+        """
+        self.main_queue = main_queue
+        self.executor = executor
+        self.decode = decode
+        self.max_in_flight = max_in_flight
+        self.on_finished = on_finished
+        self.timings = StageTimings()
+        self.errors = {}
+        self._waiting = deque()
+        self._in_flight = 0
+        self._submitting = True
+
+    def submit(self, key, file_path, file_type):
+        """
+        Queue a downloaded file for decoding. Must be called on the main thread.
+
+        Args:
+            key (str): Identifies the file in the timings, e.g. its Flywheel id.
+            file_path (str): Path to the cached file.
+            file_type (str): Flywheel file type.
+        """
+        now = time.perf_counter()
+        self.timings.add(key, "download", now - self.timings.started)
+        self._waiting.append((key, str(file_path), file_type, now))
+        self._dispatch()
+
+    def finish_submitting(self):
+        """
+        Declare that all files were submitted, e.g. when the downloads finished.
+        """
+        self._submitting = False
+        self._check_finished()
+
+    def _dispatch(self):
+        """
+        Start decoding queued files while under the in-flight limit.
+        """
+        while self._waiting and self._in_flight < self.max_in_flight:
+            key, file_path, file_type, queued_at = self._waiting.popleft()
+            self._in_flight += 1
+            self.timings.add(key, "decode wait", time.perf_counter() - queued_at)
+            self.main_queue.submit(
+                self.executor,
+                self._decode,
+                key,
+                file_path,
+                file_type,
+                callback=self._load,
+                errback=lambda exc, key=key: self._failed(key, exc),
+            )
+
+    def _decode(self, key, file_path, file_type):
+        """
+        Run the decode stage. Runs on the pool.
+
+        Returns:
+            _Decoded: Loader of the file.
+        """
+        started = time.perf_counter()
+        load = self.decode(file_path, file_type)
+        decoded_at = time.perf_counter()
+        self.timings.add(key, "decode", decoded_at - started)
+        return _Decoded(key, load, decoded_at)
+
+    def _load(self, decoded):
+        """
+        Run the load stage of a decoded file on the main thread.
+
+        Args:
+            decoded (_Decoded): Loader of the file.
+        """
+        started = time.perf_counter()
+        self.timings.add(decoded.key, "load wait", started - decoded.decoded_at)
+        try:
+            decoded.load()
+        except Exception as exc:
+            self.errors[decoded.key] = exc
+            log.error("Failed to load %s: %s", decoded.key, exc)
+        self.timings.add(decoded.key, "load", time.perf_counter() - started)
+        self._done()
+
+    def _failed(self, key, exc):
+        """
+        Record a file that could not be decoded.
+
+        Args:
+            key (str): File.
+            exc (Exception): Error raised by the decode stage.
+        """
+        self.errors[key] = exc
+        log.error("Failed to decode %s: %s", key, exc)
+        self._done()
+
+    def _done(self):
+        self._in_flight -= 1
+        self._dispatch()
+        self._check_finished()
+
+    def _check_finished(self):
+        """
+        Report the timings once every submitted file went through the pipeline.
+        """
+        if self._submitting or self._waiting or self._in_flight:
+            return
+        if self.timings.finished is None:
+            self.timings.finished = time.perf_counter()
+            log.info(self.timings.report())
+            if self.on_finished:
+                self.on_finished(self.timings)
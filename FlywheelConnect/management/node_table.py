@@ -0,0 +1,202 @@
+"""
+Compact, column-oriented storage of the Flywheel tree.
+
+Every container or file shown in the tree is a node: an integer index into parallel
+columns holding its id, label, kind, parent reference, row and flags. Folders
+("FILES", "ANALYSES", "SUBJECTS", ...) and "Loading..." placeholders are not stored;
+they are computed from their container node.
+
+Nodes, folders and placeholders are addressed by a single integer reference,
+``node * SLOTS + slot``, which is also the internal id of their QModelIndex.
+"""
+from array import array
+
+# Reference of the invisible root of the tree
+ROOT_REF = -1
+
+# Slots of a reference: the node itself, its virtual folders and their placeholders
+SLOTS = 8
+NODE = 0
+FILES = 1
+ANALYSES = 2
+CHILDREN = 3
+LOADING = 4
+FOLDER_SLOTS = (FILES, ANALYSES, CHILDREN)
+
+# Node kinds
+GROUP = 1
+PROJECT = 2
+SUBJECT = 3
+SESSION = 4
+ACQUISITION = 5
+ANALYSIS = 6
+FILE = 7
+
+CONTAINER_KINDS = {
+    "group": GROUP,
+    "project": PROJECT,
+    "subject": SUBJECT,
+    "session": SESSION,
+    "acquisition": ACQUISITION,
+    "analysis": ANALYSIS,
+}
+
+# Folder rows of each node kind, in display order
+KIND_FOLDERS = (
+    (),
+    (CHILDREN,),
+    (FILES, ANALYSES, CHILDREN),
+    (FILES, ANALYSES, CHILDREN),
+    (FILES, ANALYSES, CHILDREN),
+    (FILES, ANALYSES),
+    (FILES,),
+    (),
+)
+
+# Node flags
+LISTED = 1
+ANALYSES_LISTED = 2
+ANALYSES_REQUESTED = 4
+CACHED = 8
+
+
+def loading_flag(folder_slot):
+    """
+    Flag set on a node while one of its folders shows a "Loading..." row.
+
+    Args:
+        folder_slot (int): FILES, ANALYSES or CHILDREN.
+
+    Returns:
+        int: Flag bit of the folder's placeholder.
+    """
+    return 8 << folder_slot
+
+
+def kind_of(record):
+    """
+    Args:
+        record (ContainerRecord or FileRecord): Record of a node.
+
+    Returns:
+        int: Node kind of the record.
+    """
+    return CONTAINER_KINDS.get(getattr(record, "container_type", None), FILE)
+
+
+class NodeTable:
+    """
+    Parallel arrays of tree nodes and the child lists of their parents.
+    """
+
+    __slots__ = (
+        "ids",
+        "labels",
+        "kinds",
+        "parents",
+        "rows",
+        "flags",
+        "records",
+        "children",
+        "file_nodes",
+    )
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        """
+        Drop all nodes.
+        """
+        self.ids = []
+        self.labels = []
+        self.kinds = array("b")
+        self.parents = array("i")
+        self.rows = array("i")
+        self.flags = array("B")
+        # Records are shared with the listing cache, not copied.
+        self.records = []
+        # Child node lists of the root and of folder references
+        self.children = {}
+        # Node of each file id, to update files without scanning the table
+        self.file_nodes = {}
+
+    def __len__(self):
+        return len(self.ids)
+
+    def child_nodes(self, parent_ref):
+        """
+        Args:
+            parent_ref (int): ROOT_REF or a folder reference.
+
+        Returns:
+            array.array: Nodes listed under parent_ref.
+        """
+        return self.children.get(parent_ref, ())
+
+    def add(self, parent_ref, record):
+        """
+        Append a node under the root or a folder.
+
+        Args:
+            parent_ref (int): ROOT_REF or a folder reference.
+            record (ContainerRecord or FileRecord): Record of the node.
+
+        Returns:
+            int: The new node.
+        """
+        node = len(self.ids)
+        siblings = self.children.get(parent_ref)
+        if siblings is None:
+            siblings = self.children[parent_ref] = array("i")
+        kind = kind_of(record)
+        if kind == FILE:
+            self.file_nodes[record.id] = node
+        self.ids.append(record.id)
+        self.labels.append(record.label)
+        self.kinds.append(kind)
+        self.parents.append(parent_ref)
+        self.rows.append(len(siblings))
+        self.flags.append(0)
+        self.records.append(record)
+        siblings.append(node)
+        return node
+
+    def remove(self, parent_ref, row):
+        """
+        Remove a node and its descendants from the root or a folder.
+
+        Args:
+            parent_ref (int): ROOT_REF or a folder reference.
+            row (int): Row of the node under parent_ref.
+        """
+        siblings = self.children[parent_ref]
+        node = siblings.pop(row)
+        for later_row in range(row, len(siblings)):
+            self.rows[siblings[later_row]] = later_row
+        self._drop(node)
+
+    def remove_all(self, parent_ref):
+        """
+        Remove all nodes under the root or a folder.
+
+        Args:
+            parent_ref (int): ROOT_REF or a folder reference.
+        """
+        for node in self.children.pop(parent_ref, ()):
+            self._drop(node)
+
+    def _drop(self, node):
+        """
+        Release the child lists and record of a removed node.
+
+        Node indices are never reused; the table is compacted by clear().
+
+        Args:
+            node (int): Removed node.
+        """
+        self.records[node] = None
+        if self.file_nodes.get(self.ids[node]) == node:
+            del self.file_nodes[self.ids[node]]
+        for slot in FOLDER_SLOTS:
+            self.remove_all(node * SLOTS + slot)
@@ -0,0 +1,154 @@
+import logging
+
+from .cache_policy import GIGABYTE
+from .fw_container_items import download_job
+
+log = logging.getLogger(__name__)
+
+MEGABYTE = 2 ** 20
+
+# Flywheel file types worth prefetching, most likely to be opened first
+PREFETCH_RANKS = {"nifti": 0, "dicom": 0, "image": 1}
+
+
+class Prefetcher:
+    """
+    Speculatively download the files of the session or acquisition the user is on.
+
+    Opt-in. When a session or acquisition is expanded or selected, the primary
+    files of its acquisitions are queued on the low priority prefetch thread of the
+    DownloadManager, NIfTI and DICOM first, so "Load Selected Files" mostly hits a
+    warm cache. Prefetching is limited to `rate` bytes per second and `max_bytes`
+    per container, pauses while the user's own downloads run, and is cancelled
+    when the user moves to another container.
+    """
+
+    def __init__(
+        self,
+        download_manager,
+        main_queue,
+        executor,
+        rate=8 * MEGABYTE,
+        max_bytes=2 * GIGABYTE,
+        on_files_cached=None,
+    ):
+        """
+        Initialize a disabled prefetcher.
+
+        Args:
+            download_manager (DownloadManager): Downloads the files.
+            main_queue (MainThreadQueue): Queue delivering results to the main thread.
+            executor (concurrent.futures.Executor): Pool listing acquisitions.
+            rate (float): Bytes per second of the prefetch downloads.
+            max_bytes (int): Bytes prefetched for a single container.
+            on_files_cached (callable, optional): Called with a set of file ids
+                once they are prefetched.
+        """
+        self.download_manager = download_manager
+        self.main_queue = main_queue
+        self.executor = executor
+        self.rate = rate
+        self.max_bytes = max_bytes
+        self.on_files_cached = on_files_cached
+        self.listing_cache = None
+        self.enabled = False
+        self._target = None
+        self._planning = None
+
+    def prefetch(self, record):
+        """
+        Prefetch the files under a session or acquisition, replacing the previous
+        prefetch. Does nothing if disabled or already prefetching the container.
+
+        Args:
+            record (ContainerRecord): Session or acquisition the user is on.
+        """
+        if not self.enabled or self.listing_cache is None:
+            return
+        if record.container_type not in ("session", "acquisition"):
+            return
+        if self._target == record.id:
+            return
+        self.cancel()
+        self._target = record.id
+        self._planning = self.main_queue.submit(
+            self.executor,
+            self._plan,
+            record,
+            callback=lambda jobs: self._start(record.id, jobs),
+            errback=lambda exc: log.debug("Prefetch of %s failed: %s", record.id, exc),
+        )
+
+    def _plan(self, record):
+        """
+        Choose the files to prefetch. Runs on a worker thread.
+
+        Args:
+            record (ContainerRecord): Session or acquisition.
+
+        Returns:
+            list: DownloadJobs of uncached files, most wanted first, within
+                max_bytes.
+        """
+        if record.container_type == "session":
+            acquisitions = self.listing_cache.children(record, "acquisitions")
+        else:
+            acquisitions = [record]
+        candidates = [
+            (PREFETCH_RANKS[file.type], order, acquisition, file)
+            for order, acquisition in enumerate(acquisitions)
+            for file in acquisition.files or []
+            if file.type in PREFETCH_RANKS
+        ]
+        candidates.sort(key=lambda candidate: candidate[:2])
+        manifest = self.download_manager.cache_manifest
+        jobs, total = [], 0
+        for _, _, acquisition, file in candidates:
+            if manifest is not None and manifest.is_current(file):
+                continue
+            if total + (file.size or 0) > self.max_bytes:
+                continue
+            total += file.size or 0
+            jobs.append(download_job(acquisition, file))
+        return jobs
+
+    def _start(self, target, jobs):
+        """
+        Queue the planned downloads unless the user moved on meanwhile.
+
+        Args:
+            target (str): Id of the container the jobs were planned for.
+            jobs (list): DownloadJobs to prefetch.
+        """
+        self._planning = None
+        if target != self._target or not self.enabled:
+            return
+        if jobs:
+            log.info("Prefetching %d files of %s", len(jobs), target)
+        self.download_manager.prefetch(
+            jobs, rate=self.rate, on_file_cached=self._file_cached
+        )
+
+    def _file_cached(self, job):
+        """
+        Args:
+            job (DownloadJob): Prefetched file.
+        """
+        if self.on_files_cached:
+            self.on_files_cached({job.file_id})
+
+    def cancel(self, record=None):
+        """
+        Stop prefetching.
+
+        Args:
+            record (ContainerRecord, optional): Only stop if prefetching this
+                container, e.g. when it is collapsed.
+        """
+        if record is not None and record.id != self._target:
+            return
+        self._target = None
+        if self._planning is not None:
+            self._planning.cancel()
+            self._planning = None
+        self.download_manager.cancel_prefetch()
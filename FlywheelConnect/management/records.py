@@ -0,0 +1,217 @@
+"""
+Lightweight, serializable stand-ins for Flywheel containers and files.
+
+Flywheel SDK objects hold a reference to the client and cannot be stored on disk.
+The tree, the listing cache and the file cache work with these records instead.
+"""
+
+# Child container listing of each container type
+CHILD_KINDS = {
+    "group": "projects",
+    "project": "subjects",
+    "subject": "sessions",
+    "session": "acquisitions",
+}
+
+# Container types that can host analyses
+ANALYSIS_HOSTS = ("project", "subject", "session", "acquisition")
+
+PARENT_TYPES = ("group", "project", "subject", "session", "acquisition")
+
+
+def _timestamp(value):
+    """
+    Normalize a Flywheel timestamp for storage and comparison.
+
+    Args:
+        value (datetime.datetime or str or None): Timestamp from the SDK or disk.
+
+    Returns:
+        str: ISO formatted timestamp or None.
+    """
+    if value is None or isinstance(value, str):
+        return value
+    return value.isoformat()
+
+
+class FileRecord:
+    """
+    Record of a file attached to a Flywheel container.
+    """
+
+    __slots__ = (
+        "id",
+        "name",
+        "type",
+        "size",
+        "modified",
+        "hash",
+        "version",
+        "modality",
+    )
+
+    # Files are leaves of the tree
+    files = None
+    hosts_analyses = False
+
+    def __init__(
+        self,
+        id,
+        name,
+        type=None,
+        size=0,
+        modified=None,
+        hash=None,
+        version=None,
+        modality=None,
+    ):
+        self.id = id
+        self.name = name
+        self.type = type
+        self.size = size or 0
+        self.modified = modified
+        self.hash = hash
+        self.version = version
+        self.modality = modality
+
+    @property
+    def label(self):
+        """
+        str: Files are labeled by their name in the tree.
+        """
+        return self.name
+
+    @classmethod
+    def from_file(cls, file_entry):
+        """
+        Create a record from a Flywheel SDK file entry.
+
+        Args:
+            file_entry (flywheel.FileEntry): File entry of a container.
+
+        Returns:
+            FileRecord: Record of the file.
+        """
+        return cls(
+            getattr(file_entry, "file_id", None) or file_entry.id,
+            file_entry.name,
+            getattr(file_entry, "type", None),
+            getattr(file_entry, "size", 0),
+            _timestamp(getattr(file_entry, "modified", None)),
+            getattr(file_entry, "hash", None),
+            getattr(file_entry, "version", None),
+            getattr(file_entry, "modality", None),
+        )
+
+    def to_dict(self):
+        """
+        Returns:
+            dict: JSON serializable representation of the record.
+        """
+        return {slot: getattr(self, slot) for slot in self.__slots__}
+
+    @classmethod
+    def from_dict(cls, values):
+        """
+        Args:
+            values (dict): Output of to_dict.
+
+        Returns:
+            FileRecord: Record of the file.
+        """
+        return cls(**values)
+
+
+class ContainerRecord:
+    """
+    Record of a Flywheel container (group, project, ..., acquisition or analysis).
+    """
+
+    __slots__ = ("id", "label", "container_type", "modified", "parents", "files")
+
+    def __init__(
+        self, id, label, container_type, modified=None, parents=None, files=None
+    ):
+        self.id = id
+        self.label = label
+        self.container_type = container_type
+        self.modified = modified
+        self.parents = parents or {}
+        self.files = files
+
+    @property
+    def hosts_analyses(self):
+        """
+        bool: Whether analyses can be attached to this container.
+        """
+        return self.container_type in ANALYSIS_HOSTS
+
+    @property
+    def child_kind(self):
+        """
+        str: Name of the child container listing (e.g. "sessions") or None.
+        """
+        return CHILD_KINDS.get(self.container_type)
+
+    @classmethod
+    def from_container(cls, container):
+        """
+        Create a record from a Flywheel SDK container.
+
+        Args:
+            container (flywheel.Container): Group, project, ..., or analysis.
+
+        Returns:
+            ContainerRecord: Record of the container.
+        """
+        container_type = getattr(container, "container_type", None) or "group"
+        label = getattr(container, "label", None) or getattr(container, "code", None)
+        parents = {}
+        container_parents = getattr(container, "parents", None)
+        if container_parents:
+            for parent_type in PARENT_TYPES:
+                parent_id = getattr(container_parents, parent_type, None)
+                if parent_id:
+                    parents[parent_type] = parent_id
+        files = None
+        if container_type != "group":
+            files = [
+                FileRecord.from_file(fl)
+                for fl in (getattr(container, "files", None) or [])
+            ]
+        return cls(
+            container.id,
+            label or container.id,
+            container_type,
+            _timestamp(getattr(container, "modified", None)),
+            parents,
+            files,
+        )
+
+    def to_dict(self):
+        """
+        Returns:
+            dict: JSON serializable representation of the record.
+        """
+        values = {slot: getattr(self, slot) for slot in self.__slots__}
+        if self.files is not None:
+            values["files"] = [fl.to_dict() for fl in self.files]
+        return values
+
+    @classmethod
+    def from_dict(cls, values):
+        """
+        Args:
+            values (dict): Output of to_dict.
+
+        Returns:
+            ContainerRecord: Record of the container.
+        """
+        values = dict(values)
+        if values.get("files") is not None:
+            values["files"] = [FileRecord.from_dict(fl) for fl in values["files"]]
+        return cls(**values)
+
+
+# Parent record of the top-level "groups" listing
+ROOT = ContainerRecord("", "Flywheel", "root")
@@ -0,0 +1,431 @@
+import io
+import re
+import struct
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from zipfile import ZIP_DEFLATED, ZIP_STORED, BadZipFile, ZipFile
+
+import pydicom
+from pydicom.errors import InvalidDicomError
+
+# Bytes fetched per request while reading the central directory
+BLOCK_SIZE = 64 * 1024
+# Bytes of a member first fetched to parse its header, doubled until it parses
+HEADER_BYTES = 16 * 1024
+# Members separated by less than this are fetched with a single request
+COALESCE_GAP = 64 * 1024
+# Tags summarizing a series
+SERIES_TAGS = (
+    "Modality",
+    "SeriesNumber",
+    "SeriesDescription",
+    "StudyDescription",
+    "BodyPartExamined",
+    "Manufacturer",
+    "Rows",
+    "Columns",
+    "SliceThickness",
+    "PixelSpacing",
+)
+
+# Fixed part of a zip local file header, up to the name and extra field lengths
+_LOCAL_HEADER = struct.Struct("<4s5H3I2H")
+# Room for local extra fields longer than the central directory's copy
+_LOCAL_EXTRA_SLACK = 1024
+# Pixel Data tag, little and big endian; the header ends before it
+_PIXEL_DATA_TAGS = (b"\xe0\x7f\x10\x00", b"\x7f\xe0\x00\x10")
+_CONTENT_RANGE = re.compile(r"bytes (\d+)-(\d+)/(\d+)")
+
+
+class RangeRequestsUnsupported(Exception):
+    """
+    The server does not honor HTTP Range requests.
+    """
+
+
+class RangeReader:
+    """
+    Fetch byte ranges of a remote file. Safe to use from several threads.
+    """
+
+    def __init__(self, url, session=None):
+        """
+        Args:
+            url (str): URL of the remote file.
+            session (requests.Session, optional): Session sending the requests.
+        """
+        if session is None:
+            import requests
+
+            session = requests.Session()
+        self.url = url
+        self.session = session
+        self.size = None
+        self.requests = 0
+        self.bytes_fetched = 0
+        self._lock = threading.Lock()
+
+    def _get(self, byte_range):
+        """
+        Args:
+            byte_range (str): Value of the Range header, e.g. "0-99" or "-100".
+
+        Returns:
+            int, bytes: Offset and content of the returned range.
+        """
+        response = self.session.get(
+            self.url, headers={"Range": f"bytes={byte_range}"}, timeout=60
+        )
+        response.raise_for_status()
+        match = _CONTENT_RANGE.match(response.headers.get("Content-Range", ""))
+        if response.status_code != 206 or match is None:
+            raise RangeRequestsUnsupported(self.url)
+        with self._lock:
+            self.size = int(match.group(3))
+            self.requests += 1
+            self.bytes_fetched += len(response.content)
+        return int(match.group(1)), response.content
+
+    def fetch(self, start, end):
+        """
+        Args:
+            start (int): First byte.
+            end (int): Byte after the last one.
+
+        Returns:
+            bytes: Bytes start to end of the remote file, fewer past its end.
+        """
+        if end <= start:
+            return b""
+        return self._get(f"{start}-{end - 1}")[1]
+
+    def fetch_tail(self, length):
+        """
+        Fetch the end of the remote file, learning its size.
+
+        Args:
+            length (int): Number of bytes.
+
+        Returns:
+            int, bytes: Offset and content of the end of the file.
+        """
+        return self._get(f"-{length}")
+
+
+class _RangeFile(io.RawIOBase):
+    """
+    Read-only file over a RangeReader, for zipfile.ZipFile.
+
+    Reads are served from the spans already fetched; misses fetch at least
+    BLOCK_SIZE bytes, so parsing the central directory takes few requests.
+    """
+
+    def __init__(self, reader, max_spans=32):
+        """
+        Args:
+            reader (RangeReader): Remote file.
+            max_spans (int): Number of fetched spans kept.
+        """
+        super().__init__()
+        self._reader = reader
+        self._max_spans = max_spans
+        # The end of the archive holds the central directory
+        self._spans = [reader.fetch_tail(BLOCK_SIZE)]
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._pos
+        elif whence == io.SEEK_END:
+            offset += self._reader.size
+        self._pos = max(0, offset)
+        return self._pos
+
+    def tell(self):
+        return self._pos
+
+    def readinto(self, buffer):
+        end = min(self._pos + len(buffer), self._reader.size)
+        if end <= self._pos:
+            return 0
+        for start, data in self._spans:
+            if start <= self._pos and end <= start + len(data):
+                break
+        else:
+            start = self._pos
+            data = self._reader.fetch(
+                start, min(max(end, start + BLOCK_SIZE), self._reader.size)
+            )
+            self._spans = self._spans[-(self._max_spans - 1) :] + [(start, data)]
+        size = end - self._pos
+        buffer[:size] = data[self._pos - start : end - start]
+        self._pos = end
+        return size
+
+
+class RemoteSeries:
+    """
+    Series of a remote DICOM archive.
+    """
+
+    __slots__ = ("uid", "header", "members")
+
+    def __init__(self, uid, header, members):
+        """
+        Args:
+            uid (str): SeriesInstanceUID.
+            header (pydicom.Dataset): Header of the first member of the series.
+            members (list): ZipInfo of the members of the series.
+        """
+        self.uid = uid
+        self.header = header
+        self.members = members
+
+    @property
+    def name(self):
+        """
+        str: "<SeriesNumber>: <SeriesDescription>", as named by the DICOM plugins.
+        """
+        values = (
+            getattr(self.header, "SeriesNumber", None),
+            getattr(self.header, "SeriesDescription", None),
+        )
+        return ": ".join(str(v) for v in values if v not in (None, "")) or self.uid
+
+    @property
+    def size(self):
+        """
+        int: Bytes to download for the series.
+        """
+        return sum(info.compress_size for info in self.members)
+
+    @property
+    def tags(self):
+        """
+        dict: Values of the SERIES_TAGS found in the header, as strings.
+        """
+        return {
+            keyword: str(self.header.get(keyword))
+            for keyword in SERIES_TAGS
+            if keyword in self.header
+        }
+
+
+class RemoteDicomZip:
+    """
+    Browse a DICOM archive on a server supporting HTTP Range requests.
+
+    Opening the archive fetches only its central directory. list_series then
+    fetches the first few kilobytes of each member to group the members by series,
+    and download_series fetches the members of the chosen series, adjacent
+    members in a single request. The rest of the archive is never downloaded.
+    """
+
+    def __init__(self, url, session=None, max_workers=8):
+        """
+        Open the archive.
+
+        Args:
+            url (str): URL of the archive.
+            session (requests.Session, optional): Session sending the requests.
+            max_workers (int): Number of concurrent header requests.
+
+        Raises:
+            RangeRequestsUnsupported: The server does not honor Range requests.
+            zipfile.BadZipFile: The remote file is not a zip archive.
+        """
+        self.reader = RangeReader(url, session)
+        self.max_workers = max_workers
+        self._zip = ZipFile(_RangeFile(self.reader))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def infolist(self):
+        """
+        Returns:
+            list: ZipInfo of the files of the archive.
+        """
+        return [info for info in self._zip.infolist() if not info.is_dir()]
+
+    def _member_span(self, info):
+        """
+        Args:
+            info (zipfile.ZipInfo): Member of the archive.
+
+        Returns:
+            int, int: Bounds of the bytes holding the member and its local header.
+        """
+        end = (
+            info.header_offset
+            + _LOCAL_HEADER.size
+            + len(info.filename.encode("utf-8"))
+            + len(info.extra)
+            + info.compress_size
+            + _LOCAL_EXTRA_SLACK
+        )
+        return info.header_offset, min(end, self.reader.size)
+
+    @staticmethod
+    def _member_data(info, buffer, offset):
+        """
+        Find the compressed data of a member in fetched bytes.
+
+        Args:
+            info (zipfile.ZipInfo): Member of the archive.
+            buffer (bytes): Bytes fetched from the archive.
+            offset (int): Position of the buffer in the archive.
+
+        Returns:
+            memoryview: Compressed data of the member, truncated to the buffer.
+        """
+        start = info.header_offset - offset
+        header = _LOCAL_HEADER.unpack_from(buffer, start)
+        if header[0] != b"PK\x03\x04":
+            raise BadZipFile(f"Bad local header for {info.filename}")
+        data_start = start + _LOCAL_HEADER.size + header[-2] + header[-1]
+        return memoryview(buffer)[data_start : data_start + info.compress_size]
+
+    @staticmethod
+    def _decompress(info, data):
+        """
+        Args:
+            info (zipfile.ZipInfo): Member of the archive.
+            data (bytes-like): Compressed data of the member, possibly truncated.
+
+        Returns:
+            bytes: Decompressed data.
+        """
+        if info.compress_type == ZIP_STORED:
+            return bytes(data)
+        if info.compress_type == ZIP_DEFLATED:
+            return zlib.decompressobj(-zlib.MAX_WBITS).decompress(data)
+        raise BadZipFile(f"Unsupported compression for {info.filename}")
+
+    def read_header(self, info):
+        """
+        Parse the DICOM header of a member, fetching only its first bytes.
+
+        Args:
+            info (zipfile.ZipInfo): Member of the archive.
+
+        Returns:
+            pydicom.Dataset: Header of the member, None if it is not DICOM.
+        """
+        start, end = self._member_span(info)
+        length = HEADER_BYTES
+        while True:
+            fetch_end = min(end, end - info.compress_size + length)
+            buffer = self.reader.fetch(start, fetch_end)
+            content = self._decompress(info, self._member_data(info, buffer, start))
+            if fetch_end == end or any(tag in content for tag in _PIXEL_DATA_TAGS):
+                break
+            length *= 2
+        try:
+            return pydicom.dcmread(io.BytesIO(content), stop_before_pixels=True)
+        except (InvalidDicomError, EOFError):
+            return None
+
+    def list_series(self):
+        """
+        Group the members of the archive by series from their headers.
+
+        Returns:
+            list: RemoteSeries of the archive, by series number.
+        """
+        members = [
+            info
+            for info in self.infolist()
+            if not info.filename.upper().endswith("DICOMDIR")
+        ]
+        with ThreadPoolExecutor(
+            max_workers=self.max_workers, thread_name_prefix="fw-remote-zip"
+        ) as executor:
+            headers = list(executor.map(self.read_header, members))
+        series = {}
+        for info, header in zip(members, headers):
+            uid = header and header.get("SeriesInstanceUID")
+            if not uid:
+                continue
+            if uid not in series:
+                series[uid] = RemoteSeries(uid, header, [])
+            series[uid].members.append(info)
+        return sorted(
+            series.values(),
+            key=lambda s: int(getattr(s.header, "SeriesNumber", None) or 0),
+        )
+
+    def read_members(self, members):
+        """
+        Fetch and decompress members, adjacent members in a single request.
+
+        Args:
+            members (iterable): ZipInfo of the members.
+
+        Yields:
+            zipfile.ZipInfo, bytes: Each member and its content.
+        """
+        runs = []
+        for info in sorted(members, key=lambda info: info.header_offset):
+            start, end = self._member_span(info)
+            if runs and start - runs[-1][1] <= COALESCE_GAP:
+                runs[-1][1] = max(runs[-1][1], end)
+                runs[-1][2].append(info)
+            else:
+                runs.append([start, end, [info]])
+        for start, end, run in runs:
+            buffer = self.reader.fetch(start, end)
+            for info in run:
+                data = self._member_data(info, buffer, start)
+                if len(data) < info.compress_size:
+                    # Local extra field longer than the slack; fetch it alone
+                    member_start, member_end = self._member_span(info)
+                    member_end = min(member_end + 0xFFFF, self.reader.size)
+                    data = self._member_data(
+                        info,
+                        self.reader.fetch(member_start, member_end),
+                        member_start,
+                    )
+                content = self._decompress(info, data)
+                if zlib.crc32(content) != info.CRC:
+                    raise BadZipFile(f"Bad CRC-32 for {info.filename}")
+                yield info, content
+
+    def download_series(self, series, dest_dir):
+        """
+        Download the members of series.
+
+        Args:
+            series (iterable): RemoteSeries to download.
+            dest_dir (str or pathlib.Path): Directory receiving the files.
+
+        Returns:
+            list: Paths of the downloaded files.
+        """
+        dest_dir = Path(dest_dir)
+        dest_dir.mkdir(parents=True, exist_ok=True)
+        members = [info for one_series in series for info in one_series.members]
+        paths = []
+        for index, (info, content) in enumerate(self.read_members(members)):
+            # Member names may collide or escape dest_dir; number them instead.
+            path = dest_dir / f"{index:06d}.dcm"
+            path.write_bytes(content)
+            paths.append(path)
+        return paths
+
+    def close(self):
+        """
+        Close the archive.
+        """
+        self._zip.close()
@@ -0,0 +1,113 @@
+import importlib
+import logging
+import sys
+import threading
+import time
+
+from .instrumentation import recorder
+
+log = logging.getLogger(__name__)
+
+
+class SdkLoader:
+    """
+    Import the flywheel SDK once, off the Slicer startup path.
+
+    The SDK imports a large package of generated models. Slicer loads every module
+    at startup, so importing it there slows down every launch, even for users who
+    never open Flywheel Connect. The import is instead started on a background
+    thread once startup completed or the module is shown, and awaited only when
+    the SDK is needed, e.g. when "Connect Flywheel" is pressed.
+
+    The time the import took is logged and recorded as an "import.flywheel" span.
+    """
+
+    def __init__(self, name="flywheel"):
+        """
+        Args:
+            name (str): Name of the SDK package.
+        """
+        self.name = name
+        self.module = None
+        self.error = None
+        self.seconds = None
+        self.modules_imported = None
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def warm_up(self):
+        """
+        Start importing the SDK on a background thread. Returns immediately.
+        """
+        if self._thread is None and self.module is None:
+            self._thread = threading.Thread(
+                target=self._import, name="fw-sdk-import", daemon=True
+            )
+            self._thread.start()
+
+    def _import(self):
+        """
+        Import the SDK unless already imported or attempted.
+        """
+        with self._lock:
+            if self.module is not None or self.error is not None:
+                return
+            loaded = len(sys.modules)
+            start = time.perf_counter()
+            try:
+                self.module = importlib.import_module(self.name)
+            except ImportError as exc:
+                self.error = exc
+            self.seconds = time.perf_counter() - start
+            self.modules_imported = len(sys.modules) - loaded
+            recorder.record(
+                f"import.{self.name}",
+                start,
+                self.seconds,
+                items=self.modules_imported,
+                thread=threading.current_thread().name,
+            )
+            log.info(self.report())
+
+    def get(self):
+        """
+        Return the SDK, waiting for or running its import.
+
+        Returns:
+            module: The flywheel package.
+
+        Raises:
+            ImportError: The SDK is not installed.
+        """
+        self._import()
+        if self.module is None:
+            raise self.error
+        return self.module
+
+    def reset(self):
+        """
+        Forget a failed import, e.g. once the SDK was installed.
+        """
+        with self._lock:
+            self.error = None
+            self._thread = None
+        importlib.invalidate_caches()
+
+    def report(self):
+        """
+        Returns:
+            str: How long the import took, for tracking the startup cost.
+        """
+        if self.seconds is None:
+            return f"{self.name} not imported yet"
+        if self.module is None:
+            return f"{self.name} failed to import in {self.seconds:.2f} s: {self.error}"
+        version = getattr(self.module, "__version__", "")
+        return (
+            f"{self.name} {version} imported in {self.seconds:.2f} s "
+            f"({self.modules_imported} modules)"
+        )
+
+
+# Loader shared by the module and its widget
+flywheel_sdk = SdkLoader()
@@ -0,0 +1,204 @@
+import logging
+import threading
+
+from .records import PARENT_TYPES
+
+log = logging.getLogger(__name__)
+
+# Ancestors of a container under its project, from the top
+_PATH_TYPES = PARENT_TYPES[PARENT_TYPES.index("project") + 1 :]
+
+
+class SearchEntry:
+    """
+    Container or file of a SearchIndex.
+    """
+
+    __slots__ = ("record", "host_id")
+
+    def __init__(self, record, host_id=None):
+        """
+        Args:
+            record (ContainerRecord or FileRecord): Record of the container or file.
+            host_id (str, optional): Id of the container hosting a file.
+        """
+        self.record = record
+        self.host_id = host_id
+
+
+def _search_text(record, host_id):
+    """
+    Args:
+        record (ContainerRecord or FileRecord): Record of an entry.
+        host_id (str): Id of the container hosting a file, None for containers.
+
+    Returns:
+        str: Lower case text matched against queries.
+    """
+    if host_id is None:
+        return record.label.lower()
+    return " ".join(
+        str(value).lower()
+        for value in (record.name, record.type, record.modality)
+        if value
+    )
+
+
+class SearchIndex:
+    """
+    In-memory index of the labels of the containers of a project and of the names,
+    types and modalities of their files.
+
+    The index is filled from the containers cached by the ListingCache and is kept
+    up to date with the listings fetched while browsing. The rest of the project is
+    fetched with one bulk query per level only when it is first searched, so
+    browsing a project never pays for listing all of it. Queries match entries
+    containing every word of the query. While the user types, a query extending
+    the previous one only scans the previous matches, so type-ahead stays well
+    under 100 ms for 100k entries.
+
+    Entries are added from worker threads and searched from the main thread.
+    """
+
+    def __init__(self, project):
+        """
+        Initialize an empty index.
+
+        Args:
+            project (ContainerRecord): Record of the indexed project.
+        """
+        self.project = project
+        self.complete = False
+        self.fetching = False
+        self._containers = {project.id: project}
+        self._texts = []
+        self._positions = {}
+        self._lock = threading.Lock()
+        self._last_query = None
+        self._last_matches = None
+        for file_record in project.files or []:
+            self._put(file_record.id, SearchEntry(file_record, project.id))
+
+    def __len__(self):
+        return len(self._texts)
+
+    def add_records(self, records):
+        """
+        Index containers of the project and their files, replacing older entries.
+
+        Records of other projects are ignored.
+
+        Args:
+            records (iterable): ContainerRecords.
+        """
+        with self._lock:
+            for record in records:
+                if record.parents.get("project") != self.project.id:
+                    continue
+                self._containers[record.id] = record
+                self._put(record.id, SearchEntry(record))
+                for file_record in record.files or []:
+                    self._put(file_record.id, SearchEntry(file_record, record.id))
+            self._last_query = None
+
+    def _put(self, key, entry):
+        """
+        Add or replace an entry. Must be called with the lock held.
+
+        Args:
+            key (str): Flywheel id of the container or file.
+            entry (SearchEntry): Entry to index.
+        """
+        text = (_search_text(entry.record, entry.host_id), entry)
+        position = self._positions.get(key)
+        if position is None:
+            self._positions[key] = len(self._texts)
+            self._texts.append(text)
+        else:
+            self._texts[position] = text
+
+    def build(self, listing_cache):
+        """
+        Fill the index from the containers cached on disk.
+
+        Reads the cache database. Call from a worker thread.
+
+        Args:
+            listing_cache (ListingCache): Cache providing the containers.
+
+        Returns:
+            SearchIndex: The index.
+        """
+        self.add_records(listing_cache.cached_descendants(self.project))
+        log.info("Indexed %d cached entries of %s", len(self), self.project.label)
+        return self
+
+    def fetch(self, listing_cache):
+        """
+        Complete the index with the containers of the project not cached yet.
+
+        Blocks on the network. Call from a worker thread.
+
+        Args:
+            listing_cache (ListingCache): Cache providing the containers.
+
+        Returns:
+            SearchIndex: The index.
+        """
+        self.add_records(listing_cache.fetch_descendants(self.project))
+        self.complete = True
+        log.info("Indexed %d entries of %s", len(self), self.project.label)
+        return self
+
+    def search(self, query):
+        """
+        Find the entries containing every word of a query, in indexing order.
+
+        Args:
+            query (str): Words to look for, case insensitive.
+
+        Returns:
+            list: Matching SearchEntries.
+        """
+        query = query.lower()
+        words = query.split()
+        if not words:
+            return []
+        with self._lock:
+            matches = self._texts
+            if self._last_query is not None and query.startswith(self._last_query):
+                matches = self._last_matches
+            for word in words:
+                matches = [item for item in matches if word in item[0]]
+            self._last_query = query
+            self._last_matches = matches
+        return [entry for _, entry in matches]
+
+    def path(self, entry):
+        """
+        Records from the project down to an entry.
+
+        Args:
+            entry (SearchEntry): Entry of the index.
+
+        Returns:
+            list: ContainerRecords of the ancestors, then the record of the entry;
+                None if an ancestor is not indexed yet.
+        """
+        container = self._containers.get(entry.host_id) if entry.host_id else None
+        if entry.host_id and container is None:
+            return None
+        top = container or entry.record
+        path = [self.project]
+        for parent_type in _PATH_TYPES:
+            parent_id = top.parents.get(parent_type)
+            if parent_id is None or parent_id == top.id:
+                continue
+            parent = self._containers.get(parent_id)
+            if parent is None:
+                return None
+            path.append(parent)
+        if container is not None and container is not self.project:
+            path.append(container)
+        path.append(entry.record)
+        return path
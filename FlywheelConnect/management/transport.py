@@ -0,0 +1,372 @@
+import logging
+import random
+import threading
+import time
+from concurrent.futures import Future
+
+from .instrumentation import span
+
+log = logging.getLogger(__name__)
+
+# HTTP statuses worth retrying: the server is overloaded or briefly unavailable
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+# HTTP statuses telling the client to send fewer concurrent requests
+THROTTLE_STATUSES = (429, 503)
+
+# Client methods that only read from Flywheel
+READ_METHODS = (
+    "get",
+    "get_config",
+    "get_container_download_url",
+    "get_current_user",
+    "get_group",
+    "lookup",
+)
+
+# Finders of the client, e.g. `fw_client.subjects.find(...)`
+FINDERS = ("groups", "projects", "subjects", "sessions", "acquisitions")
+
+
+def error_status(exc):
+    """
+    Args:
+        exc (Exception): Error raised by the SDK or by requests.
+
+    Returns:
+        int: HTTP status of the failed request, None if there is none.
+    """
+    status = getattr(exc, "status", None)
+    if status is None and getattr(exc, "response", None) is not None:
+        status = getattr(exc.response, "status_code", None)
+    return status
+
+
+def retry_after(exc):
+    """
+    Args:
+        exc (Exception): Error raised by the SDK or by requests.
+
+    Returns:
+        float: Seconds the server asked to wait before retrying, None if unknown.
+    """
+    headers = getattr(exc, "headers", None)
+    if headers is None and getattr(exc, "response", None) is not None:
+        headers = getattr(exc.response, "headers", None)
+    try:
+        return float((headers or {}).get("Retry-After"))
+    except (TypeError, ValueError):
+        return None
+
+
+class ConcurrencyLimit:
+    """
+    Adaptive limit on the number of concurrent requests.
+
+    The limit is halved each time the server throttles a request and grows by one
+    after as many successful requests as the current limit (additive increase,
+    multiplicative decrease), so the client settles just below the rate the server
+    accepts.
+    """
+
+    def __init__(self, maximum, minimum=1):
+        """
+        Args:
+            maximum (int): Highest number of concurrent requests.
+            minimum (int): Lowest number of concurrent requests.
+        """
+        self.maximum = maximum
+        self.minimum = minimum
+        self.limit = maximum
+        self._active = 0
+        self._successes = 0
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        """
+        Wait for a free request slot.
+        """
+        with self._condition:
+            while self._active >= self.limit:
+                self._condition.wait()
+            self._active += 1
+
+    def release(self, throttled=False):
+        """
+        Free a request slot and adapt the limit.
+
+        Args:
+            throttled (bool): True if the server throttled the request.
+        """
+        with self._condition:
+            self._active -= 1
+            if throttled:
+                self.limit = max(self.minimum, self.limit // 2)
+                self._successes = 0
+                log.info("Flywheel throttled a request, %d concurrent", self.limit)
+            elif self.limit < self.maximum:
+                self._successes += 1
+                if self._successes >= self.limit:
+                    self.limit += 1
+                    self._successes = 0
+            self._condition.notify_all()
+
+    def resize(self, maximum):
+        """
+        Args:
+            maximum (int): New highest number of concurrent requests.
+        """
+        with self._condition:
+            self.maximum = max(self.minimum, maximum)
+            self.limit = min(self.limit, self.maximum)
+            self._condition.notify_all()
+
+
+class _FinderProxy:
+    """
+    Finder of a FlywheelTransport, e.g. `transport.subjects`.
+    """
+
+    def __init__(self, transport, name, finder):
+        self._transport = transport
+        self._name = name
+        self._finder = finder
+
+    def __call__(self, *args, **kwargs):
+        return self._transport._read((self._name,), self._finder, args, kwargs)
+
+    def find(self, *args, **kwargs):
+        return self._transport._read(
+            (self._name, "find"), self._finder.find, args, kwargs
+        )
+
+    def find_first(self, *args, **kwargs):
+        return self._transport._read(
+            (self._name, "find_first"), self._finder.find_first, args, kwargs
+        )
+
+    def __getattr__(self, name):
+        return getattr(self._finder, name)
+
+
+class FlywheelTransport:
+    """
+    Shared transport wrapping a flywheel.Client.
+
+    The transport stands in for the client: every module calls the SDK through it.
+    It provides:
+
+    * A keep-alive connection pool sized to the worker threads, used by the SDK
+      and, through `session`, by file downloads.
+    * Retries with exponential backoff and jitter on 429 and 5xx responses,
+      honoring Retry-After. Reads are retried on all of RETRY_STATUSES; writes
+      only when throttled, since the server did not process them. SDK calls are
+      retried by the transport, so every response reaches the concurrency limit
+      and a failing call is sent at most max_retries + 1 times; their connection
+      pool only retries failed connections. File downloads bypass the SDK and are
+      retried by their session.
+    * An adaptive limit on concurrent SDK requests (see ConcurrencyLimit).
+    * Coalescing of identical reads: a read issued while the same read is in
+      flight waits for it and shares its response instead of sending another
+      request. Callers must not modify shared responses.
+
+    Attributes other than the SDK methods, e.g. `api_client`, are the client's.
+    """
+
+    def __init__(self, fw_client, pool_size=16, max_retries=5, backoff=0.5):
+        """
+        Args:
+            fw_client (flywheel.Client): Authenticated client.
+            pool_size (int): Connections kept alive per host, at least the number
+                of threads sending requests.
+            max_retries (int): Retries of a failed request before giving up.
+            backoff (float): Seconds before the first retry, doubled each retry.
+        """
+        self.fw_client = fw_client
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.limit = ConcurrencyLimit(pool_size)
+        self._pool_size = pool_size
+        self._session = None
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self.coalesced = 0
+        self.retried = 0
+        self._tune_sdk_pool()
+
+    @property
+    def pool_size(self):
+        """
+        int: Connections kept alive per host.
+        """
+        return self._pool_size
+
+    @pool_size.setter
+    def pool_size(self, value):
+        if value == self._pool_size:
+            return
+        self._pool_size = value
+        self.limit.resize(value)
+        self._tune_sdk_pool()
+        if self._session is not None:
+            self._mount(self._session, RETRY_STATUSES)
+
+    def _adapter(self, statuses=()):
+        """
+        Args:
+            statuses (tuple): HTTP statuses on which idempotent requests are
+                retried, besides failed connections.
+
+        Returns:
+            requests.adapters.HTTPAdapter: Keep-alive adapter of pool_size
+                connections.
+        """
+        from requests.adapters import HTTPAdapter
+        from urllib3.util.retry import Retry
+
+        options = dict(
+            total=self.max_retries,
+            read=0,
+            backoff_factor=self.backoff,
+            status_forcelist=statuses,
+            respect_retry_after_header=True,
+            raise_on_status=False,
+        )
+        try:
+            retry = Retry(allowed_methods=frozenset(["GET", "HEAD"]), **options)
+        except TypeError:
+            # urllib3 < 1.26
+            retry = Retry(method_whitelist=frozenset(["GET", "HEAD"]), **options)
+        return HTTPAdapter(
+            pool_connections=4, pool_maxsize=self._pool_size, max_retries=retry
+        )
+
+    def _mount(self, session, statuses=()):
+        """
+        Args:
+            session (requests.Session): Session receiving the pooled adapter.
+            statuses (tuple): HTTP statuses retried by the adapter.
+        """
+        adapter = self._adapter(statuses)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+
+    def _tune_sdk_pool(self):
+        """
+        Size the connection pool of the SDK to pool_size.
+        """
+        api_client = getattr(self.fw_client, "api_client", None)
+        rest_client = getattr(api_client, "rest_client", None)
+        session = getattr(rest_client, "session", None)
+        pool_manager = getattr(rest_client, "pool_manager", None)
+        if session is not None:
+            self._mount(session)
+        elif pool_manager is not None:
+            pool_manager.connection_pool_kw["maxsize"] = self._pool_size
+            pool_manager.clear()
+        else:
+            log.debug("Cannot size the connection pool of the Flywheel SDK")
+
+    @property
+    def session(self):
+        """
+        requests.Session: Pooled session for file downloads, retrying them on
+            RETRY_STATUSES.
+        """
+        with self._lock:
+            if self._session is None:
+                import requests
+
+                self._session = requests.Session()
+                self._mount(self._session, RETRY_STATUSES)
+            return self._session
+
+    def __getattr__(self, name):
+        attribute = getattr(self.fw_client, name)
+        if name in FINDERS:
+            return _FinderProxy(self, name, attribute)
+        if not callable(attribute):
+            return attribute
+        if name in READ_METHODS:
+            return lambda *args, **kwargs: self._read(
+                (name,), attribute, args, kwargs
+            )
+        return lambda *args, **kwargs: self._call(
+            (name,), attribute, args, kwargs, False
+        )
+
+    def _read(self, name, method, args, kwargs):
+        """
+        Send a read, or wait for the identical read already in flight.
+
+        Args:
+            name (tuple): Name of the SDK method, e.g. ("subjects", "find").
+            method (callable): SDK method.
+            args (tuple): Positional arguments of the call.
+            kwargs (dict): Keyword arguments of the call.
+
+        Returns:
+            object: Response of the SDK method.
+        """
+        key = name + (args, tuple(sorted(kwargs.items())))
+        try:
+            hash(key)
+        except TypeError:
+            return self._call(name, method, args, kwargs, True)
+        with self._lock:
+            future = self._inflight.get(key)
+            owner = future is None
+            if owner:
+                future = self._inflight[key] = Future()
+            else:
+                self.coalesced += 1
+        if not owner:
+            return future.result()
+        try:
+            future.set_result(self._call(name, method, args, kwargs, True))
+        except BaseException as exc:
+            future.set_exception(exc)
+        finally:
+            with self._lock:
+                del self._inflight[key]
+        return future.result()
+
+    def _call(self, name, method, args, kwargs, idempotent):
+        """
+        Call an SDK method within the concurrency limit, retrying failures.
+
+        Each attempt is recorded as an "api.<name>" span.
+
+        Args:
+            name (tuple): Name of the SDK method, e.g. ("subjects", "find").
+            method (callable): SDK method.
+            args (tuple): Positional arguments of the call.
+            kwargs (dict): Keyword arguments of the call.
+            idempotent (bool): True if the call may be retried on server errors.
+
+        Returns:
+            object: Response of the SDK method.
+        """
+        retryable = RETRY_STATUSES if idempotent else (429,)
+        for attempt in range(self.max_retries + 1):
+            self.limit.acquire()
+            throttled = False
+            try:
+                with span("api." + ".".join(name), attempt=attempt) as measures:
+                    result = method(*args, **kwargs)
+                    if isinstance(result, list):
+                        measures["items"] = len(result)
+                return result
+            except Exception as exc:
+                status = error_status(exc)
+                throttled = status in THROTTLE_STATUSES
+                if status not in retryable or attempt == self.max_retries:
+                    raise
+                delay = retry_after(exc)
+                if delay is None:
+                    delay = self.backoff * 2 ** attempt * random.uniform(0.5, 1.5)
+                log.info("Flywheel returned %s, retrying in %.1f s", status, delay)
+                self.retried += 1
+            finally:
+                self.limit.release(throttled)
+            time.sleep(delay)
@@ -0,0 +1,420 @@
+import logging
+import time
+from collections import deque
+from functools import partial
+
+from .instrumentation import recorder
+from .records import CHILD_KINDS
+
+# Container listings that are fetched page by page
+PAGED_KINDS = tuple(CHILD_KINDS.values())
+
+log = logging.getLogger(__name__)
+
+
+class ExpandRequest:
+    """
+    State of a single in-progress tree node expansion.
+    """
+
+    def __init__(self, item, paging=False):
+        """
+        Initialize the request for a tree item.
+
+        Args:
+            item (ContainerItem or FolderItem): Tree item being expanded, or folder
+                receiving the next page of a paged listing.
+            paging (bool): True if the request fetches the next page of a folder.
+        """
+        self.item = item
+        self.paging = paging
+        self.placeholders = set()
+        self.revealed = set()
+        self.pending = deque()
+        self.refreshed = []
+        self.futures = []
+        self.fetches = 0
+        self.rows = 0
+        self.failed = False
+        self.cancelled = False
+        self.started = time.perf_counter()
+
+
+class TreeExpander:
+    """
+    Fill expanded tree nodes from the listing cache and Flywheel.
+
+    Cached listings are inserted right away. Missing listings are fetched on worker
+    threads while "Loading..." placeholders are shown, and stale listings are
+    revalidated in the background and merged into the tree when they changed. Rows
+    are inserted on the main thread one page per callback, each page with a single
+    model insertion, so the tree stays responsive.
+
+    Child containers are listed one page at a time. Folders remember the id of their
+    last child and fetch the next page when the view asks for more (fetch_more).
+
+    Folders holding only the rows of a revealed path (see
+    FlywheelTreeModel.reveal) are listed in full and merged, so the revealed rows
+    keep their state while their siblings are added.
+
+    Folders are addressed by their reference in the FlywheelTreeModel.
+    """
+
+    def __init__(self, model, main_queue, executor, page_size=500):
+        """
+        Initialize the expander.
+
+        Args:
+            model (FlywheelTreeModel): Model receiving the listed rows.
+            main_queue (MainThreadQueue): Queue delivering results to the main thread.
+            executor (concurrent.futures.Executor): Executor for listing requests.
+            page_size (int): Number of child containers fetched per request and
+                inserted per main thread callback.
+        """
+        self.model = model
+        self.main_queue = main_queue
+        self.executor = executor
+        self.page_size = page_size
+        self.listing_cache = None
+        self._requests = {}
+
+    def expand(self, item):
+        """
+        Start listing the children of a tree item unless already listed or pending.
+
+        Args:
+            item (ContainerItem or AnalysisFolderItem): Tree item being expanded.
+        """
+        if item._listed or item.ref in self._requests:
+            return
+        request = ExpandRequest(item)
+        self._requests[item.ref] = request
+        self.main_queue.acquire()
+        for folder_ref, parent, kind in item._listings():
+            limit = self.page_size if kind in PAGED_KINDS else None
+            state = self.model.folder_state(folder_ref)
+            state.listing = (parent, kind)
+            records, fresh, complete = self.listing_cache.peek(parent, kind)
+            if folder_ref in self.model.revealed:
+                # Keep the revealed rows and merge the full listing into them.
+                self.model.revealed.discard(folder_ref)
+                request.revealed.add(folder_ref)
+                limit = None
+                if records is None or not complete:
+                    records, fresh = None, False
+                else:
+                    request.refreshed.append((folder_ref, records, True))
+            else:
+                # Drop rows left behind by an earlier, failed expansion.
+                self.model.remove_children(folder_ref)
+                if records is None:
+                    request.placeholders.add(folder_ref)
+                    self.model.set_loading(folder_ref, True)
+                else:
+                    self._queue_rows(request, folder_ref, records)
+                    self._set_cursor(state, records, complete)
+            if records is None or not fresh:
+                request.fetches += 1
+                request.futures.append(
+                    self.main_queue.submit(
+                        self.executor,
+                        self.listing_cache.refresh,
+                        parent,
+                        kind,
+                        limit,
+                        callback=partial(
+                            self._fetched, request, folder_ref, records is None
+                        ),
+                        errback=partial(self._failed, request, folder_ref),
+                    )
+                )
+        self._schedule(request)
+
+    def can_fetch_more(self, folder):
+        """
+        Check whether a folder has another page of children to fetch.
+
+        Args:
+            folder (FolderItem): Folder of a listed container.
+
+        Returns:
+            bool: True if a page can be fetched now.
+        """
+        state = self.model.folder_state(folder.ref)
+        return (
+            state.next_after is not None
+            and not state.fetching
+            and folder.parent_item._listed
+        )
+
+    def fetch_more(self, folder):
+        """
+        Fetch and append the next page of children of a folder.
+
+        Args:
+            folder (FolderItem): Folder of a listed container.
+        """
+        if not self.can_fetch_more(folder):
+            return
+        state = self.model.folder_state(folder.ref)
+        parent, kind = state.listing
+        request = ExpandRequest(folder, paging=True)
+        self._requests[folder.ref] = request
+        self.main_queue.acquire()
+        state.fetching = True
+        request.placeholders.add(folder.ref)
+        self.model.set_loading(folder.ref, True)
+        request.fetches = 1
+        request.futures.append(
+            self.main_queue.submit(
+                self.executor,
+                self.listing_cache.fetch_page,
+                parent,
+                kind,
+                state.next_after,
+                self.page_size,
+                callback=partial(self._page_fetched, request, folder.ref),
+                errback=partial(self._failed, request, folder.ref),
+            )
+        )
+
+    @staticmethod
+    def _set_cursor(state, records, complete):
+        """
+        Remember where the next page of a folder starts.
+
+        Args:
+            state (FolderState): Paging state of the folder listing the records.
+            records (list): Records of the latest page.
+            complete (bool): Whether the listing is complete.
+        """
+        state.next_after = None if complete or not records else records[-1].id
+
+    def _queue_rows(self, request, folder_ref, records):
+        """
+        Queue rows for insertion, split into pages.
+
+        Args:
+            request (ExpandRequest): Request inserting the rows.
+            folder_ref (int): Reference of the folder receiving the rows.
+            records (list): Records of the rows.
+        """
+        for start in range(0, len(records), self.page_size):
+            request.pending.append(
+                (folder_ref, records[start : start + self.page_size])
+            )
+
+    def _schedule(self, request):
+        """
+        Insert queued rows in the background, or finish the request.
+
+        Args:
+            request (ExpandRequest): Request with rows to insert.
+        """
+        if request.pending:
+            self.main_queue.post(self._insert_batch, request)
+        else:
+            self._merge_refreshed(request)
+
+    def _remove_placeholder(self, request, folder_ref):
+        """
+        Remove the "Loading..." row of a folder.
+
+        Args:
+            request (ExpandRequest): Request showing the placeholder.
+            folder_ref (int): Reference of the folder showing the placeholder.
+        """
+        if folder_ref in request.placeholders:
+            request.placeholders.discard(folder_ref)
+            self.model.set_loading(folder_ref, False)
+
+    def _fetched(self, request, folder_ref, was_missing, result):
+        """
+        Insert fetched children or queue a revalidated listing for merging.
+
+        Args:
+            request (ExpandRequest): Request the children were fetched for.
+            folder_ref (int): Reference of the folder receiving the children.
+            was_missing (bool): True if nothing was cached for the folder.
+            result (tuple): Records, changed and complete flags from
+                ListingCache.refresh.
+        """
+        if request.cancelled:
+            return
+        records, changed, complete = result
+        request.fetches -= 1
+        # A running chain of batches picks up new rows and refreshed listings.
+        idle = not request.pending
+        if was_missing and folder_ref not in request.revealed:
+            self._remove_placeholder(request, folder_ref)
+            self._queue_rows(request, folder_ref, records)
+            self._set_cursor(self.model.folder_state(folder_ref), records, complete)
+        elif changed or folder_ref in request.revealed:
+            request.refreshed.append((folder_ref, records, complete))
+        if idle:
+            self._schedule(request)
+
+    def _page_fetched(self, request, folder_ref, result):
+        """
+        Append a fetched page of children to a folder.
+
+        Args:
+            request (ExpandRequest): Paging request of the folder.
+            folder_ref (int): Reference of the folder receiving the children.
+            result (tuple): Records and complete flag from ListingCache.fetch_page.
+        """
+        records, complete = result
+        self._fetched(request, folder_ref, True, (records, True, complete))
+
+    def _insert_batch(self, request):
+        """
+        Insert the next page of children and reschedule until none are left.
+
+        Args:
+            request (ExpandRequest): Request being inserted.
+        """
+        if request.cancelled:
+            return
+        folder_ref, records = request.pending.popleft()
+        self.model.append_children(folder_ref, records)
+        request.rows += len(records)
+        if request.pending:
+            self.main_queue.post(self._insert_batch, request)
+        else:
+            self._merge_refreshed(request)
+
+    def _merge_refreshed(self, request):
+        """
+        Merge revalidated listings into their folders and finish the request.
+
+        Rows of removed containers are dropped, rows of new containers are appended
+        and the records of the remaining rows are updated in place, so expanded
+        children keep their state. For a paged listing only the rows covered by the
+        revalidated first page are considered.
+
+        Args:
+            request (ExpandRequest): Request with revalidated listings.
+        """
+        table = self.model.table
+        while request.refreshed:
+            folder_ref, records, complete = request.refreshed.pop(0)
+            wanted = {record.id: record for record in records}
+            last_id = records[-1].id if records else None
+            child_ids = []
+            child_nodes = table.child_nodes(folder_ref)
+            for row in reversed(range(len(child_nodes))):
+                node = child_nodes[row]
+                child_id = table.ids[node]
+                record = wanted.pop(child_id, None)
+                if record is not None:
+                    self.model.update_record(node, record)
+                    child_ids.append(child_id)
+                elif complete or last_id is None or child_id <= last_id:
+                    self.model.remove_child(folder_ref, row)
+                else:
+                    child_ids.append(child_id)
+            added = [record for record in records if record.id in wanted]
+            self.model.append_children(folder_ref, added)
+            request.rows += len(added)
+            child_ids.extend(record.id for record in added)
+            self._set_cursor(
+                self.model.folder_state(folder_ref),
+                [] if complete else sorted(child_ids),
+                complete,
+            )
+        if request.fetches == 0:
+            self._finish(request)
+
+    def _finish(self, request):
+        """
+        Release a completed request and record its "tree.expand" or
+        "tree.fetch_more" span.
+
+        Args:
+            request (ExpandRequest): Completed request.
+        """
+        recorder.record(
+            "tree.fetch_more" if request.paging else "tree.expand",
+            request.started,
+            time.perf_counter() - request.started,
+            items=request.rows,
+            failed=request.failed,
+        )
+        if self._requests.pop(request.item.ref, None) is request:
+            if request.paging:
+                self.model.folder_state(request.item.ref).fetching = False
+            else:
+                request.item._listed = not request.failed
+            self.main_queue.release()
+
+    def _failed(self, request, folder_ref, exc):
+        """
+        Clean up after a failed listing so the node can be expanded again.
+
+        Args:
+            request (ExpandRequest): Failed request.
+            folder_ref (int): Reference of the folder that was being listed.
+            exc (Exception): Error raised while listing.
+        """
+        if request.cancelled:
+            return
+        log.error("Failed to list %s: %s", self.model.display_text(folder_ref), exc)
+        request.fetches -= 1
+        request.failed = True
+        self._remove_placeholder(request, folder_ref)
+        if not request.pending:
+            self._merge_refreshed(request)
+
+    def cancel(self, item):
+        """
+        Cancel the pending expansion or page fetch of a collapsed tree item.
+
+        Partially inserted children of a container are removed so the container is
+        listed in full the next time it is expanded. A folder keeps the rows of its
+        partially inserted page and continues after them.
+
+        Args:
+            item (TreeItem): Collapsed tree item.
+        """
+        request = self._requests.pop(item.ref, None)
+        if request is not None:
+            self._cancel(request)
+            if request.paging:
+                self._remove_placeholder(request, item.ref)
+                state = self.model.folder_state(item.ref)
+                state.fetching = False
+                child_nodes = self.model.table.child_nodes(item.ref)
+                if child_nodes:
+                    state.next_after = self.model.table.ids[child_nodes[-1]]
+                return
+            for folder_ref in list(request.placeholders):
+                self._remove_placeholder(request, folder_ref)
+            for folder_ref, _, _ in item._listings():
+                self.model.remove_children(folder_ref)
+        if hasattr(item, "_listings"):
+            for folder_ref, _, _ in item._listings():
+                if folder_ref != item.ref:
+                    self.cancel(self.model.item_for_ref(folder_ref))
+
+    def _cancel(self, request):
+        """
+        Mark a request cancelled and release its hold on the main thread queue.
+
+        Args:
+            request (ExpandRequest): Request to cancel.
+        """
+        request.cancelled = True
+        for future in request.futures:
+            future.cancel()
+        request.pending.clear()
+        self.main_queue.release()
+
+    def cancel_all(self):
+        """
+        Cancel all pending expansions, e.g. before the tree is repopulated.
+
+        Tree rows are left untouched since they are about to be discarded.
+        """
+        for request in self._requests.values():
+            self._cancel(request)
+        self._requests.clear()
@@ -1,15 +1,27 @@
-from PythonQt import QtGui
+import logging
+
 from PythonQt.QtCore import Qt
-from qt import QAbstractItemView, QItemSelectionModel, QMenu
+from qt import QAbstractItemView, QItemSelectionModel, QMenu, QPoint
 
+from .bulk_download import BULK_CONTAINER_TYPES, BulkDownloader
 from .fw_container_items import (
     AnalysisFolderItem,
     AnalysisItem,
     ContainerItem,
     FileItem,
-    GroupItem,
-    ProjectItem,
+    FolderItem,
 )
+from .node_table import ROOT_REF
+from .prefetcher import Prefetcher
+from .records import ROOT
+from .search_index import SearchIndex
+from .tree_expansion import TreeExpander
+from .tree_model import FlywheelTreeModel
+
+log = logging.getLogger(__name__)
+
+# Matches of a tree filter shown at most
+MAX_FILTER_MATCHES = 500
 
 
 class TreeManagement:
@@ -27,6 +39,13 @@ class TreeManagement:
         self.main_window = main_window
         self.treeView = self.main_window.treeView
         self.cache_files = {}
+        self.project = None
+        self.search_index = None
+        self.filter_text = ""
+        # State keys (see FlywheelTreeModel.state_key) of the expanded rows, and of
+        # the rows still to expand to restore an earlier session
+        self.expanded = set()
+        self.pending_expanded = set()
         tree = self.treeView
         # https://doc.qt.io/archives/qt-4.8/qabstractitemview.html
         tree.selectionMode = QAbstractItemView.ExtendedSelection
@@ -34,11 +53,30 @@ class TreeManagement:
         tree.clicked.connect(self.tree_clicked)
         tree.doubleClicked.connect(self.tree_dblclicked)
         tree.expanded.connect(self.on_expanded)
+        tree.collapsed.connect(self.on_collapsed)
+
+        self.source_model = FlywheelTreeModel()
+        self.expander = TreeExpander(
+            self.source_model,
+            self.main_window.main_queue,
+            self.main_window.listing_executor,
+        )
+        self.source_model.expander = self.expander
+        self.prefetcher = Prefetcher(
+            self.main_window.download_manager,
+            self.main_window.main_queue,
+            self.main_window.listing_executor,
+            on_files_cached=self.source_model.refresh_cached,
+        )
+        self.bulk_downloader = BulkDownloader(
+            self.main_window.download_manager, self.main_window.main_queue
+        )
 
         tree.setContextMenuPolicy(Qt.CustomContextMenu)
         tree.customContextMenuRequested.connect(self.open_menu)
-        self.source_model = QtGui.QStandardItemModel()
         tree.setModel(self.source_model)
+        self.source_model.rowsInserted.connect(self.on_rows_inserted)
+        tree.verticalScrollBar().valueChanged.connect(self.on_scrolled)
         self.selection_model = QItemSelectionModel(self.source_model)
         tree.setSelectionModel(self.selection_model)
         tree.selectionModel().selectionChanged.connect(self.on_selection_changed)
@@ -62,20 +100,216 @@ class TreeManagement:
         item = self.get_id(index)
         if isinstance(item, AnalysisFolderItem):
             item._dblclicked()
+            self.expander.expand(item)
 
     def populateTree(self):
         """
         Populate the tree starting with groups
         """
-        groups = self.main_window.fw_client.groups()
-        for group in groups:
-            group_item = GroupItem(self.source_model, group)
+        groups = self.main_window.listing_cache.children(ROOT, "groups")
+        self.source_model.append_children(ROOT_REF, groups)
 
     def populateTreeFromProject(self, project):
         """
         Populate Tree from a single Project
+
+        Args:
+            project (ContainerRecord): Record of the project.
+        """
+        self.project = project
+        self.source_model.append_children(ROOT_REF, [project])
+        self.index_project(project)
+
+    def index_project(self, project):
+        """
+        Build the SearchIndex of a project from its cached containers in the
+        background.
+
+        Listings fetched while browsing are added to the index as they arrive. The
+        rest of the project is fetched when it is first filtered.
+
+        Args:
+            project (ContainerRecord): Record of the project.
+        """
+        listing_cache = self.main_window.listing_cache
+        self.search_index = SearchIndex(project)
+        listing_cache.on_stored = self.search_index.add_records
+        self.main_window.main_queue.submit(
+            self.main_window.listing_executor,
+            self.search_index.build,
+            listing_cache,
+            callback=self._index_built,
+            errback=lambda exc: log.error("Failed to index %s: %s", project.label, exc),
+        )
+
+    def complete_index(self):
+        """
+        Fetch the containers of the project missing from the SearchIndex in the
+        background, once.
+        """
+        search_index = self.search_index
+        if search_index is None or search_index.complete or search_index.fetching:
+            return
+        search_index.fetching = True
+
+        def _failed(exc):
+            search_index.fetching = False
+            log.error("Failed to index %s: %s", search_index.project.label, exc)
+
+        self.main_window.main_queue.submit(
+            self.main_window.listing_executor,
+            search_index.fetch,
+            self.main_window.listing_cache,
+            callback=self._index_built,
+            errback=_failed,
+        )
+
+    def _index_built(self, search_index):
+        """
+        Refresh the filtered tree with the grown index.
+
+        Args:
+            search_index (SearchIndex): Filled index.
+        """
+        if search_index is self.search_index and self.filter_text:
+            self._show_matches(self.filter_text)
+
+    def filter_tree(self, text):
+        """
+        Show only the paths to the containers and files matching a filter.
+
+        The tree of the project is restored when the filter is cleared.
+
+        Args:
+            text (str): Words to look for in labels, file names, types and
+                modalities.
+
+        Returns:
+            int: Number of matches, some may not be shown; None if the filter did
+                not change.
         """
-        project_item = ProjectItem(self.source_model, project)
+        text = text.strip()
+        if text == self.filter_text or self.project is None:
+            return None
+        was_filtered = bool(self.filter_text)
+        self.filter_text = text
+        self.expander.cancel_all()
+        self.prefetcher.cancel()
+        if not text:
+            if was_filtered:
+                self.source_model.clear()
+                self.source_model.append_children(ROOT_REF, [self.project])
+                self.restore_expanded(self.expanded)
+            return 0
+        self.complete_index()
+        return self._show_matches(text)
+
+    def _show_matches(self, text):
+        """
+        Replace the tree with the paths to the matches of a filter.
+
+        Args:
+            text (str): Filter.
+
+        Returns:
+            int: Number of matches.
+        """
+        matches = self.search_index.search(text) if self.search_index else []
+        paths = []
+        for entry in matches:
+            path = self.search_index.path(entry)
+            if path is not None:
+                paths.append(path)
+                if len(paths) == MAX_FILTER_MATCHES:
+                    break
+        self.source_model.show_paths(paths)
+        self.treeView.expandAll()
+        return len(matches)
+
+    def reveal(self, path):
+        """
+        Show and select a container of the project, creating only the rows of its
+        ancestors. Their siblings are listed in the background as they expand.
+
+        Args:
+            path (list): ContainerRecords from the project down to the container.
+        """
+        model = self.source_model
+        ref = model.reveal(path)
+        if ref is None:
+            return
+        ancestors = []
+        parent_ref = model.parent_ref(ref)
+        while parent_ref != ROOT_REF:
+            ancestors.append(parent_ref)
+            parent_ref = model.parent_ref(parent_ref)
+        for ancestor in reversed(ancestors):
+            self.treeView.expand(model.index_for_ref(ancestor))
+        index = model.index_for_ref(ref)
+        self.selection_model.select(index, QItemSelectionModel.ClearAndSelect)
+        self.treeView.scrollTo(index)
+
+    def restore_expanded(self, keys):
+        """
+        Expand the rows that were expanded in an earlier session.
+
+        Each row is expanded once its parent is expanded and its listing, cached or
+        fetched, is inserted, so the tree unfolds as fast as the listings arrive.
+
+        Args:
+            keys (list): State keys of the rows to expand.
+        """
+        self.pending_expanded = set(keys)
+        model = self.source_model
+        for row in range(model.rowCount()):
+            self._expand_pending(model.index(row, 0))
+
+    def on_rows_inserted(self, parent, first, last):
+        """
+        Expand inserted rows that are waiting to be restored.
+
+        Args:
+            parent (QtCore.QModelIndex): Index of the parent of the rows.
+            first (int): First inserted row.
+            last (int): Last inserted row.
+        """
+        if not self.pending_expanded:
+            return
+        for row in range(first, last + 1):
+            self._expand_pending(self.source_model.index(row, 0, parent))
+
+    def _expand_pending(self, index):
+        """
+        Expand a row waiting to be restored, and its folder rows.
+
+        Args:
+            index (QtCore.QModelIndex): Index of a container or folder row.
+        """
+        model = self.source_model
+        item = model.item(index)
+        if not isinstance(item, (ContainerItem, FolderItem)):
+            return
+        key = model.state_key(item.ref)
+        if key not in self.pending_expanded:
+            return
+        self.pending_expanded.discard(key)
+        self.treeView.expand(index)
+        if isinstance(item, ContainerItem):
+            # Folder rows are derived from the container, not inserted.
+            for row in range(model.rowCount(index)):
+                self._expand_pending(model.index(row, 0, index))
+
+    def clear_tree(self):
+        """
+        Cancel background listings and downloads and remove all tree nodes.
+        """
+        self.cancel_pending()
+        self.source_model.clear()
+        self.project = None
+        self.search_index = None
+        self.filter_text = ""
+        self.expanded.clear()
+        self.pending_expanded.clear()
 
     def get_id(self, index):
         """
@@ -85,10 +319,9 @@ class TreeManagement:
             index (QtCore.QModelIndex): Index from selected tree node.
 
         Returns:
-            QtGui.QStandardItem: Returns the item with designated index.
+            TreeItem: Returns the item with designated index.
         """
-        item = self.source_model.itemFromIndex(index)
-        id = item.data()
+        item = self.source_model.item(index)
         # I will want to move this to "clicked" or "on select"
         # self.ui.txtID.setText(id)
         return item
@@ -104,7 +337,7 @@ class TreeManagement:
         if len(indexes) > 0:
             hasFile = False
             for index in indexes:
-                item = self.source_model.itemFromIndex(index)
+                item = self.get_id(index)
                 if isinstance(item, FileItem):
                     hasFile = True
 
@@ -112,6 +345,20 @@ class TreeManagement:
             if hasFile:
                 action = menu.addAction("Cache Selected Files")
                 action.triggered.connect(self._cache_selected)
+            file_items = self._selected_file_items()
+            if len(file_items) == 1 and self._is_dicom_archive(file_items[0]):
+                action = menu.addAction("Load DICOM Series...")
+                action.triggered.connect(
+                    lambda: self.main_window.onLoadDicomSeries(file_items[0])
+                )
+            container_items = self._selected_container_items()
+            if len(container_items) == 1 and (
+                container_items[0].container.container_type in BULK_CONTAINER_TYPES
+            ):
+                action = menu.addAction("Cache All Files Under This Container")
+                action.triggered.connect(
+                    lambda: self._cache_container(container_items[0])
+                )
             menu.exec_(self.treeView.viewport().mapToGlobal(position))
 
     def on_selection_changed(self):
@@ -120,14 +367,16 @@ class TreeManagement:
 
         If a FileItem is selected, the load button is enabled.
         Else if a ContainerItem (e.g. Project, Session,...) is selected, upload is
-        is enabled.
+        is enabled, and the files under a selected session or acquisition are
+        prefetched.
         """
         indexes = self.treeView.selectedIndexes()
         has_file = False
         containers_selected = 0
+        container_item = None
         if len(indexes) > 0:
             for index in indexes:
-                item = self.source_model.itemFromIndex(index)
+                item = self.get_id(index)
                 if isinstance(item, FileItem):
                     has_file = True
                 # Analysis Containers cannot be altered.
@@ -135,6 +384,7 @@ class TreeManagement:
                     containers_selected = 2
                 elif isinstance(item, ContainerItem):
                     containers_selected += 1
+                    container_item = item
         else:
             has_file = False
 
@@ -142,47 +392,182 @@ class TreeManagement:
         upload_enabled = containers_selected == 1
         self.main_window.uploadFilesButton.enabled = upload_enabled
         self.main_window.asAnalysisCheck.enabled = upload_enabled
+        if upload_enabled:
+            self.prefetcher.prefetch(container_item.container)
+
+    def _selected_file_items(self):
+        """
+        Collect the FileItems among the selected tree nodes.
+
+        Returns:
+            list: Selected FileItems.
+        """
+        file_items = []
+        for index in self.treeView.selectedIndexes():
+            item = self.get_id(index)
+            if isinstance(item, FileItem):
+                file_items.append(item)
+        return file_items
+
+    def _selected_container_items(self):
+        """
+        Collect the ContainerItems among the selected tree nodes.
+
+        Returns:
+            list: Selected ContainerItems.
+        """
+        return [
+            item
+            for item in map(self.get_id, self.treeView.selectedIndexes())
+            if isinstance(item, ContainerItem)
+        ]
+
+    @staticmethod
+    def _is_dicom_archive(file_item):
+        """
+        Args:
+            file_item (FileItem): Tree item of a file.
+
+        Returns:
+            bool: True if the file is a zipped DICOM series.
+        """
+        return file_item.file_type == "dicom" and file_item.file.name.endswith(".zip")
+
+    def selected_file_ids(self):
+        """
+        Returns:
+            list: Flywheel ids of the selected files.
+        """
+        return [item.container.id for item in self._selected_file_items()]
 
     def _cache_selected(self):
         """
-        Cache selected files to local directory,
+        Cache selected files to local directory in the background.
+
+        Only files are cached; "Cache All Files Under This Container" caches the
+        files of a whole container.
         """
-        # TODO: Acknowledge this is for files only or change for all files of selected
-        #       Acquisitions.
-        indexes = self.treeView.selectedIndexes()
-        if len(indexes) > 0:
-            for index in indexes:
-                item = self.source_model.itemFromIndex(index)
-                if isinstance(item, FileItem):
-                    item._add_to_cache()
+        self.main_window.download_manager.download(
+            self._selected_file_items(),
+            on_progress=self.main_window.onDownloadProgress,
+            on_finished=self.main_window.onDownloadsFinished,
+        )
+
+    def _cache_container(self, container_item):
+        """
+        Cache every file under a container with a single bulk download.
+
+        Args:
+            container_item (ContainerItem): Project, subject, session or acquisition.
+        """
+
+        def _finished(batch):
+            self.source_model.refresh_cached(set(batch.results))
+            self.main_window.onContainerCached(container_item.container, batch)
+
+        self.bulk_downloader.download(
+            container_item.container,
+            on_progress=self.main_window.onDownloadProgress,
+            on_finished=_finished,
+        )
 
     def on_expanded(self, index):
         """
         Triggered on the expansion of any tree node.
 
         Used to populate subtree on expanding only.  This significantly speeds up the
-        population of the tree.
+        population of the tree. Children are fetched in the background while a
+        "Loading..." placeholder is shown.
 
         Args:
             index (QtCore.QModelIndex): Index of expanded tree node.
         """
-        item = self.source_model.itemFromIndex(index)
-        if hasattr(item, "_on_expand"):
-            item._on_expand()
+        item = self.get_id(index)
+        # Filtered trees are expanded at once; only remember the user's expansions.
+        if isinstance(item, (ContainerItem, FolderItem)) and not self.filter_text:
+            self.expanded.add(self.source_model.state_key(item.ref))
+        if isinstance(item, ContainerItem):
+            self.expander.expand(item)
+            # Filtered trees are expanded at once; do not prefetch every match.
+            if not self.filter_text:
+                self.prefetcher.prefetch(item.container)
 
-    def cache_selected_for_open(self):
+    def on_collapsed(self, index):
+        """
+        Triggered on the collapse of any tree node.
+
+        Cancels a listing of the node that is still in progress.
+
+        Args:
+            index (QtCore.QModelIndex): Index of collapsed tree node.
+        """
+        item = self.get_id(index)
+        if isinstance(item, (ContainerItem, FolderItem)) and not self.filter_text:
+            self.expanded.discard(self.source_model.state_key(item.ref))
+        self.expander.cancel(item)
+        if isinstance(item, ContainerItem):
+            self.prefetcher.cancel(item.container)
+
+    def on_scrolled(self, value):
+        """
+        Fetch the next page of the folder at the bottom of the view near the end.
+
+        QTreeView only asks for more rows once the scroll bar hits its maximum, so
+        the next page is requested a screen ahead of time.
+
+        Args:
+            value (int): Position of the vertical scroll bar.
+        """
+        scroll_bar = self.treeView.verticalScrollBar()
+        if value < scroll_bar.maximum - scroll_bar.pageStep:
+            return
+        viewport = self.treeView.viewport()
+        index = self.treeView.indexAt(QPoint(1, viewport.height - 2))
+        while index.isValid():
+            if self.source_model.canFetchMore(index):
+                self.source_model.fetchMore(index)
+                return
+            index = index.parent()
+
+    def cancel_pending(self):
+        """
+        Cancel background listings and downloads before the tree is repopulated.
+        """
+        self.expander.cancel_all()
+        self.prefetcher.cancel()
+        self.bulk_downloader.cancel_all()
+        self.main_window.download_manager.cancel_all()
+
+    def cache_selected_for_open(self, on_file_cached=None, on_finished=None):
         """
         Cache selected files if necessary for opening in application.
+
+        Files are downloaded in the background. on_file_cached is called on the main
+        thread as soon as each file is in the cache, so loading can begin before the
+        last download finishes.
+
+        Args:
+            on_file_cached (callable, optional): Called with (file_item, file_path,
+                file_type) for each cached file.
+            on_finished (callable, optional): Called with the DownloadBatch when all
+                selected files are cached.
+
+        Returns:
+            DownloadBatch: Progress of the selected files.
         """
-        tree = self.treeView
         self.cache_files.clear()
-        for index in tree.selectedIndexes():
-            file_path = self.main_window.CacheDir
-            item = self.source_model.itemFromIndex(index)
-            if isinstance(item, FileItem):
-                file_path, file_type = item._add_to_cache()
 
-                self.cache_files[item.container.id] = {
-                    "file_path": str(file_path),
-                    "file_type": file_type,
-                }
+        def _file_cached(item, file_path, file_type):
+            self.cache_files[item.container.id] = {
+                "file_path": str(file_path),
+                "file_type": file_type,
+            }
+            if on_file_cached:
+                on_file_cached(item, file_path, file_type)
+
+        return self.main_window.download_manager.download(
+            self._selected_file_items(),
+            on_file_cached=_file_cached,
+            on_progress=self.main_window.onDownloadProgress,
+            on_finished=on_finished,
+        )
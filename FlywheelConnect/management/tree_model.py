@@ -0,0 +1,635 @@
+import qt
+from PythonQt.QtCore import Qt
+
+from .fw_container_items import (
+    KIND_ITEMS,
+    AnalysisFolderItem,
+    FileItem,
+    FolderItem,
+    LoadingItem,
+    container_cache_dir,
+)
+from .icons import get_icon, preload
+from .node_table import (
+    ANALYSES,
+    ANALYSES_REQUESTED,
+    CACHED,
+    CHILDREN,
+    FILE,
+    FILES,
+    KIND_FOLDERS,
+    LISTED,
+    LOADING,
+    NODE,
+    ROOT_REF,
+    SLOTS,
+    NodeTable,
+    kind_of,
+    loading_flag,
+)
+
+LOADING_TEXT = "Loading…"
+# Role of the Flywheel id, as stored by QStandardItem.setData
+ID_ROLE = Qt.UserRole + 1
+
+
+class FolderState:
+    """
+    Paging state of the listing shown in a folder.
+    """
+
+    __slots__ = ("listing", "next_after", "fetching")
+
+    def __init__(self):
+        # (parent record, kind) of the listing
+        self.listing = None
+        # Id of the last listed child if more pages can be fetched
+        self.next_after = None
+        self.fetching = False
+
+
+class FlywheelTreeModel(qt.QAbstractItemModel):
+    """
+    Item model of the Flywheel hierarchy backed by a NodeTable.
+
+    Only containers and files are stored. Folder rows and "Loading..." placeholders
+    are derived from their container, and TreeItems are created on demand when an
+    index is looked up, so large listings cost a few array entries per row.
+    """
+
+    def __init__(self, expander=None):
+        """
+        Initialize an empty model.
+
+        Args:
+            expander (TreeExpander, optional): Expander fetching pages of folders.
+        """
+        super(FlywheelTreeModel, self).__init__()
+        self.expander = expander
+        self.cache_manifest = None
+        self.table = NodeTable()
+        self.generation = 0
+        self._folder_states = {}
+        # Folders holding only the rows of revealed paths, see reveal
+        self.revealed = set()
+        preload(
+            [item_class.icon_path for item_class in KIND_ITEMS[1:]]
+            + [
+                FileItem.cached_icon_path,
+                FolderItem.icon_path,
+                AnalysisFolderItem.icon_path,
+            ]
+        )
+
+    # Navigation
+
+    def folder_slots(self, node):
+        """
+        Args:
+            node (int): Container node.
+
+        Returns:
+            tuple: Folder slots shown under the node, in display order.
+        """
+        return KIND_FOLDERS[self.table.kinds[node]]
+
+    def parent_ref(self, ref):
+        """
+        Args:
+            ref (int): Reference of a row.
+
+        Returns:
+            int: Reference of the parent row, ROOT_REF for top-level rows.
+        """
+        node, slot = divmod(ref, SLOTS)
+        if slot == NODE:
+            return self.table.parents[node]
+        if slot < LOADING:
+            return node * SLOTS
+        return ref - LOADING
+
+    def row_of(self, ref):
+        """
+        Args:
+            ref (int): Reference of a row.
+
+        Returns:
+            int: Row of the reference under its parent.
+        """
+        node, slot = divmod(ref, SLOTS)
+        if slot == NODE:
+            return self.table.rows[node]
+        if slot < LOADING:
+            return self.folder_slots(node).index(slot)
+        return len(self.table.child_nodes(ref - LOADING))
+
+    def child_ref(self, parent_ref, row):
+        """
+        Args:
+            parent_ref (int): Reference of the parent row or ROOT_REF.
+            row (int): Row under the parent.
+
+        Returns:
+            int: Reference of the child row.
+        """
+        if parent_ref == ROOT_REF:
+            return self.table.children[ROOT_REF][row] * SLOTS
+        node, slot = divmod(parent_ref, SLOTS)
+        if slot == NODE:
+            return parent_ref + self.folder_slots(node)[row]
+        child_nodes = self.table.child_nodes(parent_ref)
+        if row < len(child_nodes):
+            return child_nodes[row] * SLOTS
+        return parent_ref + LOADING
+
+    def index_for_ref(self, ref):
+        """
+        Args:
+            ref (int): Reference of a row or ROOT_REF.
+
+        Returns:
+            QtCore.QModelIndex: Index of the row.
+        """
+        if ref == ROOT_REF:
+            return qt.QModelIndex()
+        return self.createIndex(self.row_of(ref), 0, ref)
+
+    def state_key(self, ref):
+        """
+        Args:
+            ref (int): Reference of a container or folder row.
+
+        Returns:
+            str: "<container id>/<slot>" key of the row, valid across sessions.
+        """
+        node, slot = divmod(ref, SLOTS)
+        return f"{self.table.ids[node]}/{slot}"
+
+    def item_for_ref(self, ref):
+        """
+        Args:
+            ref (int): Reference of a row.
+
+        Returns:
+            TreeItem: Item of the row.
+        """
+        node, slot = divmod(ref, SLOTS)
+        if slot == NODE:
+            return KIND_ITEMS[self.table.kinds[node]](self, ref)
+        if slot == ANALYSES:
+            return AnalysisFolderItem(self, ref)
+        if slot < LOADING:
+            return FolderItem(self, ref)
+        return LoadingItem(self, ref)
+
+    def item(self, index):
+        """
+        Args:
+            index (QtCore.QModelIndex): Index of a row.
+
+        Returns:
+            TreeItem: Item of the row, None for an invalid index.
+        """
+        if not index.isValid():
+            return None
+        return self.item_for_ref(index.internalId())
+
+    def display_text(self, ref):
+        """
+        Args:
+            ref (int): Reference of a row.
+
+        Returns:
+            str: Text displayed for the row.
+        """
+        node, slot = divmod(ref, SLOTS)
+        if slot == NODE:
+            return self.table.labels[node]
+        if slot == FILES:
+            return "FILES"
+        if slot == ANALYSES:
+            return "ANALYSES"
+        if slot < LOADING:
+            return KIND_ITEMS[self.table.kinds[node]].child_container_name
+        return LOADING_TEXT
+
+    def icon_path(self, ref):
+        """
+        Args:
+            ref (int): Reference of a row.
+
+        Returns:
+            str: Path of the icon of the row or None.
+        """
+        node, slot = divmod(ref, SLOTS)
+        if slot == NODE:
+            kind = self.table.kinds[node]
+            if kind == FILE and self.has_flag(node, CACHED):
+                return FileItem.cached_icon_path
+            return KIND_ITEMS[kind].icon_path
+        if slot == ANALYSES:
+            if self.has_flag(node, ANALYSES_REQUESTED):
+                return AnalysisFolderItem.requested_icon_path
+            return AnalysisFolderItem.icon_path
+        if slot < LOADING:
+            return FolderItem.icon_path
+        return None
+
+    def tool_tip(self, ref):
+        """
+        Args:
+            ref (int): Reference of a row.
+
+        Returns:
+            str: Tool tip of the row or None.
+        """
+        node, slot = divmod(ref, SLOTS)
+        if slot == NODE and self.table.kinds[node] == FILE:
+            if self.has_flag(node, CACHED):
+                return "File is cached."
+            return "File is not cached"
+        if slot == ANALYSES and not self.has_flag(node, ANALYSES_REQUESTED):
+            return AnalysisFolderItem.tool_tip
+        return None
+
+    # QAbstractItemModel interface
+
+    def index(self, row, column, parent=None):
+        """
+        Args:
+            row (int): Row under parent.
+            column (int): Column, only column 0 is populated.
+            parent (QtCore.QModelIndex, optional): Parent index.
+
+        Returns:
+            QtCore.QModelIndex: Index of the child row.
+        """
+        parent = parent or qt.QModelIndex()
+        if column != 0 or row < 0 or row >= self.rowCount(parent):
+            return qt.QModelIndex()
+        parent_ref = parent.internalId() if parent.isValid() else ROOT_REF
+        return self.createIndex(row, column, self.child_ref(parent_ref, row))
+
+    def parent(self, index):
+        """
+        Args:
+            index (QtCore.QModelIndex): Index of a row.
+
+        Returns:
+            QtCore.QModelIndex: Index of the parent row.
+        """
+        if not index.isValid():
+            return qt.QModelIndex()
+        return self.index_for_ref(self.parent_ref(index.internalId()))
+
+    def rowCount(self, parent=None):
+        """
+        Args:
+            parent (QtCore.QModelIndex, optional): Parent index.
+
+        Returns:
+            int: Number of rows under parent.
+        """
+        if parent is None or not parent.isValid():
+            return len(self.table.child_nodes(ROOT_REF))
+        if parent.column() > 0:
+            return 0
+        ref = parent.internalId()
+        node, slot = divmod(ref, SLOTS)
+        if slot == NODE:
+            return len(self.folder_slots(node))
+        if slot >= LOADING:
+            return 0
+        rows = len(self.table.child_nodes(ref))
+        if self.has_flag(node, loading_flag(slot)):
+            rows += 1
+        return rows
+
+    def columnCount(self, parent=None):
+        return 1
+
+    def data(self, index, role=Qt.DisplayRole):
+        """
+        Args:
+            index (QtCore.QModelIndex): Index of a row.
+            role (int): Qt item data role.
+
+        Returns:
+            object: Text, icon, tool tip or Flywheel id of the row.
+        """
+        if not index.isValid():
+            return None
+        ref = index.internalId()
+        if role == Qt.DisplayRole:
+            return self.display_text(ref)
+        if role == Qt.DecorationRole:
+            icon_path = self.icon_path(ref)
+            return get_icon(icon_path) if icon_path else None
+        if role == Qt.ToolTipRole:
+            return self.tool_tip(ref)
+        if role == ID_ROLE and ref % SLOTS == NODE:
+            return self.table.ids[ref // SLOTS]
+        return None
+
+    def flags(self, index):
+        """
+        Args:
+            index (QtCore.QModelIndex): Index of a row.
+
+        Returns:
+            int: Placeholders are disabled, other rows are selectable.
+        """
+        if not index.isValid() or index.internalId() % SLOTS >= LOADING:
+            return Qt.NoItemFlags
+        return Qt.ItemIsEnabled | Qt.ItemIsSelectable
+
+    def canFetchMore(self, index):
+        """
+        Args:
+            index (QtCore.QModelIndex): Index of a tree node.
+
+        Returns:
+            bool: True if the node is a folder with another page of children.
+        """
+        if not index.isValid() or self.expander is None:
+            return False
+        item = self.item(index)
+        return type(item) is FolderItem and self.expander.can_fetch_more(item)
+
+    def fetchMore(self, index):
+        """
+        Fetch the next page of children of a folder in the background.
+
+        Args:
+            index (QtCore.QModelIndex): Index of a folder.
+        """
+        item = self.item(index)
+        if type(item) is FolderItem and self.expander is not None:
+            self.expander.fetch_more(item)
+
+    # Updates
+
+    def has_flag(self, node, flag):
+        """
+        Args:
+            node (int): Node of the table.
+            flag (int): Flag bit of node_table.
+
+        Returns:
+            bool: Whether the flag is set on the node.
+        """
+        return bool(self.table.flags[node] & flag)
+
+    def set_flag(self, node, flag, value):
+        """
+        Set or clear a flag of a node without notifying views.
+
+        Args:
+            node (int): Node of the table.
+            flag (int): Flag bit of node_table.
+            value (bool): New value of the flag.
+        """
+        if value:
+            self.table.flags[node] |= flag
+        else:
+            self.table.flags[node] &= ~flag & 0xFF
+
+    def row_changed(self, ref):
+        """
+        Notify views that the text, icon or tool tip of a row changed.
+
+        Args:
+            ref (int): Reference of the row.
+        """
+        index = self.index_for_ref(ref)
+        self.dataChanged.emit(index, index)
+
+    def folder_state(self, folder_ref):
+        """
+        Args:
+            folder_ref (int): Reference of a folder row.
+
+        Returns:
+            FolderState: Paging state of the folder.
+        """
+        state = self._folder_states.get(folder_ref)
+        if state is None:
+            state = self._folder_states[folder_ref] = FolderState()
+        return state
+
+    def append_children(self, parent_ref, records):
+        """
+        Append rows under the root or a folder with a single insertion.
+
+        Args:
+            parent_ref (int): ROOT_REF or a folder reference.
+            records (list): ContainerRecords or FileRecords of the new rows.
+        """
+        if not records:
+            return
+        first = len(self.table.child_nodes(parent_ref))
+        is_cached = None
+        if parent_ref % SLOTS == FILES:
+            is_cached = self._cached_check(parent_ref // SLOTS)
+        self.beginInsertRows(
+            self.index_for_ref(parent_ref), first, first + len(records) - 1
+        )
+        add = self.table.add
+        for record in records:
+            node = add(parent_ref, record)
+            if is_cached is not None and is_cached(record):
+                self.table.flags[node] |= CACHED
+        self.endInsertRows()
+
+    def _cached_check(self, node):
+        """
+        Args:
+            node (int): Container node hosting files.
+
+        Returns:
+            callable: Returns whether the FileRecord it is called with is cached.
+        """
+        if self.cache_manifest is not None:
+            return self.cache_manifest.is_current
+        # Without a manifest, resolve the cache directory once for the whole page.
+        cache_dir = container_cache_dir(self.table.records[node])
+        return lambda record: (cache_dir / record.id / record.name).exists()
+
+    def remove_child(self, parent_ref, row):
+        """
+        Remove a row and its descendants from the root or a folder.
+
+        Args:
+            parent_ref (int): ROOT_REF or a folder reference.
+            row (int): Row to remove.
+        """
+        self.beginRemoveRows(self.index_for_ref(parent_ref), row, row)
+        self._drop_folder_states(self.table.child_nodes(parent_ref)[row])
+        self.table.remove(parent_ref, row)
+        self.endRemoveRows()
+
+    def remove_children(self, parent_ref):
+        """
+        Remove all rows listed under the root or a folder.
+
+        Args:
+            parent_ref (int): ROOT_REF or a folder reference.
+        """
+        child_nodes = self.table.child_nodes(parent_ref)
+        if not child_nodes:
+            return
+        self.beginRemoveRows(self.index_for_ref(parent_ref), 0, len(child_nodes) - 1)
+        for node in child_nodes:
+            self._drop_folder_states(node)
+        self.table.remove_all(parent_ref)
+        self.endRemoveRows()
+
+    def _drop_folder_states(self, node):
+        """
+        Forget the paging state of the folders of a node and its descendants.
+
+        Args:
+            node (int): Node being removed.
+        """
+        for slot in self.folder_slots(node):
+            folder_ref = node * SLOTS + slot
+            self._folder_states.pop(folder_ref, None)
+            for child in self.table.child_nodes(folder_ref):
+                self._drop_folder_states(child)
+
+    def update_record(self, node, record):
+        """
+        Replace the record of a node after a background refresh.
+
+        Args:
+            node (int): Node of the table.
+            record (ContainerRecord or FileRecord): Fresh record.
+        """
+        self.table.records[node] = record
+        self.table.labels[node] = record.label
+        if self.table.kinds[node] == FILE and self.cache_manifest is not None:
+            # A new version of a cached file makes the cached copy stale.
+            self.set_flag(node, CACHED, self.cache_manifest.is_current(record))
+        self.row_changed(node * SLOTS)
+
+    def refresh_cached(self, file_ids):
+        """
+        Update the cached badge of files that were cached without a tree item.
+
+        Args:
+            file_ids (set): Flywheel ids of the files.
+        """
+        table = self.table
+        for file_id in file_ids:
+            node = table.file_nodes.get(file_id)
+            if node is None:
+                continue
+            record = table.records[node]
+            if record is not None and self.cache_manifest is not None:
+                self.set_flag(node, CACHED, self.cache_manifest.is_current(record))
+                self.row_changed(node * SLOTS)
+
+    def set_loading(self, folder_ref, loading):
+        """
+        Show or hide the "Loading..." row at the end of a folder.
+
+        Args:
+            folder_ref (int): Reference of a folder row.
+            loading (bool): Whether the placeholder is shown.
+        """
+        node, slot = divmod(folder_ref, SLOTS)
+        flag = loading_flag(slot)
+        if self.has_flag(node, flag) == loading:
+            return
+        row = len(self.table.child_nodes(folder_ref))
+        folder_index = self.index_for_ref(folder_ref)
+        if loading:
+            self.beginInsertRows(folder_index, row, row)
+            self.set_flag(node, flag, True)
+            self.endInsertRows()
+        else:
+            self.beginRemoveRows(folder_index, row, row)
+            self.set_flag(node, flag, False)
+            self.endRemoveRows()
+
+    def reveal(self, path):
+        """
+        Add the nodes of a path under a top-level container, without their siblings.
+
+        Folders of unlisted containers receiving a node are remembered in
+        `revealed`; the TreeExpander merges the full listing into them when their
+        container is expanded.
+
+        Args:
+            path (list): ContainerRecords from a top-level container down.
+
+        Returns:
+            int: Reference of the last node of the path, None if the top-level
+                container is not in the tree.
+        """
+        table = self.table
+        node = next(
+            (n for n in table.child_nodes(ROOT_REF) if table.ids[n] == path[0].id),
+            None,
+        )
+        if node is None:
+            return None
+        for record in path[1:]:
+            folder_ref = node * SLOTS + CHILDREN
+            child = next(
+                (n for n in table.child_nodes(folder_ref) if table.ids[n] == record.id),
+                None,
+            )
+            if child is None:
+                if not self.has_flag(node, LISTED):
+                    self.revealed.add(folder_ref)
+                self.append_children(folder_ref, [record])
+                child = table.child_nodes(folder_ref)[-1]
+            node = child
+        return node * SLOTS
+
+    def show_paths(self, paths):
+        """
+        Replace all rows with the given paths, e.g. the matches of a search.
+
+        Containers on the paths are marked as listed, so they show only the rows
+        of the paths and expanding them does not list their children.
+
+        Args:
+            paths (list): Lists of records from a top-level container down.
+        """
+        self.beginResetModel()
+        self.table.clear()
+        self._folder_states.clear()
+        self.revealed.clear()
+        self.generation += 1
+        nodes = {}
+        for path in paths:
+            parent_ref = ROOT_REF
+            for record in path:
+                kind = kind_of(record)
+                if parent_ref != ROOT_REF:
+                    parent_ref += FILES if kind == FILE else CHILDREN
+                key = (parent_ref, record.id)
+                node = nodes.get(key)
+                if node is None:
+                    node = nodes[key] = self.table.add(parent_ref, record)
+                    if kind != FILE:
+                        self.table.flags[node] |= LISTED
+                    elif self.cache_manifest is not None:
+                        self.set_flag(
+                            node, CACHED, self.cache_manifest.is_current(record)
+                        )
+                parent_ref = node * SLOTS
+        self.endResetModel()
+
+    def clear(self):
+        """
+        Remove all rows. Items created before are no longer valid.
+        """
+        self.beginResetModel()
+        self.table.clear()
+        self._folder_states.clear()
+        self.revealed.clear()
+        self.generation += 1
+        self.endResetModel()
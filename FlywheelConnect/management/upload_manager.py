@@ -0,0 +1,319 @@
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from .download_manager import CHUNK_SIZE
+from .instrumentation import span
+
+log = logging.getLogger(__name__)
+
+# What to do with a file whose name exists in the container with other content
+OVERWRITE = "overwrite"
+KEEP_BOTH = "keep both"
+CONFLICT_POLICIES = (OVERWRITE, KEEP_BOTH)
+
+# Outcomes of an upload
+UPLOADED = "uploaded"
+UNCHANGED = "unchanged"
+
+
+def parse_hash(file_hash):
+    """
+    Split a Flywheel file hash.
+
+    Args:
+        file_hash (str): Hash reported by Flywheel, e.g. "v0-sha384-<hex digest>".
+
+    Returns:
+        tuple: Algorithm and hex digest, or None if the hash cannot be checked.
+    """
+    parts = (file_hash or "").split("-")
+    if len(parts) != 3 or parts[0] != "v0":
+        return None
+    if parts[1] not in hashlib.algorithms_available:
+        return None
+    return parts[1], parts[2]
+
+
+def free_name(name, taken):
+    """
+    Find a file name that is not taken, numbering the stem of the name.
+
+    Args:
+        name (str): Wanted file name, e.g. "T1.nii.gz".
+        taken (set): Names in use.
+
+    Returns:
+        str: First free name among name, "T1 (2).nii.gz", "T1 (3).nii.gz"...
+    """
+    stem, dot, suffix = name.partition(".")
+    number = 1
+    while name in taken:
+        number += 1
+        name = f"{stem} ({number}){dot}{suffix}"
+    return name
+
+
+def content_hashes(path, algorithms):
+    """
+    Hash a file with several algorithms in a single read.
+
+    Args:
+        path (pathlib.Path): File to hash.
+        algorithms (iterable): hashlib algorithm names.
+
+    Returns:
+        dict: Algorithm -> hex digest.
+    """
+    digests = {algorithm: hashlib.new(algorithm) for algorithm in algorithms}
+    if not digests:
+        return {}
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(CHUNK_SIZE), b""):
+            for digest in digests.values():
+                digest.update(chunk)
+    return {algorithm: digest.hexdigest() for algorithm, digest in digests.items()}
+
+
+class UploadBatch:
+    """
+    Aggregate progress of a set of files uploaded together.
+    """
+
+    def __init__(self, on_progress=None, on_finished=None):
+        """
+        Initialize an empty batch.
+
+        Args:
+            on_progress (callable, optional): Called with (files_done, files_total,
+                bytes_done, bytes_total) after each file.
+            on_finished (callable, optional): Called with the batch when every file
+                was uploaded, skipped or failed.
+        """
+        self.on_progress = on_progress
+        self.on_finished = on_finished
+        self.files_total = 0
+        self.files_done = 0
+        self.bytes_total = 0
+        self.bytes_done = 0
+        self.bytes_sent = 0
+        self.results = {}
+        self.errors = {}
+
+    @property
+    def uploaded(self):
+        """
+        list: Names of the files sent to Flywheel.
+        """
+        return [name for name, outcome in self.results.items() if outcome == UPLOADED]
+
+    @property
+    def unchanged(self):
+        """
+        list: Names of the files whose content already was in the container.
+        """
+        return [name for name, outcome in self.results.items() if outcome == UNCHANGED]
+
+
+class UploadManager:
+    """
+    Upload files to a Flywheel container on a pool of worker threads.
+
+    The files of the container are listed once. Each file is hashed on a worker
+    and skipped if a file with the same content, whatever its name, is already in
+    the container, so unchanged bytes are never sent again. A file whose name
+    exists with other content is, depending on the conflict policy, uploaded over
+    it, Flywheel keeping the earlier version in the history of the file, or
+    uploaded next to it under a free name such as "name (2).ext". Existing files
+    are never deleted, so a failed upload loses nothing. Results are delivered on
+    the main thread through the MainThreadQueue.
+    """
+
+    def __init__(self, main_queue, max_workers=4):
+        """
+        Initialize the manager. fw_client must be set before uploading.
+
+        Args:
+            main_queue (MainThreadQueue): Queue delivering results to the main thread.
+            max_workers (int): Number of concurrent uploads.
+        """
+        self.main_queue = main_queue
+        self.fw_client = None
+        self.max_workers = max_workers
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="fw-upload"
+        )
+
+    def upload(
+        self,
+        container_id,
+        paths,
+        conflict=OVERWRITE,
+        on_progress=None,
+        on_finished=None,
+    ):
+        """
+        Upload files to a container in the background.
+
+        Args:
+            container_id (str): Id of the Flywheel container receiving the files.
+            paths (list): Paths of the files to upload.
+            conflict (str): One of CONFLICT_POLICIES.
+            on_progress (callable, optional): See UploadBatch.
+            on_finished (callable, optional): See UploadBatch.
+
+        Returns:
+            UploadBatch: Progress of the upload.
+        """
+        if conflict not in CONFLICT_POLICIES:
+            raise ValueError(f"Unknown conflict policy {conflict!r}")
+        batch = UploadBatch(on_progress=on_progress, on_finished=on_finished)
+        paths = [Path(path) for path in paths]
+        batch.files_total = len(paths)
+        batch.bytes_total = sum(path.stat().st_size for path in paths)
+        if not paths:
+            self._check_finished(batch)
+            return batch
+
+        def _failed(exc):
+            log.error("Cannot list the files of %s: %s", container_id, exc)
+            for path in paths:
+                batch.errors[path.name] = exc
+            batch.files_done = batch.files_total
+            self._check_finished(batch)
+
+        self.main_queue.submit(
+            self._executor,
+            self._get_container,
+            container_id,
+            callback=lambda container: self._start(batch, container, paths, conflict),
+            errback=_failed,
+        )
+        return batch
+
+    def _get_container(self, container_id):
+        """
+        Fetch a container with its current files. Runs on a worker thread.
+
+        Args:
+            container_id (str): Id of the container.
+
+        Returns:
+            Container: Flywheel container.
+        """
+        return self.fw_client.get(container_id).reload()
+
+    def _start(self, batch, container, paths, conflict):
+        """
+        Queue the upload of each file once the container is listed.
+
+        Args:
+            batch (UploadBatch): Progress of the upload.
+            container (Container): Flywheel container receiving the files.
+            paths (list): Paths of the files.
+            conflict (str): One of CONFLICT_POLICIES.
+        """
+        existing = {
+            file_entry.name: parse_hash(getattr(file_entry, "hash", None))
+            for file_entry in container.files or []
+        }
+        taken = set(existing) | {path.name for path in paths}
+        for path in paths:
+            name = path.name
+            if conflict == KEEP_BOTH and name in existing:
+                name = free_name(name, taken)
+                taken.add(name)
+            self.main_queue.submit(
+                self._executor,
+                self._upload,
+                container,
+                path,
+                existing,
+                name,
+                callback=lambda outcome, path=path: self._file_done(
+                    batch, path, outcome, None
+                ),
+                errback=lambda exc, path=path: self._file_done(batch, path, None, exc),
+            )
+
+    @staticmethod
+    def _upload(container, path, existing, name):
+        """
+        Upload a file unless its content is already in the container. Runs on a
+        worker thread.
+
+        Args:
+            container (Container): Flywheel container receiving the file.
+            path (pathlib.Path): File to upload.
+            existing (dict): Name -> (algorithm, hex digest) of the container's
+                files; the hash is None if Flywheel did not report it.
+            name (str): Name of the file in the container.
+
+        Returns:
+            str: UPLOADED or UNCHANGED.
+        """
+        size = path.stat().st_size
+        algorithms = {parsed[0] for parsed in existing.values() if parsed}
+        with span("upload.hash", bytes=size, file=path.name):
+            local = content_hashes(path, algorithms)
+        for parsed in existing.values():
+            if parsed and local[parsed[0]] == parsed[1]:
+                return UNCHANGED
+        if name in existing:
+            log.info("Uploading a new version of %s to %s", name, container.id)
+        elif name != path.name:
+            log.info("Uploading %s to %s as %s", path.name, container.id, name)
+        with span("upload.transfer", bytes=size, file=name):
+            if name == path.name:
+                container.upload_file(str(path))
+                return UPLOADED
+            # The SDK names uploads after their path: link the file under its name.
+            with tempfile.TemporaryDirectory(dir=path.parent) as link_dir:
+                link = Path(link_dir) / name
+                try:
+                    os.link(path, link)
+                except OSError:
+                    shutil.copyfile(path, link)
+                container.upload_file(str(link))
+        return UPLOADED
+
+    def _file_done(self, batch, path, outcome, error):
+        """
+        Update the progress of a batch after a file was uploaded, skipped or failed.
+
+        Args:
+            batch (UploadBatch): Progress of the upload.
+            path (pathlib.Path): File.
+            outcome (str): UPLOADED or UNCHANGED, None on error.
+            error (Exception): Error raised by the upload, if any.
+        """
+        size = path.stat().st_size if path.exists() else 0
+        batch.files_done += 1
+        batch.bytes_done += size
+        if error is not None:
+            log.error("Failed to upload %s: %s", path.name, error)
+            batch.errors[path.name] = error
+        else:
+            batch.results[path.name] = outcome
+            if outcome == UPLOADED:
+                batch.bytes_sent += size
+        if batch.on_progress:
+            batch.on_progress(
+                batch.files_done, batch.files_total, batch.bytes_done, batch.bytes_total
+            )
+        self._check_finished(batch)
+
+    @staticmethod
+    def _check_finished(batch):
+        if batch.files_done >= batch.files_total and batch.on_finished:
+            batch.on_finished(batch)
+
+    def shutdown(self):
+        """
+        Stop the worker threads. Uploads in progress are completed.
+        """
+        self._executor.shutdown(wait=False)